@@ -0,0 +1,228 @@
+# Token analytics computed in the database
+
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import Integer, case, cast, func, or_, update
+
+from timestamps import epoch_ms, seconds_between
+
+# Date range presets, in the order they are offered
+DATE_PRESETS = {
+    'today': 'Today',
+    'yesterday': 'Yesterday',
+    'last7': 'Last 7 days',
+    'last30': 'Last 30 days',
+    'this_month': 'This month',
+    'all': 'All time',
+}
+
+
+class DateRange(namedtuple('DateRange', 'start end preset')):
+    """Inclusive service dates to report on, None for an open end"""
+
+    def query_args(self):
+        """Request arguments that select this range again"""
+        if self.preset in DATE_PRESETS:
+            return {} if self.preset == 'all' else {'preset': self.preset}
+        args = {}
+        if self.start:
+            args['from'] = self.start.isoformat()
+        if self.end:
+            args['to'] = self.end.isoformat()
+        return args
+
+    @property
+    def label(self):
+        if self.preset in DATE_PRESETS:
+            return DATE_PRESETS[self.preset]
+        if self.start == self.end:
+            return self.start.isoformat()
+        return f"{self.start.isoformat() if self.start else '...'} to {self.end.isoformat() if self.end else '...'}"
+
+
+def resolve_date_range(args, today):
+    """
+    The date range selected by a preset or by from/to dates (YYYY-MM-DD)
+    in the request arguments. Raises ValueError for unknown presets and
+    malformed dates.
+    """
+    preset = args.get('preset')
+    if preset:
+        if preset == 'today':
+            return DateRange(today, today, preset)
+        if preset == 'yesterday':
+            yesterday = today - timedelta(days=1)
+            return DateRange(yesterday, yesterday, preset)
+        if preset == 'last7':
+            return DateRange(today - timedelta(days=6), today, preset)
+        if preset == 'last30':
+            return DateRange(today - timedelta(days=29), today, preset)
+        if preset == 'this_month':
+            return DateRange(today.replace(day=1), today, preset)
+        if preset == 'all':
+            return DateRange(None, None, preset)
+        raise ValueError(f'Unknown date preset: {preset}')
+
+    start = datetime.strptime(args['from'], '%Y-%m-%d').date() if args.get('from') else None
+    end = datetime.strptime(args['to'], '%Y-%m-%d').date() if args.get('to') else None
+    if start and end and start > end:
+        start, end = end, start
+    if not start and not end:
+        return DateRange(None, None, 'all')
+    return DateRange(start, end, 'custom')
+
+
+def created_between(column, start=None, end=None):
+    """Conditions for a DateTime column to fall on the service dates, index friendly"""
+    conditions = []
+    if start:
+        conditions.append(column >= datetime.combine(start, time.min))
+    if end:
+        conditions.append(column < datetime.combine(end + timedelta(days=1), time.min))
+    return conditions
+
+
+# Dialect helpers
+def truncate(value, dialect):
+    """Drop the fraction of a number, like int()"""
+    if dialect == 'sqlite':
+        return cast(value, Integer)
+    return cast(func.trunc(value), Integer)
+
+
+def token_conditions(Token):
+    """The status buckets the analytics page has always used"""
+    skip_count = func.coalesce(Token.skip_count, 0)
+    served = Token.status == 'SERVED'
+    skipped = or_(Token.status == 'SKIPPED', skip_count > 0)
+    return {
+        'served': served,
+        # Served tokens with a finished service
+        'completed': served & Token.served_at.isnot(None),
+        'skipped': skipped,
+        # Day/hour/reason buckets count a served token only as served
+        'skipped_only': ~served & skipped,
+        'pending_only': (Token.status == 'PENDING') & ~(skip_count > 0),
+    }
+
+
+# Token columns the stored durations are derived from
+DURATION_FIELDS = ('created_at', 'served_at', 'skip_count', 'recovery_time', 'last_skipped_at', 'completed_at')
+
+
+def token_durations(values):
+    """
+    The durations stored with a token, in whole seconds:
+    waiting_seconds: creation to service, minus the time spent skipped
+    recovery_seconds: the recorded recovery time, or last skip to service
+    total_seconds: creation to completion
+    """
+    created_at, served_at = values['created_at'], values['served_at']
+
+    waiting = None
+    if created_at and served_at:
+        waiting = int(waited_seconds(created_at, served_at, values['skip_count'] or 0, values['recovery_time']))
+
+    recovery = values['recovery_time'] or None
+    if recovery is None and served_at and values['last_skipped_at']:
+        recovery = int(seconds_between(values['last_skipped_at'], served_at))
+
+    total = None
+    if created_at and values['completed_at']:
+        total = int(seconds_between(created_at, values['completed_at']))
+
+    return {'waiting_seconds': waiting, 'recovery_seconds': recovery, 'total_seconds': total}
+
+
+def duration_expressions(Token, dialect):
+    """token_durations as SQL expressions over the stored timestamps"""
+    def seconds(start, end):
+        return (epoch_ms(end) - epoch_ms(start)) / 1000.0
+
+    recovery = case(
+        (func.coalesce(Token.skip_count, 0) > 0, func.coalesce(Token.recovery_time, 0)),
+        else_=0
+    )
+    waiting = seconds(Token.created_at, Token.served_at) - recovery
+    return {
+        'waiting_seconds': case(
+            (Token.served_at.is_(None), None),
+            (waiting > 0, truncate(waiting, dialect)),
+            else_=0
+        ),
+        'recovery_seconds': case(
+            (func.coalesce(Token.recovery_time, 0) != 0, Token.recovery_time),
+            (Token.served_at.isnot(None) & Token.last_skipped_at.isnot(None),
+             truncate(seconds(Token.last_skipped_at, Token.served_at), dialect)),
+            else_=None
+        ),
+        'total_seconds': case(
+            (Token.completed_at.isnot(None), truncate(seconds(Token.created_at, Token.completed_at), dialect)),
+            else_=None
+        ),
+    }
+
+
+def durations_missing(Token):
+    """Rows written before the durations were stored"""
+    return or_(
+        Token.served_at.isnot(None) & Token.waiting_seconds.is_(None),
+        Token.served_at.isnot(None) & Token.last_skipped_at.isnot(None) & Token.recovery_seconds.is_(None),
+        (func.coalesce(Token.recovery_time, 0) != 0) & Token.recovery_seconds.is_(None),
+        Token.completed_at.isnot(None) & Token.total_seconds.is_(None),
+    )
+
+
+def backfill_durations(session, Token, only_missing=True):
+    """
+    Store the durations of existing rows with one UPDATE, only of the rows
+    that have none by default. Returns the number of rows updated.
+    """
+    dialect = session.get_bind().dialect.name
+    statement = update(Token).values(duration_expressions(Token, dialect))
+    if only_missing:
+        statement = statement.where(durations_missing(Token))
+    result = session.execute(statement.execution_options(synchronize_session=False))
+    return result.rowcount
+
+
+def waited_seconds(created_at, served_at, skip_count, recovery_time):
+    """Seconds from creation to service, minus the time spent skipped, never below zero"""
+    if not served_at:
+        return None
+
+    total_seconds = seconds_between(created_at, served_at)
+
+    if skip_count > 0 and recovery_time:
+        total_seconds -= recovery_time
+
+    return max(0, total_seconds)
+
+
+# Columns of the recovered tokens detail table
+RECOVERED_TOKEN_COLUMNS = (
+    'id', 'token_number', 'customer_name', 'created_at', 'skip_count', 'served_at', 'recovery_time'
+)
+
+
+def recovered_tokens(session, Token, start=None, end=None):
+    """
+    Tokens that were skipped and later served, for the detail table. Plain
+    dicts rather than Token objects, so they can be cached past the session.
+    """
+    rows = session.query(
+        *(getattr(Token, name) for name in RECOVERED_TOKEN_COLUMNS), Token.waiting_seconds
+    ).filter(
+        token_conditions(Token)['completed'],
+        func.coalesce(Token.skip_count, 0) > 0,
+        *created_between(Token.created_at, start, end)
+    ).order_by(Token.id)
+
+    tokens = []
+    for row in rows:
+        token = {name: getattr(row, name) for name in RECOVERED_TOKEN_COLUMNS}
+        # Minutes, as Token.waiting_time
+        token['waiting_time'] = row.waiting_seconds // 60 if row.waiting_seconds is not None else None
+        tokens.append(token)
+    return tokens
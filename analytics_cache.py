@@ -0,0 +1,81 @@
+# In-memory cache of analytics page results, per date range
+
+import threading
+from collections import OrderedDict
+
+
+class CacheEntry:
+    """The analytics context of one date range and its rendered pages"""
+
+    def __init__(self, version, context):
+        self.version = version
+        self.context = context
+        # Page variant (viewer, staff table, ...) -> HTML
+        self.pages = OrderedDict()
+
+
+class AnalyticsCache:
+    """
+    LRU cache of analytics results keyed by (start, end) service dates.
+
+    An entry is valid for the data version it was computed at. Local
+    commits drop the entries whose range covers a changed date and move
+    the others to the new version, so a change today leaves last month's
+    results cached. Any other version change (e.g. another worker's
+    commit) makes the entries miss.
+    """
+
+    def __init__(self, max_entries=32, max_pages=4):
+        self.max_entries = max_entries
+        self.max_pages = max_pages
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.version != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, context):
+        entry = CacheEntry(version, context)
+        if self.max_entries <= 0:
+            return entry
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def get_page(self, entry, variant):
+        with self.lock:
+            return entry.pages.get(variant)
+
+    def put_page(self, entry, variant, html):
+        with self.lock:
+            entry.pages[variant] = html
+            while len(entry.pages) > self.max_pages:
+                entry.pages.popitem(last=False)
+
+    def invalidate(self, dates, version=None):
+        """
+        Drop the entries covering any of the dates (all entries if dates
+        is None). The rest stay valid at version, if they were current.
+        """
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                start, end = key
+                if dates is None or any((start is None or start <= day) and (end is None or day <= end) for day in dates):
+                    del self.entries[key]
+                elif version is not None and entry.version == version - 1:
+                    entry.version = version
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,13 +1,29 @@
 # Main application file
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify, g, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 from flask_bcrypt import Bcrypt
-from datetime import datetime, timezone, timedelta
+from sqlalchemy import event
+from datetime import datetime, timezone
 import os
 import pandas as pd
-import io
 import json
+import threading
+from contextlib import contextmanager
+from queue_engine import QueueEngine, QueueEntry, queue_status_delta
+from analytics import (DATE_PRESETS, DURATION_FIELDS, DateRange, backfill_durations, durations_missing,
+                       resolve_date_range, token_durations)
+from frame_analytics import summary_sheets
+from rollups import (ROLLUP_FIELDS, add_token, apply_rollup_deltas, rebuild_rollups,
+                     rollup_analytics, rollup_inputs_changed, rollup_values)
+from staff_stats import employee_service_stats, rebuild_staff_stats, record_service, remove_service, staff_service_stats
+from analytics_cache import AnalyticsCache
+from exports import (RECOVERY_EXPORT_HEADER, TOKEN_EXPORT_HEADER, columnar_batches, columnar_supported, csv_chunks,
+                     frame_rows, recovery_rows, report_progress, select_tokens, token_rows, write_columnar,
+                     write_workbook)
+from export_jobs import ExportJobs
+from migrate_database import upgrade_database
+from timestamps import IST, EpochDateTime, local_naive, local_time, seconds_between
 
 app = Flask(__name__)
 
@@ -21,103 +37,229 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # Production flag
 app.config['PRODUCTION'] = os.environ.get('PRODUCTION', 'False').lower() == 'true'
 
-# IST timezone
-IST = timezone(timedelta(hours=5, minutes=30))
+# Queue changes within this window share one broadcast (0 = emit immediately)
+app.config['BROADCAST_COALESCE_MS'] = int(os.environ.get('BROADCAST_COALESCE_MS', '75'))
+app.config['DISPLAY_BROADCAST_COALESCE_MS'] = int(os.environ.get('DISPLAY_BROADCAST_COALESCE_MS', '250'))
+
+# Message queue shared by several workers, e.g. redis://127.0.0.1:6379/0 (unset = single worker)
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+
+# Date ranges whose analytics stay cached in memory (0 = no cache)
+app.config['ANALYTICS_CACHE_SIZE'] = int(os.environ.get('ANALYTICS_CACHE_SIZE', '32'))
+
+# Background exports: their files, worker threads, and how long and how much of them to keep
+app.config['EXPORT_DIR'] = os.environ.get('EXPORT_DIR', 'exports')
+app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', '2'))
+app.config['EXPORT_MAX_AGE_HOURS'] = float(os.environ.get('EXPORT_MAX_AGE_HOURS', '24'))
+app.config['EXPORT_MAX_MB'] = int(os.environ.get('EXPORT_MAX_MB', '500'))
 
 # Get IST time
 def get_ist_time():
     return datetime.now(timezone.utc).astimezone(IST)
 
 # Socket.IO init
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
 
 # Bcrypt init
 bcrypt = Bcrypt(app)
 
+# Socket.IO rooms: public displays and the two staff dashboards
+QUEUE_ROOMS = ('display', 'employee', 'admin')
+
+def resolve_queue_room(requested):
+    """Room a client may join; staff rooms need a staff session"""
+    if requested == 'admin' and is_admin():
+        return 'admin'
+    if requested == 'employee' and ('employee_id' in session or is_admin()):
+        return 'employee'
+    return 'display'
+
 # Socket events
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     print('Client connected')
+    room = resolve_queue_room((auth or {}).get('room'))
+    session['queue_room'] = room
+    join_room(room)
     # Send status to client
-    current_token = get_current_token()
-    next_token = get_next_token()
-    settings = get_settings()
+    emit('queue_status', get_queue_status(room))
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    print('Client disconnected')
 
-    # Get skipped tokens
-    skipped_tokens = Token.query.filter_by(status='SKIPPED').order_by(Token.last_skipped_at.desc()).limit(10).all()
+@socketio.on('request_queue_status')
+def handle_request_queue_status():
+    # Clients ask for a snapshot when they miss a delta
+    emit('queue_status', get_queue_status(session.get('queue_room', 'display')))
+
+# Queue status payload
+def build_queue_status(room='display'):
+    """
+    queue_status payload for a room.
+
+    Displays only get token numbers. Staff rooms also get token ids,
+    customer details and the full pending and skipped lists.
+    """
+    engine = get_queue_engine()
+    staff = room != 'display'
 
     # Convert to JSON
     current_token_data = None
+    current_token = engine.current_entry()
     if current_token:
         current_token_data = {
-            'token_number': current_token.token_number,
-            'customer_name': current_token.customer_name,
-            'visit_reason': current_token.visit_reason,
-            'recall_count': current_token.recall_count
+            'token_number': current_token.token_number
         }
+        if staff:
+            current_token_data.update({
+                'customer_name': current_token.customer_name,
+                'visit_reason': current_token.visit_reason,
+                'recall_count': current_token.recall_count
+            })
 
     next_token_data = None
+    next_token = engine.next_entry()
     if next_token:
         next_token_data = {
             'token_number': next_token.token_number
         }
+        if staff:
+            next_token_data['id'] = next_token.id
 
+    # Staff dashboards list every skipped token, displays the latest ten
     skipped_tokens_data = []
-    for token in skipped_tokens:
-        skipped_tokens_data.append({
+    for token in engine.skipped(None if staff else 10):
+        skipped_data = {
             'token_number': token.token_number,
             'skipped_at': token.last_skipped_at.strftime('%H:%M:%S') if token.last_skipped_at else None
-        })
-
-    emit('queue_status', {
+        }
+        if staff:
+            skipped_data.update({
+                'id': token.id,
+                'customer_name': token.customer_name
+            })
+        skipped_tokens_data.append(skipped_data)
+
+    status = {
+        'version': engine.version,
         'current_token': current_token_data,
         'next_token': next_token_data,
-        'queue_active': settings.queue_active,
+        'queue_active': engine.queue_active,
         'skipped_tokens': skipped_tokens_data
-    })
+    }
 
-@socketio.on('disconnect')
-def handle_disconnect():
-    print('Client disconnected')
+    if staff:
+        status['pending_tokens'] = [{
+            'id': token.id,
+            'token_number': token.token_number,
+            'customer_name': token.customer_name,
+            'visit_reason': token.visit_reason
+        } for token in engine.pending()]
+
+    return status
+
+# Cached snapshot per room: room -> (queue version, payload)
+queue_status_cache = {}
+
+def get_queue_status(room='display'):
+    """
+    queue_status payload for a room, rebuilt only when the queue changes.
+
+    A reconnect storm after a network blip is served from one cached
+    snapshot instead of one set of queries per client. A room keeps its
+    previous version while its payload is unchanged, so displays are not
+    sent empty deltas for changes only staff can see. The payload is
+    shared, so callers must not modify it.
+    """
+    engine = get_queue_engine()
+    entry = queue_status_cache.get(room)
+    if entry is not None and entry[0] == engine.version:
+        return entry[1]
+
+    status = build_queue_status(room)
+    version = status['version']
+    if entry is not None and queue_status_delta(entry[1], status) == {}:
+        status = entry[1]
+    queue_status_cache[room] = (version, status)
+    return status
+
+def invalidate_queue_status():
+    # Keep the payloads so unchanged rooms can reuse their version
+    for room, entry in list(queue_status_cache.items()):
+        queue_status_cache[room] = (None, entry[1])
+
+# Last broadcast snapshot per room, the base for the next delta
+last_broadcast = {}
+broadcast_lock = threading.Lock()
+
+# Rooms with a scheduled broadcast
+broadcast_schedule = set()
+broadcast_schedule_lock = threading.Lock()
+
+def broadcast_window(room):
+    """Coalescing window for a room in seconds"""
+    if room == 'display':
+        return app.config['DISPLAY_BROADCAST_COALESCE_MS'] / 1000
+    return app.config['BROADCAST_COALESCE_MS'] / 1000
 
 # Broadcast updates
 def broadcast_token_update():
-    current_token = get_current_token()
-    next_token = get_next_token()
-    settings = get_settings()
+    """
+    Schedule a queue broadcast to every room.
 
-    # Get skipped tokens
-    skipped_tokens = Token.query.filter_by(status='SKIPPED').order_by(Token.last_skipped_at.desc()).limit(10).all()
+    Each emit runs as a Socket.IO background task after the room's
+    coalescing window, so the request returns straight away and a burst
+    of staff actions produces a single emit of the latest state.
+    """
+    for room in QUEUE_ROOMS:
+        window = broadcast_window(room)
+        if window <= 0:
+            emit_queue_update(room)
+            continue
 
-    # Convert to JSON
-    current_token_data = None
-    if current_token:
-        current_token_data = {
-            'token_number': current_token.token_number,
-            'customer_name': current_token.customer_name,
-            'visit_reason': current_token.visit_reason,
-            'recall_count': current_token.recall_count
-        }
+        with broadcast_schedule_lock:
+            if room in broadcast_schedule:
+                continue
+            broadcast_schedule.add(room)
 
-    next_token_data = None
-    if next_token:
-        next_token_data = {
-            'token_number': next_token.token_number
-        }
+        socketio.start_background_task(run_coalesced_broadcast, room, window)
 
-    skipped_tokens_data = []
-    for token in skipped_tokens:
-        skipped_tokens_data.append({
-            'token_number': token.token_number,
-            'skipped_at': token.last_skipped_at.strftime('%H:%M:%S') if token.last_skipped_at else None
-        })
+def run_coalesced_broadcast(room, window):
+    socketio.sleep(window)
 
-    socketio.emit('queue_status', {
-        'current_token': current_token_data,
-        'next_token': next_token_data,
-        'queue_active': settings.queue_active,
-        'skipped_tokens': skipped_tokens_data
-    })
+    # Changes committed from here on schedule a new broadcast
+    with broadcast_schedule_lock:
+        broadcast_schedule.discard(room)
+
+    try:
+        with app.app_context():
+            emit_queue_update(room)
+    except Exception as e:
+        print(f'Error broadcasting queue update: {str(e)}')
+
+def emit_queue_update(room):
+    with broadcast_lock:
+        status = get_queue_status(room)
+        previous = last_broadcast.get(room)
+
+        if previous is not None:
+            changes = queue_status_delta(previous, status)
+            if not changes and status['version'] == previous['version']:
+                return
+
+        if previous is None or app.config['SOCKETIO_MESSAGE_QUEUE']:
+            # Deltas need a single base; with several workers broadcasting, send snapshots
+            socketio.emit('queue_status', status, to=room)
+        else:
+            # Clients apply the delta only if they are at base_version
+            socketio.emit('queue_delta', {
+                'version': status['version'],
+                'base_version': previous['version'],
+                'changes': changes
+            }, to=room)
+
+        last_broadcast[room] = status
 
 # Context processors
 @app.context_processor
@@ -138,6 +280,18 @@ db = SQLAlchemy(app)
 # Token model
 class Token(db.Model):
     __tablename__ = 'tokens'
+    __table_args__ = (
+        # Pending queue and next-token lookups
+        db.Index('ix_tokens_status_id', 'status', 'id'),
+        # Skipped list ordered by skip time
+        db.Index('ix_tokens_status_last_skipped_at', 'status', 'last_skipped_at'),
+        # Employee dashboard served history
+        db.Index('ix_tokens_staff_status_served_at', 'staff_id', 'status', 'served_at'),
+        # Analytics by creation time
+        db.Index('ix_tokens_created_at', 'created_at'),
+        # Incremental exports, and stamping a commit's changes
+        db.Index('ix_tokens_change_version_id', 'change_version', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     token_number = db.Column(db.String(10), nullable=False)
     visit_reason = db.Column(db.String(50), nullable=False)
@@ -145,71 +299,53 @@ class Token(db.Model):
     phone_number = db.Column(db.String(20))
     customer_name = db.Column(db.String(100))
     status = db.Column(db.String(20), default='PENDING')
-    created_at = db.Column(db.DateTime, default=get_ist_time)
+    created_at = db.Column(EpochDateTime, default=get_ist_time)
     # Recall tracking
     recall_count = db.Column(db.Integer, default=0)
-    last_recalled_at = db.Column(db.DateTime, nullable=True)
+    last_recalled_at = db.Column(EpochDateTime, nullable=True)
     # Service time
-    served_at = db.Column(db.DateTime, nullable=True)
+    served_at = db.Column(EpochDateTime, nullable=True)
     service_duration = db.Column(db.Integer, nullable=True)
     # Analytics fields
     skip_count = db.Column(db.Integer, default=0)
-    last_skipped_at = db.Column(db.DateTime, nullable=True)
-    completed_at = db.Column(db.DateTime, nullable=True)
+    last_skipped_at = db.Column(EpochDateTime, nullable=True)
+    completed_at = db.Column(EpochDateTime, nullable=True)
     resolution_outcome = db.Column(db.String(50), nullable=True)
     staff_id = db.Column(db.String(50), nullable=True)
     complexity_level = db.Column(db.Integer, nullable=True)
     customer_feedback = db.Column(db.Integer, nullable=True)
     recovery_time = db.Column(db.Integer, nullable=True)
     previous_status = db.Column(db.String(20), nullable=True)
+    # Durations in seconds, stored when the token is served, recovered or completed
+    waiting_seconds = db.Column(db.Integer, nullable=True)
+    recovery_seconds = db.Column(db.Integer, nullable=True)
+    total_seconds = db.Column(db.Integer, nullable=True)
+    # Queue version of the commit that last inserted or updated the token.
+    # Every write clears it and the commit stamps it (see bump_queue_version).
+    change_version = db.Column(db.Integer, nullable=True, onupdate=db.null())
 
 
     @property
     def waiting_time(self):
         """Calculate waiting time in minutes from creation to being served, excluding time spent in SKIPPED state"""
-        if not self.served_at:
+        if self.waiting_seconds is None:
             return None
-
-        if self.created_at.tzinfo is None and self.served_at.tzinfo is not None:
-            served_at_naive = self.served_at.replace(tzinfo=None)
-            delta = served_at_naive - self.created_at
-        elif self.created_at.tzinfo is not None and self.served_at.tzinfo is None:
-            created_at_naive = self.created_at.replace(tzinfo=None)
-            delta = self.served_at - created_at_naive
-        else:
-            delta = self.served_at - self.created_at
-
-        total_seconds = delta.total_seconds()
-
-        if self.skip_count > 0 and self.recovery_time:
-            total_seconds -= self.recovery_time
-
-        return max(0, int(total_seconds / 60))
+        return self.waiting_seconds // 60
 
     @property
     def total_service_time(self):
         """Calculate total time from creation to completion in minutes"""
-        if not self.completed_at:
+        if self.total_seconds is None:
             return None
-
-        if self.created_at.tzinfo is None and self.completed_at.tzinfo is not None:
-            completed_at_naive = self.completed_at.replace(tzinfo=None)
-            delta = completed_at_naive - self.created_at
-        elif self.created_at.tzinfo is not None and self.completed_at.tzinfo is None:
-            created_at_naive = self.created_at.replace(tzinfo=None)
-            delta = self.completed_at - created_at_naive
-        else:
-            delta = self.completed_at - self.created_at
-
-        return int(delta.total_seconds() / 60)
+        return int(self.total_seconds / 60)
 
     @property
     def day_of_week(self):
-        return self.created_at.strftime('%A')
+        return local_time(self.created_at).strftime('%A')
 
     @property
     def hour_of_day(self):
-        return self.created_at.hour
+        return local_time(self.created_at).hour
 
 # Settings model
 class Settings(db.Model):
@@ -218,6 +354,8 @@ class Settings(db.Model):
     current_token_id = db.Column(db.Integer, default=0)
     last_token_number = db.Column(db.Integer, default=0)
     use_thermal_printer = db.Column(db.Boolean, default=True)
+    # Bumped by every committed queue change
+    queue_version = db.Column(db.Integer, default=0)
 
 # Reason model
 class Reason(db.Model):
@@ -226,8 +364,8 @@ class Reason(db.Model):
     code = db.Column(db.String(20), nullable=False, unique=True)
     description = db.Column(db.String(100), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=get_ist_time)
-    updated_at = db.Column(db.DateTime, default=get_ist_time, onupdate=get_ist_time)
+    created_at = db.Column(EpochDateTime, default=get_ist_time)
+    updated_at = db.Column(EpochDateTime, default=get_ist_time, onupdate=get_ist_time)
 
 # Employee model
 class Employee(db.Model):
@@ -238,8 +376,8 @@ class Employee(db.Model):
     role = db.Column(db.String(50))
     password = db.Column(db.String(100), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=get_ist_time)
-    last_login = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(EpochDateTime, default=get_ist_time)
+    last_login = db.Column(EpochDateTime, nullable=True)
     is_on_duty = db.Column(db.Boolean, default=False)
 
     # Set password
@@ -250,9 +388,22 @@ class Employee(db.Model):
     def check_password(self, password):
         return bcrypt.check_password_hash(self.password, password)
 
-    # Stats
+    # Stats, updated in SQL by record_service (staff_stats.py)
     tokens_served = db.Column(db.Integer, default=0)
+    # Running mean and squared deviations (Welford) of the service time in minutes
+    service_count = db.Column(db.Integer, default=0)
     avg_service_time = db.Column(db.Float, default=0.0)
+    service_m2 = db.Column(db.Float, default=0.0)
+
+# Served tokens and service time stats (seconds) per employee and service date
+class StaffDailyStats(db.Model):
+    __tablename__ = 'staff_daily_stats'
+    employee_id = db.Column(db.Integer, primary_key=True)
+    service_date = db.Column(db.Date, primary_key=True)
+    served_count = db.Column(db.Integer, nullable=False, default=0)
+    service_count = db.Column(db.Integer, nullable=False, default=0)
+    service_mean = db.Column(db.Float, nullable=False, default=0.0)
+    service_m2 = db.Column(db.Float, nullable=False, default=0.0)
 
 # Status change model
 class TokenStatusChange(db.Model):
@@ -261,17 +412,360 @@ class TokenStatusChange(db.Model):
     token_id = db.Column(db.Integer, nullable=False)
     old_status = db.Column(db.String(20), nullable=False)
     new_status = db.Column(db.String(20), nullable=False)
-    changed_at = db.Column(db.DateTime, default=get_ist_time)
+    changed_at = db.Column(EpochDateTime, default=get_ist_time)
     changed_by = db.Column(db.String(50), nullable=True)
 
+# Analytics rollups, kept in step with the tokens in the same transaction
+class RollupMetrics:
+    token_count = db.Column(db.Integer, nullable=False, default=0)
+    served_count = db.Column(db.Integer, nullable=False, default=0)
+    # Served with a recorded served_at
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+    skipped_count = db.Column(db.Integer, nullable=False, default=0)
+    skipped_only_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_only_count = db.Column(db.Integer, nullable=False, default=0)
+    recovered_count = db.Column(db.Integer, nullable=False, default=0)
+    waiting_minutes = db.Column(db.Integer, nullable=False, default=0)
+    service_seconds = db.Column(db.Integer, nullable=False, default=0)
+    completed_service_seconds = db.Column(db.Integer, nullable=False, default=0)
+    recall_count = db.Column(db.Integer, nullable=False, default=0)
+    skip_count = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyRollup(RollupMetrics, db.Model):
+    __tablename__ = 'rollup_daily'
+    key_columns = ('service_date',)
+    service_date = db.Column(db.Date, primary_key=True)
+
+class HourlyRollup(RollupMetrics, db.Model):
+    __tablename__ = 'rollup_hourly'
+    key_columns = ('service_date', 'hour')
+    service_date = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)
+
+class ReasonRollup(RollupMetrics, db.Model):
+    __tablename__ = 'rollup_reasons'
+    key_columns = ('service_date', 'visit_reason')
+    service_date = db.Column(db.Date, primary_key=True)
+    visit_reason = db.Column(db.String(50), primary_key=True)
+
+class StaffRollup(RollupMetrics, db.Model):
+    __tablename__ = 'rollup_staff'
+    key_columns = ('service_date', 'staff_id')
+    service_date = db.Column(db.Date, primary_key=True)
+    # Empty for tokens nobody served
+    staff_id = db.Column(db.String(50), primary_key=True)
+
+# Waiting/service time quantile sketches of served tokens, per day and group
+class SketchRollup(db.Model):
+    __tablename__ = 'rollup_sketches'
+    key_columns = ('service_date', 'dimension', 'group_key', 'metric')
+    service_date = db.Column(db.Date, primary_key=True)
+    # 'reason', 'hour' or 'staff'
+    dimension = db.Column(db.String(10), primary_key=True)
+    group_key = db.Column(db.String(50), primary_key=True)
+    # 'waiting' or 'service'
+    metric = db.Column(db.String(10), primary_key=True)
+    value_count = db.Column(db.Integer, nullable=False, default=0)
+    # JSON {bucket: count}, see sketches.py
+    buckets = db.Column(db.Text, nullable=False, default='{}')
+
+rollup_models = {
+    'daily': DailyRollup,
+    'hourly': HourlyRollup,
+    'reason': ReasonRollup,
+    'staff': StaffRollup,
+    'sketch': SketchRollup,
+}
+
+# Analytics page results per date range
+analytics_cache = AnalyticsCache(app.config['ANALYTICS_CACHE_SIZE'])
+
+# Queue engine
+queue_engine = QueueEngine()
+
+def queue_entry(token):
+    return QueueEntry(
+        token.id,
+        token.token_number,
+        customer_name=token.customer_name,
+        visit_reason=token.visit_reason,
+        recall_count=token.recall_count,
+        status=token.status,
+        last_skipped_at=token.last_skipped_at
+    )
+
+def load_queue_engine():
+    """Load the live queue from the tokens table"""
+    settings = get_settings()
+    current_id = settings.current_token_id if settings else 0
+    rows = db.session.query(
+        Token.id, Token.token_number, Token.customer_name, Token.visit_reason,
+        Token.recall_count, Token.status, Token.last_skipped_at
+    ).filter(db.or_(Token.status.in_(('PENDING', 'SKIPPED')), Token.id == current_id)).all()
+
+    queue_engine.load([QueueEntry(*row) for row in rows],
+                      current_id,
+                      settings.queue_active if settings else True,
+                      version=(settings.queue_version or 0) if settings else 0)
+
+# One load at a time, so concurrent requests share it
+queue_load_lock = threading.Lock()
+
+def stored_queue_version():
+    return db.session.query(Settings.queue_version).order_by(Settings.id).limit(1).scalar() or 0
+
+def sync_queue_engine():
+    """
+    Reload the engine if another worker committed queue changes.
+
+    Each worker keeps its own engine, so with several workers the stored
+    queue version is compared once per request (a primary key read).
+    """
+    if g.get('queue_engine_synced'):
+        return
+    g.queue_engine_synced = True
+
+    if stored_queue_version() != queue_engine.version:
+        queue_engine.invalidate()
+        invalidate_queue_status()
+
+def get_queue_engine():
+    if queue_engine.loaded and app.config['SOCKETIO_MESSAGE_QUEUE']:
+        sync_queue_engine()
+    if not queue_engine.loaded:
+        with queue_load_lock:
+            if not queue_engine.loaded:
+                load_queue_engine()
+    if queue_engine.needs_current():
+        token = db.session.get(Token, queue_engine.current_id)
+        if token:
+            queue_engine.track(queue_entry(token))
+        else:
+            queue_engine.track_missing(queue_engine.current_id)
+    return queue_engine
+
+def increment_settings(column, session=None):
+    """
+    Atomically increment a Settings counter and return the new value.
+
+    The increment happens inside the database, so concurrent requests and
+    gunicorn workers never read the same value. The row stays locked until
+    the surrounding transaction commits.
+    """
+    session = session or db.session
+    settings_id = db.select(db.func.min(Settings.id)).scalar_subquery()
+    statement = db.update(Settings).where(Settings.id == settings_id).values(
+        {column: column + 1}
+    ).execution_options(queue_reload=False)
+
+    if db.engine.dialect.update_returning:
+        return session.execute(statement.returning(column)).scalar()
+
+    # The write lock taken by the UPDATE keeps this read consistent
+    session.execute(statement)
+    return session.execute(db.select(column).where(Settings.id == settings_id)).scalar()
+
+# Keep the engine in sync with committed changes
+@event.listens_for(db.session, 'after_flush')
+def track_queue_changes(session, flush_context):
+    changes = session.info.setdefault('queue_changes', [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Settings):
+            changes.append(('settings', obj.current_token_id, obj.queue_active))
+        elif isinstance(obj, Token):
+            changes.append(('token', queue_entry(obj)))
+    for obj in session.deleted:
+        if isinstance(obj, Settings):
+            session.info['queue_reload'] = True
+        elif isinstance(obj, Token):
+            changes.append(('delete', obj.id))
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_queue_changes(orm_execute_state):
+    # Bulk UPDATE/DELETE bypasses the flush, so reload after commit
+    if not orm_execute_state.execution_options.get('queue_reload', True):
+        return
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in (Token, Settings):
+            orm_execute_state.session.info['queue_reload'] = True
+
+@event.listens_for(db.session, 'before_commit')
+def bump_queue_version(session):
+    # Every committed queue change gets a new version
+    session.flush()
+    changes = session.info.get('queue_changes')
+    if changes or session.info.get('queue_reload'):
+        version = increment_settings(Settings.queue_version, session)
+        session.info['queue_version'] = version
+
+        # Stamp the tokens written in this transaction. The Settings row stays
+        # locked until commit, so versions are committed in order and make a
+        # watermark for incremental exports.
+        tokens_changed = session.info.get('queue_reload') or any(change[0] != 'settings' for change in changes)
+        if version is not None and tokens_changed:
+            session.execute(
+                db.update(Token).where(Token.change_version.is_(None)).values(change_version=version)
+                .execution_options(synchronize_session=False, queue_reload=False, rollup_rebuild=False)
+            )
+
+@event.listens_for(db.session, 'after_commit')
+def apply_queue_changes(session):
+    changes = session.info.pop('queue_changes', None)
+    version = session.info.pop('queue_version', None)
+    if session.info.pop('queue_reload', False):
+        queue_engine.invalidate()
+        invalidate_queue_status()
+    elif changes:
+        queue_engine.apply(changes, version)
+        invalidate_queue_status()
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_queue_changes(session):
+    session.info.pop('queue_changes', None)
+    session.info.pop('queue_version', None)
+    session.info.pop('queue_reload', None)
+
+# Keep the analytics rollups in step with the tokens
+def load_previous_value(target, value, oldvalue, initiator):
+    pass
+
+@event.listens_for(db.session, 'before_flush')
+def store_token_durations(session, flush_context, instances):
+    # Runs before the rollup listeners, which read the stored waiting seconds
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Token):
+            state = db.inspect(obj)
+            if state.pending or any(state.attrs[name].history.has_changes() for name in DURATION_FIELDS):
+                for name, value in token_durations({name: getattr(obj, name) for name in DURATION_FIELDS}).items():
+                    if getattr(obj, name) != value:
+                        setattr(obj, name, value)
+
+for name in ROLLUP_FIELDS:
+    # Load the replaced value, so the flush can take it out of the rollups
+    event.listen(getattr(Token, name), 'set', load_previous_value, active_history=True)
+
+@event.listens_for(db.session, 'before_flush')
+def remove_previous_rollup_values(session, flush_context, instances):
+    deltas = session.info.setdefault('rollup_deltas', {})
+    for obj in session.deleted:
+        if isinstance(obj, Token):
+            add_token(deltas, rollup_values(obj, previous=True), sign=-1)
+    for obj in session.dirty:
+        if isinstance(obj, Token) and rollup_inputs_changed(obj):
+            add_token(deltas, rollup_values(obj, previous=True), sign=-1)
+
+@event.listens_for(db.session, 'after_flush')
+def add_new_rollup_values(session, flush_context):
+    deltas = session.info.setdefault('rollup_deltas', {})
+    for obj in session.new:
+        if isinstance(obj, Token):
+            add_token(deltas, rollup_values(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Token) and rollup_inputs_changed(obj):
+            add_token(deltas, rollup_values(obj))
+
+@event.listens_for(db.session, 'after_flush')
+def track_analytics_dates(session, flush_context):
+    # Service dates whose cached analytics the change makes stale
+    dates = session.info.setdefault('analytics_dates', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Token):
+            created = db.inspect(obj).attrs.created_at.history.sum()
+            if not created:
+                session.info['analytics_all_dates'] = True
+            dates.update(local_time(value).date() for value in created if value is not None)
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_rollup_changes(orm_execute_state):
+    # Bulk UPDATE/DELETE bypasses the flush, so rebuild before commit
+    if not orm_execute_state.execution_options.get('rollup_rebuild', True):
+        return
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ is Token:
+            orm_execute_state.session.info['rollup_rebuild'] = True
+
+@event.listens_for(db.session, 'before_commit')
+def apply_rollup_changes(session):
+    session.flush()
+    deltas = session.info.pop('rollup_deltas', None)
+    if session.info.pop('rollup_rebuild', False):
+        rebuild_rollups(session, Token, rollup_models)
+        session.info['analytics_all_dates'] = True
+    elif deltas:
+        apply_rollup_deltas(session, rollup_models, deltas)
+
+    dates = session.info.pop('analytics_dates', set())
+    if session.info.pop('analytics_all_dates', False):
+        dates = None
+    session.info['analytics_changes'] = (dates, session.info.get('queue_version'))
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_analytics_cache(session):
+    changes = session.info.pop('analytics_changes', None)
+    if changes:
+        analytics_cache.invalidate(*changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_rollup_changes(session):
+    for key in ('rollup_deltas', 'rollup_rebuild', 'analytics_dates', 'analytics_all_dates', 'analytics_changes'):
+        session.info.pop(key, None)
+
+@event.listens_for(db.metadata, 'after_create')
+@event.listens_for(db.metadata, 'after_drop')
+def reset_queue_engine(target, connection, **kw):
+    queue_engine.invalidate()
+    invalidate_queue_status()
+    analytics_cache.clear()
+
 # Init database
 with app.app_context():
     db.create_all()
+
+    # Apply schema migrations
+    changes = upgrade_database(db)
+    for change in changes:
+        print(f'Migration: {change}')
+
+    # Store the durations of tokens written before they were stored
+    if Token.query.filter(durations_missing(Token)).first():
+        count = backfill_durations(db.session, Token)
+        db.session.commit()
+        print(f'Migration: Stored durations of {count} tokens')
+
+    # Fill the rollups of a database created before they existed, or
+    # whose timestamps were just converted
+    converted = any(change.startswith('Converted timestamps') for change in changes)
+    served = Token.query.filter(Token.status == 'SERVED', Token.served_at.isnot(None)).first()
+    if converted or (Token.query.first() and not DailyRollup.query.first()) or \
+            (served and not SketchRollup.query.first()):
+        rebuild_rollups(db.session, Token, rollup_models)
+        db.session.commit()
+        print('Migration: Rebuilt analytics rollups')
+
+    # Fill the staff stats of a database created before they existed
+    if converted or (Token.query.filter(Token.status == 'SERVED', Token.staff_id.isnot(None)).first()
+                     and not StaffDailyStats.query.first()):
+        rebuild_staff_stats(db.session, Token, Employee, StaffDailyStats)
+        db.session.commit()
+        print('Migration: Rebuilt staff statistics')
+
     # Init settings
     if not Settings.query.first():
         db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
         db.session.commit()
 
+    # Tokens written before change versions existed belong to every full export
+    if Token.query.filter(Token.change_version.is_(None)).first():
+        count = db.session.execute(
+            db.update(Token).where(Token.change_version.is_(None)).values(change_version=0)
+            .execution_options(synchronize_session=False, queue_reload=False, rollup_rebuild=False)
+        ).rowcount
+        db.session.commit()
+        print(f'Migration: Set change version of {count} tokens')
+
     # Init reasons
     if not Reason.query.first():
         default_reasons = [
@@ -293,34 +787,71 @@ def get_active_reasons():
     return Reason.query.filter_by(is_active=True).order_by(Reason.code).all()
 
 def get_current_token():
-    settings = get_settings()
-    if settings.current_token_id == 0:
+    current_id = get_queue_engine().current_id
+    if not current_id:
         return None
-    return Token.query.get(settings.current_token_id)
+    return db.session.get(Token, current_id)
 
 def get_next_token():
-    current_token = get_current_token()
-    if not current_token:
-        # If there's no current token, return the first pending token
-        next_token = Token.query.filter_by(status='PENDING').order_by(Token.id).first()
-    else:
-        # First try to get the next token with a higher ID
-        next_token = Token.query.filter(Token.id > current_token.id, Token.status == 'PENDING').order_by(Token.id).first()
-
-        # If there's no pending token with a higher ID (e.g., when serving the last token first),
-        # get the first pending token with a lower ID
-        if not next_token:
-            next_token = Token.query.filter(Token.id < current_token.id, Token.status == 'PENDING').order_by(Token.id).first()
+    next_id = get_queue_engine().next_id()
+    if not next_id:
+        return None
+    return db.session.get(Token, next_id)
 
-    return next_token
+def get_skipped_tokens(limit=10):
+    """Most recently skipped tokens, served from the queue engine"""
+    return get_queue_engine().skipped(limit)
 
 def generate_token_number():
-    settings = get_settings()
-    new_token_number = settings.last_token_number + 1
-    settings.last_token_number = new_token_number
-    db.session.commit()
+    # Committed together with the new token
+    new_token_number = increment_settings(Settings.last_token_number)
     return f"T{new_token_number:03d}"
 
+# Queue transitions
+@contextmanager
+def queue_transition():
+    """Run one staff or kiosk action as a single transaction"""
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def get_actor():
+    if 'employee_id' in session:
+        return str(session['employee_id'])
+    if session.get('is_admin', False):
+        return 'admin'
+    return None
+
+def change_token_status(token, new_status):
+    """Change a token status and add the audit row to the transaction"""
+    old_status = token.status or 'PENDING'
+    token.status = new_status
+    db.session.add(TokenStatusChange(
+        token_id=token.id,
+        old_status=old_status,
+        new_status=new_status,
+        changed_by=get_actor()
+    ))
+
+def record_recovery_time(token):
+    """Store the seconds a skipped token waited before being recovered"""
+    if not token.last_skipped_at:
+        return
+
+    token.recovery_time = int(seconds_between(token.last_skipped_at, get_ist_time()))
+
+def mark_token_served(token):
+    """Mark a token as served and record its service duration"""
+    change_token_status(token, 'SERVED')
+    token.served_at = get_ist_time()
+
+    # Calculate service duration in seconds
+    if token.created_at:
+        token.service_duration = int(seconds_between(token.created_at, token.served_at))
+
 # Auth check
 def is_admin():
     # Check admin flag
@@ -334,13 +865,228 @@ def is_admin():
 
     return False
 
+def is_staff():
+    return is_admin() or 'employee_id' in session
+
+def staff_redirect():
+    # Redirect based on user type
+    if is_admin():
+        return redirect(url_for('admin'))
+    else:
+        return redirect(url_for('employee_dashboard'))
+
+def flash_messages(messages):
+    for category, message in messages:
+        flash(message, category)
+
+def credited_employee(token):
+    """The employee a served token counts for: its staff_id, as rebuild_staff_stats credits it"""
+    if token.staff_id is None or not str(token.staff_id).isdigit():
+        return None
+    return db.session.get(Employee, int(token.staff_id))
+
+def record_employee_service(token):
+    """Credit a served token to the logged in employee, else to its staff_id (who skipped it)"""
+    if 'employee_id' in session:
+        token.staff_id = str(session['employee_id'])
+
+    # Update employee statistics with atomic SQL updates
+    employee = credited_employee(token)
+    if employee:
+        record_service(db.session, Employee, StaffDailyStats, employee.id, token)
+
+def remove_employee_service(token):
+    """Take back the credit of a served token that goes back to the queue"""
+    employee = credited_employee(token)
+    if employee:
+        remove_service(db.session, Employee, StaffDailyStats, employee.id, token)
+
+def staff_performance(staff_members, date_range):
+    """Served tokens and service time stats per employee id for the date range"""
+    if date_range.start is None and date_range.end is None:
+        return {staff.id: employee_service_stats(staff) for staff in staff_members}
+    return staff_service_stats(db.session, StaffDailyStats, date_range.start, date_range.end)
+
+def analytics_model(date_range, staff_members):
+    """
+    The analytics of a date range, shared by the analytics page and the
+    Excel export. Read from the rollups, unless the range is cached for the
+    current data version. Returns the cache entry; its context is the model.
+    """
+    version = stored_queue_version()
+    cache_key = (date_range.start, date_range.end)
+    entry = analytics_cache.get(cache_key, version)
+    if entry is None:
+        context = rollup_analytics(db.session, Token, rollup_models, date_range.start, date_range.end)
+        context['staff_performance'] = staff_performance(staff_members, date_range)
+        entry = analytics_cache.put(cache_key, version, context)
+    return entry
+
+def requested_date_range():
+    """The analytics date range in the request arguments, all dates if unset"""
+    try:
+        return resolve_date_range(request.args, get_ist_time().date())
+    except ValueError:
+        flash('Invalid date range, showing all dates', 'error')
+        return DateRange(None, None, 'all')
+
+# Staff queue actions, shared by the page routes and the JSON API.
+# Each runs one transition and returns its messages as (category, message).
+def queue_next_token():
+    next_token = get_next_token()
+    if not next_token:
+        return [('info', 'No more pending tokens in queue')]
+
+    with queue_transition():
+        current_token = get_current_token()
+        if current_token:
+            mark_token_served(current_token)
+
+            # Record employee
+            record_employee_service(current_token)
+
+        get_settings().current_token_id = next_token.id
+
+    # Broadcast update
+    broadcast_token_update()
+    return [('success', f'Now serving token {next_token.token_number}')]
+
+def queue_recall_token():
+    current_token = get_current_token()
+    if not current_token:
+        return [('error', 'No active token to recall')]
+
+    # Update recall count
+    with queue_transition():
+        current_token.recall_count = (current_token.recall_count or 0) + 1
+
+        # Update recall time
+        current_token.last_recalled_at = get_ist_time()
+
+    # Broadcast update
+    broadcast_token_update()
+    return [('warning', f'Recalling token {current_token.token_number} (Recall #{current_token.recall_count})')]
+
+def queue_mark_as_served():
+    current_token = get_current_token()
+    if not current_token:
+        return [('error', 'No active token to mark as served')]
+
+    with queue_transition():
+        # Mark the current token as SERVED
+        mark_token_served(current_token)
+
+        # Record which employee served this token
+        record_employee_service(current_token)
+
+        # Clear the current token
+        get_settings().current_token_id = 0
+
+    # Broadcast token update to all connected clients
+    broadcast_token_update()
+    return [('success', f'Token {current_token.token_number} has been marked as served')]
+
+def queue_skip_token():
+    current_token = get_current_token()
+    if not current_token:
+        return [('error', 'No active token to skip')]
+
+    # Find next token
+    next_token = get_next_token()
+
+    with queue_transition():
+        # Mark as skipped
+        change_token_status(current_token, 'SKIPPED')
+
+        # Store previous status
+        current_token.previous_status = 'PENDING' if not current_token.previous_status else current_token.status
+
+        # Update skip info
+        current_token.skip_count += 1
+        current_token.last_skipped_at = get_ist_time()
+
+        # Record employee
+        if 'employee_id' in session:
+            employee_id = session['employee_id']
+
+            if not current_token.staff_id:
+                current_token.staff_id = str(employee_id)
+
+        # Move on to the next token
+        get_settings().current_token_id = next_token.id if next_token else 0
+
+    # Broadcast update
+    broadcast_token_update()
+    return [('warning', f'Token {current_token.token_number} has been skipped')]
+
+def queue_serve_token(token_id):
+    token = Token.query.get_or_404(token_id)
+
+    # Check token status
+    if token.status != 'PENDING' and token.status != 'SKIPPED':
+        return [('error', f'Only pending or skipped tokens can be served. Token {token.token_number} is {token.status}')]
+
+    messages = []
+    with queue_transition():
+        # Handle skipped tokens
+        if token.status == 'SKIPPED':
+            record_recovery_time(token)
+
+            # The SKIPPED -> SERVED audit row is written by mark_token_served
+            messages.append(('info', f'Serving previously skipped token {token.token_number}. Token was skipped {token.skip_count} times.'))
+
+        # Mark current token as served
+        settings = get_settings()
+        current_token = get_current_token()
+        if current_token:
+            mark_token_served(current_token)
+
+            # Record employee
+            record_employee_service(current_token)
+
+        # Set current token
+        settings.current_token_id = token.id
+
+    # Broadcast update
+    broadcast_token_update()
+    messages.append(('success', f'Now serving token {token.token_number}'))
+    return messages
+
+def queue_recover_token(token_id):
+    token = Token.query.get_or_404(token_id)
+
+    # Check token status
+    if token.status != 'SKIPPED':
+        return [('error', f'Only skipped tokens can be recovered. Token {token.token_number} is {token.status}')]
+
+    with queue_transition():
+        # Calculate recovery time
+        record_recovery_time(token)
+
+        # Reset status
+        change_token_status(token, 'PENDING')
+
+    # Broadcast token update to all connected clients
+    broadcast_token_update()
+    return [('success', f'Token {token.token_number} has been recovered and is now back in the pending queue')]
+
+# JSON API name -> (action, takes a token id)
+QUEUE_ACTIONS = {
+    'next': (queue_next_token, False),
+    'recall': (queue_recall_token, False),
+    'mark-served': (queue_mark_as_served, False),
+    'skip': (queue_skip_token, False),
+    'serve': (queue_serve_token, True),
+    'recover': (queue_recover_token, True),
+}
+
 # Routes
 @app.route('/')
 def index():
     settings = get_settings()
     current_token = get_current_token()
     next_token = get_next_token()
-    skipped_tokens = Token.query.filter_by(status='SKIPPED').order_by(Token.last_skipped_at.desc()).limit(10).all()
+    skipped_tokens = get_skipped_tokens()
 
     return render_template('index.html',
                           settings=settings,
@@ -363,17 +1109,20 @@ def generate_token():
     # Handle custom reason
     final_reason = f"Other: {custom_reason}" if visit_reason == 'other' else visit_reason
 
-    token_number = generate_token_number()
+    with queue_transition():
+        token_number = generate_token_number()
 
-    new_token = Token(
-        token_number=token_number,
-        visit_reason=final_reason,
-        phone_number=phone_number,
-        customer_name=customer_name
-    )
+        new_token = Token(
+            token_number=token_number,
+            visit_reason=final_reason,
+            phone_number=phone_number,
+            customer_name=customer_name
+        )
 
-    db.session.add(new_token)
-    db.session.commit()
+        db.session.add(new_token)
+
+    # Staff dashboards show the pending list
+    broadcast_token_update()
 
     flash(f'Token {token_number} generated successfully!', 'success')
     return redirect(url_for('token_confirmation', token_id=new_token.id))
@@ -390,135 +1139,30 @@ def token_confirmation(token_id):
 
 @app.route('/next-token')
 def next_token():
-    if not is_admin() and 'employee_id' not in session:
+    if not is_staff():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    next_token = get_next_token()
-    if next_token:
-        settings = get_settings()
-        current_token = get_current_token()
-        if current_token:
-            current_token.status = 'SERVED'
-            current_token.served_at = get_ist_time()
-            # Calculate service duration in seconds
-            if current_token.created_at:
-                # Handle timezone differences
-                if current_token.created_at.tzinfo is None:
-                    served_at_naive = current_token.served_at.replace(tzinfo=None)
-                    delta = served_at_naive - current_token.created_at
-                else:
-
-                    delta = current_token.served_at - current_token.created_at
-
-                current_token.service_duration = int(delta.total_seconds())
-            db.session.commit()
-
-        settings.current_token_id = next_token.id
-        db.session.commit()
-
-        # Broadcast update
-        broadcast_token_update()
-    else:
-        flash('No more pending tokens in queue', 'info')
-
-    # Redirect
-    if is_admin():
-        return redirect(url_for('admin'))
-    else:
-        return redirect(url_for('employee_dashboard'))
+    flash_messages(queue_next_token())
+    return staff_redirect()
 
 @app.route('/recall-token')
 def recall_token():
-    if not is_admin() and 'employee_id' not in session:
+    if not is_staff():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    current_token = get_current_token()
-    if current_token:
-        # Update recall count
-        if not hasattr(current_token, 'recall_count'):
-            current_token.recall_count = 0
-        current_token.recall_count += 1
-
-        # Update recall time
-        current_token.last_recalled_at = get_ist_time()
-
-        db.session.commit()
-
-        # Broadcast update
-        broadcast_token_update()
-
-
-        flash(f'Recalling token {current_token.token_number} (Recall #{current_token.recall_count})', 'warning')
-    else:
-        flash('No active token to recall', 'error')
-
-    # Redirect
-    if is_admin():
-        return redirect(url_for('admin'))
-    else:
-        return redirect(url_for('employee_dashboard'))
-
-
+    flash_messages(queue_recall_token())
+    return staff_redirect()
 
 @app.route('/mark-as-served')
 def mark_as_served():
-    if not is_admin() and 'employee_id' not in session:
+    if not is_staff():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    current_token = get_current_token()
-    if current_token:
-        # Mark the current token as SERVED
-        current_token.status = 'SERVED'
-        current_token.served_at = get_ist_time()
-
-        # Record which employee served this token
-        if 'employee_id' in session:
-            employee_id = session['employee_id']
-            current_token.staff_id = str(employee_id)
-
-            # Update employee statistics
-            employee = Employee.query.get(employee_id)
-            if employee:
-                employee.tokens_served += 1
-
-                # Update average service time
-                if current_token.created_at:
-                    # Calculate service duration in seconds
-                    if current_token.created_at.tzinfo is None:
-                        served_at_naive = current_token.served_at.replace(tzinfo=None)
-                        delta = served_at_naive - current_token.created_at
-                    else:
-                        delta = current_token.served_at - current_token.created_at
-
-                    current_token.service_duration = int(delta.total_seconds())
-
-                    if employee.tokens_served == 1:
-                        employee.avg_service_time = current_token.service_duration / 60  # Convert to minutes
-                    else:
-                        # Weighted average to smooth out the values
-                        employee.avg_service_time = (employee.avg_service_time * (employee.tokens_served - 1) +
-                                                 current_token.service_duration / 60) / employee.tokens_served
-
-        # Clear the current token
-        settings = get_settings()
-        settings.current_token_id = 0
-        db.session.commit()
-
-        # Broadcast token update to all connected clients
-        broadcast_token_update()
-
-        flash(f'Token {current_token.token_number} has been marked as served', 'success')
-    else:
-        flash('No active token to mark as served', 'error')
-
-    # Redirect based on user type
-    if is_admin():
-        return redirect(url_for('admin'))
-    else:
-        return redirect(url_for('employee_dashboard'))
+    flash_messages(queue_mark_as_served())
+    return staff_redirect()
 
 # Admin routes
 @app.route('/admin')
@@ -606,358 +1250,154 @@ def toggle_print_mode():
     flash(f'Print mode changed to {mode}', 'success')
     return redirect(url_for('admin'))
 
+# Exports
+# Format -> (file extension, mimetype)
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+}
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
+def export_download_name(export_format, date_range):
+    """Download file name, after the range the export covers"""
+    file_suffix = ''
+    if date_range.start or date_range.end:
+        file_suffix = f"_{date_range.start or 'first'}_{date_range.end or 'latest'}"
+    extension = EXPORT_FORMATS[export_format][0]
+    if export_format == 'excel':
+        return f'qms_analytics_export{file_suffix}.{extension}'
+    return f'tokens_export{file_suffix}.{extension}'
+
+def requested_changes():
+    """
+    (since, watermark) change versions of an export: the since watermark in
+    the request (None for everything) and the current queue version, read
+    before the export starts, which it returns as the next watermark.
+    Raises ValueError for a malformed watermark.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        since = int(since)
+        if since < 0:
+            raise ValueError(f'Invalid watermark {since}')
+    return since, stored_queue_version()
+
+def export_token_count(date_range, since):
+    statement = select_tokens(db.select(Token.id), Token, date_range.start, date_range.end, since)
+    return db.session.execute(db.select(db.func.count()).select_from(statement.subquery())).scalar()
+
+def export_sheets(date_range, since, progress=None):
+    """
+    The Excel export's sheets, name -> (header, rows). The token sheets
+    have the tokens written after the since watermark, the summary sheets
+    always cover the whole range. progress(done, total)
+    is called as the Tokens sheet rows are read.
+    """
+    # Summary sheets from the analytics model, shared with (and often cached by) the page
+    staff_members = Employee.query.all()
+    model = analytics_model(date_range, staff_members).context
+
+    # Token sheets are streamed from the database row by row
+    rows = token_rows(db.session, Token, date_range.start, date_range.end, since)
+    if progress:
+        rows = report_progress(rows, progress, export_token_count(date_range, since))
+    sheets = {'Tokens': (TOKEN_EXPORT_HEADER, rows)}
+    sheets.update((name, frame_rows(sheet)) for name, sheet in summary_sheets(model, staff_members).items())
+    # Recovery Analysis - New sheet for recovered tokens
+    sheets['Recovery Analysis'] = (RECOVERY_EXPORT_HEADER,
+                                   recovery_rows(db.session, Token, date_range.start, date_range.end, since))
+    return sheets
+
+def write_export(export_format, date_range, since, path, progress=None):
+    """Write an export to a file, for the background jobs"""
+    with app.app_context():
+        if export_format == 'excel':
+            write_workbook(path, export_sheets(date_range, since, progress))
+            return
+
+        if export_format in COLUMNAR_FORMATS:
+            batches = columnar_batches(db.session, Token, date_range.start, date_range.end, since)
+            if progress:
+                batches = report_progress(batches, progress, export_token_count(date_range, since),
+                                          size=lambda batch: batch.num_rows)
+            write_columnar(path, batches, export_format)
+            return
+
+        rows = token_rows(db.session, Token, date_range.start, date_range.end, since)
+        if progress:
+            rows = report_progress(rows, progress, export_token_count(date_range, since))
+        with open(path, 'wb') as f:
+            for chunk in csv_chunks(rows):
+                f.write(chunk)
+
+export_jobs = ExportJobs(app.config['EXPORT_DIR'], app.config['EXPORT_WORKERS'],
+                         app.config['EXPORT_MAX_AGE_HOURS'] * 3600, app.config['EXPORT_MAX_MB'] * 1024 * 1024)
+
+def submit_export(export_format, date_range, since, watermark):
+    """Queue an export as a background job and return its state"""
+    return export_jobs.submit(
+        lambda path, progress: write_export(export_format, date_range, since, path, progress),
+        EXPORT_FORMATS[export_format][0],
+        format=export_format,
+        download_name=export_download_name(export_format, date_range),
+        watermark=watermark
+    )
+
+def export_job_accepted(job, as_json=False):
+    """
+    The 202 response for a queued export job: its status as JSON for
+    scripts, or a page that follows the job and then downloads the file
+    """
+    status = export_job_status(job)
+    status_url = url_for('export_job_status_api', job_id=job['id'])
+    headers = {'Location': status_url, 'X-Export-Watermark': str(job['watermark'])}
+    if as_json or request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        return jsonify({'success': True, 'job': status, 'status_url': status_url}), 202, headers
+    return render_template('export_job.html', job=status, status_url=status_url), 202, headers
+
+def export_job_status(job):
+    """The fields of a job clients see, with its download link once finished"""
+    status = {key: job.get(key) for key in ('id', 'status', 'format', 'done', 'total', 'error', 'download_name',
+                                            'watermark')}
+    if job['status'] == 'finished':
+        status['download_url'] = url_for('download_export_job', job_id=job['id'])
+    return status
+
 @app.route('/export-data')
 def export_data():
     if not is_admin() and 'employee_id' not in session:
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
+    date_range = requested_date_range()
+
     try:
-        # Get all tokens
-        all_tokens = Token.query.all()
-
-        # Prepare token data for export
-        token_data = []
-        for token in all_tokens:
-            token_item = {
-                'Token Number': token.token_number,
-                'Visit Reason': token.visit_reason,
-                'Phone Number': token.phone_number,
-                'Customer Name': token.customer_name,
-                'Status': token.status,
-                'Created At': token.created_at,
-                'Recall Count': token.recall_count,
-                'Skip Count': token.skip_count,
-                'Was Skipped': token.skip_count > 0,
-            }
-
-            # Add skipped token specific data
-            if token.skip_count > 0:
-                token_item['Last Skipped At'] = token.last_skipped_at
-                # Include recovery time if the token was skipped but later served
-                if token.status == 'SERVED' and token.served_at and token.last_skipped_at:
-                    # Calculate recovery time if not stored directly
-                    if hasattr(token, 'recovery_time') and token.recovery_time:
-                        token_item['Recovery Time (sec)'] = token.recovery_time
-                    else:
-                        # Calculate on the fly if not stored
-                        if token.last_skipped_at.tzinfo is None and token.served_at.tzinfo is not None:
-                            # last_skipped_at is naive, served_at is aware
-                            served_at_naive = token.served_at.replace(tzinfo=None)
-                            recovery_delta = served_at_naive - token.last_skipped_at
-                        elif token.last_skipped_at.tzinfo is not None and token.served_at.tzinfo is None:
-                            # last_skipped_at is aware, served_at is naive
-                            last_skipped_at_naive = token.last_skipped_at.replace(tzinfo=None)
-                            recovery_delta = token.served_at - last_skipped_at_naive
-                        else:
-                            # Both are either naive or aware
-                            recovery_delta = token.served_at - token.last_skipped_at
-
-                        token_item['Recovery Time (sec)'] = int(recovery_delta.total_seconds())
-                        token_item['Recovery Time (min)'] = round(int(recovery_delta.total_seconds()) / 60, 1)
-
-            # Add service time data if available
-            if token.served_at:
-                token_item['Served At'] = token.served_at
-                token_item['Waiting Time (min)'] = token.waiting_time
-
-                if token.service_duration is not None:
-                    # Convert seconds to minutes for better readability
-                    token_item['Service Duration (min)'] = round(token.service_duration / 60, 1)
-
-            token_data.append(token_item)
-
-        tokens_df = pd.DataFrame(token_data)
-
-        # Determine export format (CSV or Excel)
-        export_format = request.args.get('format', 'csv')
+        # Only tokens written after the since watermark, if one is given
+        since, watermark = requested_changes()
+        # The next export passes this as since to get what changed from here on
+        watermark_header = {'X-Export-Watermark': str(watermark)}
 
-        if export_format == 'excel':
-            output = io.BytesIO()
-
-            served_tokens = [t for t in all_tokens if t.status == 'SERVED' and t.served_at is not None]
-            skipped_tokens = [t for t in all_tokens if t.status == 'SKIPPED' or t.skip_count > 0]
-            pending_tokens = [t for t in all_tokens if t.status == 'PENDING']
-
-            # Get tokens that were skipped but later served (recovered tokens)
-            skipped_then_served = [t for t in served_tokens if t.skip_count > 0]
-
-            # Get all employees
-            staff_members = Employee.query.all()
-
-            # Basic counts
-            total_tokens = len(all_tokens)
-            total_served = len(served_tokens)
-            total_skipped = len(skipped_tokens)
-            total_pending = len(pending_tokens)
-            total_recovered = len(skipped_then_served)
-
-            # Calculate recovery rate
-            recovery_rate = (total_recovered / total_skipped * 100) if total_skipped > 0 else 0
-
-            # Calculate service metrics
-            if total_served > 0:
-                avg_waiting_time = sum(token.waiting_time or 0 for token in served_tokens) / total_served
-                avg_service_duration = sum(token.service_duration or 0 for token in served_tokens) / total_served / 60
-                total_recalls = sum(token.recall_count or 0 for token in all_tokens)
-                total_skips = sum(token.skip_count or 0 for token in all_tokens)
-            else:
-                avg_waiting_time = 0
-                avg_service_duration = 0
-                total_recalls = 0
-                total_skips = 0
-
-            # Time-based analytics
-            day_stats = {}
-            hour_stats = {}
-
-            for token in all_tokens:
-                # Day of week stats
-                day = token.day_of_week
-                if day not in day_stats:
-                    day_stats[day] = {'count': 0, 'served': 0, 'skipped': 0, 'recovered': 0}
-
-                day_stats[day]['count'] += 1
-                if token.status == 'SERVED':
-                    day_stats[day]['served'] += 1
-                    if token.skip_count > 0:
-                        day_stats[day]['recovered'] += 1
-                elif token.status == 'SKIPPED' or token.skip_count > 0:
-                    day_stats[day]['skipped'] += 1
-
-                # Hour of day stats
-                hour = token.hour_of_day
-                if hour not in hour_stats:
-                    hour_stats[hour] = {'count': 0, 'served': 0, 'skipped': 0, 'recovered': 0}
-
-                hour_stats[hour]['count'] += 1
-                if token.status == 'SERVED':
-                    hour_stats[hour]['served'] += 1
-                    if token.skip_count > 0:
-                        hour_stats[hour]['recovered'] += 1
-                elif token.status == 'SKIPPED' or token.skip_count > 0:
-                    hour_stats[hour]['skipped'] += 1
-
-            # Reason analytics
-            reason_stats = {}
-            for token in all_tokens:
-                reason = token.visit_reason
-                if reason not in reason_stats:
-                    reason_stats[reason] = {
-                        'count': 0,
-                        'served': 0,
-                        'skipped': 0,
-                        'pending': 0,
-                        'recovered': 0,
-                        'total_waiting_time': 0,
-                        'total_service_duration': 0,
-                        'total_recalls': 0,
-                        'total_skips': 0
-                    }
-
-                reason_stats[reason]['count'] += 1
-                reason_stats[reason]['total_recalls'] += token.recall_count or 0
-                reason_stats[reason]['total_skips'] += token.skip_count or 0
-
-                if token.status == 'SERVED':
-                    reason_stats[reason]['served'] += 1
-                    if token.skip_count > 0:
-                        reason_stats[reason]['recovered'] += 1
-                    reason_stats[reason]['total_waiting_time'] += token.waiting_time or 0
-                    reason_stats[reason]['total_service_duration'] += token.service_duration or 0 if token.service_duration else 0
-                elif token.status == 'SKIPPED' or token.skip_count > 0:
-                    reason_stats[reason]['skipped'] += 1
-                elif token.status == 'PENDING':
-                    reason_stats[reason]['pending'] += 1
-
-            # Calculate averages for each reason
-            for reason, stats in reason_stats.items():
-                if stats['served'] > 0:
-                    stats['avg_waiting_time'] = stats['total_waiting_time'] / stats['served']
-                    stats['avg_service_duration'] = stats['total_service_duration'] / stats['served'] / 60
-                else:
-                    stats['avg_waiting_time'] = 0
-                    stats['avg_service_duration'] = 0
-
-            # Create DataFrames for each analytics section
-
-            # Summary Statistics
-            summary_data = {
-                'Metric': [
-                    'Total Tokens', 'Tokens Served', 'Tokens Skipped', 'Tokens Pending',
-                    'Average Waiting Time (min)', 'Average Service Duration (min)',
-                    'Total Recalls', 'Total Skips', 'Skipped Tokens Recovered', 'Recovery Rate (%)'
-                ],
-                'Value': [
-                    total_tokens, total_served, total_skipped, total_pending,
-                    round(avg_waiting_time, 1), round(avg_service_duration, 1),
-                    total_recalls, total_skips, total_recovered, round(recovery_rate, 1)
-                ]
-            }
-            summary_df = pd.DataFrame(summary_data)
-
-            # Day of Week Analysis
-            day_data = []
-            for day, stats in day_stats.items():
-                efficiency = round((stats['served'] / stats['count'] * 100), 1) if stats['count'] > 0 else 0
-                recovery_rate = round((stats['recovered'] / stats['skipped'] * 100), 1) if stats['skipped'] > 0 else 0
-                day_data.append({
-                    'Day': day,
-                    'Total': stats['count'],
-                    'Served': stats['served'],
-                    'Skipped': stats['skipped'],
-                    'Recovered': stats['recovered'],
-                    'Efficiency (%)': efficiency,
-                    'Recovery Rate (%)': recovery_rate
-                })
-            day_df = pd.DataFrame(day_data)
-
-            # Hour of Day Analysis
-            hour_data = []
-            for hour, stats in hour_stats.items():
-                efficiency = round((stats['served'] / stats['count'] * 100), 1) if stats['count'] > 0 else 0
-                recovery_rate = round((stats['recovered'] / stats['skipped'] * 100), 1) if stats['skipped'] > 0 else 0
-                hour_data.append({
-                    'Hour': f"{hour}:00",
-                    'Total': stats['count'],
-                    'Served': stats['served'],
-                    'Skipped': stats['skipped'],
-                    'Recovered': stats['recovered'],
-                    'Efficiency (%)': efficiency,
-                    'Recovery Rate (%)': recovery_rate
-                })
-            hour_df = pd.DataFrame(hour_data)
-
-            # Visit Reason Analysis
-            reason_data = []
-            for reason, stats in reason_stats.items():
-                recovery_rate = round((stats['recovered'] / stats['skipped'] * 100), 1) if stats['skipped'] > 0 else 0
-                reason_data.append({
-                    'Visit Reason': reason,
-                    'Total': stats['count'],
-                    'Served': stats['served'],
-                    'Skipped': stats['skipped'],
-                    'Recovered': stats['recovered'],
-                    'Pending': stats['pending'],
-                    'Recalls': stats['total_recalls'],
-                    'Skips': stats['total_skips'],
-                    'Avg. Wait (min)': round(stats['avg_waiting_time'], 1),
-                    'Avg. Service (min)': round(stats['avg_service_duration'], 1),
-                    'Recovery Rate (%)': recovery_rate
-                })
-            reason_df = pd.DataFrame(reason_data)
-
-            # Staff Performance
-            staff_data = []
-            for staff in staff_members:
-                staff_data.append({
-                    'Staff ID': staff.employee_id,
-                    'Name': staff.name,
-                    'Role': staff.role,
-                    'Tokens Served': staff.tokens_served,
-                    'Avg. Service Time (min)': round(staff.avg_service_time, 1),
-                    'Status': 'On Duty' if staff.is_on_duty else 'Off Duty',
-                    'Last Login': staff.last_login
-                })
-            staff_df = pd.DataFrame(staff_data)
-
-            # Recovery Analysis - New sheet for recovered tokens
-            recovery_data = []
-            for token in skipped_then_served:
-                # Calculate recovery time if not stored directly
-                recovery_time = None
-                if hasattr(token, 'recovery_time') and token.recovery_time:
-                    recovery_time = token.recovery_time
-                elif token.last_skipped_at and token.served_at:
-                    # Calculate on the fly
-                    if token.last_skipped_at.tzinfo is None and token.served_at.tzinfo is not None:
-                        served_at_naive = token.served_at.replace(tzinfo=None)
-                        recovery_delta = served_at_naive - token.last_skipped_at
-                    elif token.last_skipped_at.tzinfo is not None and token.served_at.tzinfo is None:
-                        last_skipped_at_naive = token.last_skipped_at.replace(tzinfo=None)
-                        recovery_delta = token.served_at - last_skipped_at_naive
-                    else:
-                        recovery_delta = token.served_at - token.last_skipped_at
-                    recovery_time = int(recovery_delta.total_seconds())
-
-                recovery_data.append({
-                    'Token Number': token.token_number,
-                    'Customer Name': token.customer_name,
-                    'Visit Reason': token.visit_reason,
-                    'Created At': token.created_at,
-                    'Times Skipped': token.skip_count,
-                    'Last Skipped At': token.last_skipped_at,
-                    'Served At': token.served_at,
-                    'Recovery Time (sec)': recovery_time,
-                    'Recovery Time (min)': round(recovery_time / 60, 1) if recovery_time else None,
-                    'Total Wait Time (min)': token.waiting_time,
-                    'Staff ID': token.staff_id
-                })
-            recovery_df = pd.DataFrame(recovery_data)
-
-            # Write all DataFrames to Excel file
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                tokens_df.to_excel(writer, sheet_name='Tokens', index=False)
-                summary_df.to_excel(writer, sheet_name='Summary', index=False)
-                day_df.to_excel(writer, sheet_name='Day Analysis', index=False)
-                hour_df.to_excel(writer, sheet_name='Hour Analysis', index=False)
-                reason_df.to_excel(writer, sheet_name='Reason Analysis', index=False)
-                staff_df.to_excel(writer, sheet_name='Staff Performance', index=False)
-                recovery_df.to_excel(writer, sheet_name='Recovery Analysis', index=False)
-
-                # Format the Excel file
-                workbook = writer.book
-
-                # Add some formatting to make it look better
-                header_format = workbook.add_format({
-                    'bold': True,
-                    'text_wrap': True,
-                    'valign': 'top',
-                    'fg_color': '#D7E4BC',
-                    'border': 1
-                })
-
-                # Apply formatting to each worksheet
-                for sheet_name in writer.sheets:
-                    worksheet = writer.sheets[sheet_name]
-                    # Get the column names from the DataFrame
-                    if sheet_name == 'Tokens':
-                        columns = tokens_df.columns
-                    elif sheet_name == 'Summary':
-                        columns = summary_df.columns
-                    elif sheet_name == 'Day Analysis':
-                        columns = day_df.columns
-                    elif sheet_name == 'Hour Analysis':
-                        columns = hour_df.columns
-                    elif sheet_name == 'Reason Analysis':
-                        columns = reason_df.columns
-                    elif sheet_name == 'Staff Performance':
-                        columns = staff_df.columns
-                    elif sheet_name == 'Recovery Analysis':
-                        columns = recovery_df.columns
-                    else:
-                        continue
-
-                    # Apply header formatting
-                    for col_num, value in enumerate(columns):
-                        worksheet.write(0, col_num, value, header_format)
-
-                    # Set column width
-                    worksheet.set_column(0, len(columns), 15)
-
-            output.seek(0)
-            return send_file(output,
-                            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                            download_name='qms_analytics_export.xlsx',
-                            as_attachment=True)
-        else:  # Default to CSV - just export token data
-            output = io.StringIO()
-            tokens_df.to_csv(output, index=False)
-            output.seek(0)
-            return send_file(io.BytesIO(output.getvalue().encode('utf-8')),
+        # Determine export format (CSV, Excel, Parquet or Arrow)
+        export_format = request.args.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            export_format = 'csv'
+
+        if export_format != 'csv':
+            # Workbooks and columnar files take a while to build, so they are
+            # written by a background job instead of blocking this request
+            if export_format in COLUMNAR_FORMATS and not columnar_supported():
+                raise RuntimeError(f'{export_format.title()} export needs pyarrow (pip install pyarrow)')
+            return export_job_accepted(submit_export(export_format, date_range, since, watermark))
+        else:  # CSV - just export token data
+            # Streamed a page of rows at a time, nothing is built up in memory and no read lock is held
+            download_name = export_download_name(export_format, date_range)
+            rows = token_rows(db.session, Token, date_range.start, date_range.end, since)
+            return Response(stream_with_context(csv_chunks(rows)),
                             mimetype='text/csv',
-                            download_name='tokens_export.csv',
-                            as_attachment=True)
+                            headers={'Content-Disposition': f'attachment; filename={download_name}',
+                                     **watermark_header})
     except Exception as e:
         flash(f'Error exporting data: {str(e)}', 'error')
         if is_admin():
@@ -965,6 +1405,51 @@ def export_data():
         else:
             return redirect(url_for('employee_dashboard'))
 
+@app.route('/api/export-jobs', methods=['POST'])
+def start_export_job():
+    """Start an export in the background; poll its status_url for progress"""
+    if not is_staff():
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': f'Unknown format {export_format}'}), 400
+    if export_format in COLUMNAR_FORMATS and not columnar_supported():
+        return jsonify({'success': False, 'error': f'{export_format.title()} export needs pyarrow'}), 400
+    try:
+        date_range = resolve_date_range(request.args, get_ist_time().date())
+        since, watermark = requested_changes()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    return export_job_accepted(submit_export(export_format, date_range, since, watermark), as_json=True)
+
+@app.route('/api/export-jobs/<job_id>')
+def export_job_status_api(job_id):
+    if not is_staff():
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Export not found or expired'}), 404
+    return jsonify({'success': True, 'job': export_job_status(job)})
+
+@app.route('/export-jobs/<job_id>/download')
+def download_export_job(job_id):
+    if not is_staff():
+        flash('Access denied', 'error')
+        return redirect(url_for('index'))
+
+    job = export_jobs.get(job_id)
+    if job is None or job['status'] != 'finished' or not os.path.exists(export_jobs.file_path(job)):
+        flash('Export not found or expired', 'error')
+        return redirect(url_for('enhanced_analytics'))
+
+    return send_file(os.path.abspath(export_jobs.file_path(job)),
+                     mimetype=EXPORT_FORMATS[job['format']][1],
+                     download_name=job['download_name'],
+                     as_attachment=True)
+
 @app.route('/admin-generate-token', methods=['POST'])
 def admin_generate_token():
     if not is_admin() and 'employee_id' not in session:
@@ -988,17 +1473,20 @@ def admin_generate_token():
     # Combine reason if "Others" is selected
     final_reason = f"{visit_reason}: {other_reason}" if visit_reason == "Others" else visit_reason
 
-    token_number = generate_token_number()
+    with queue_transition():
+        token_number = generate_token_number()
 
-    new_token = Token(
-        token_number=token_number,
-        visit_reason=final_reason,
-        phone_number=phone_number,
-        customer_name=customer_name
-    )
+        new_token = Token(
+            token_number=token_number,
+            visit_reason=final_reason,
+            phone_number=phone_number,
+            customer_name=customer_name
+        )
 
-    db.session.add(new_token)
-    db.session.commit()
+        db.session.add(new_token)
+
+    # Staff dashboards show the pending list
+    broadcast_token_update()
 
     flash(f'Token {token_number} generated successfully!', 'success')
 
@@ -1073,13 +1561,13 @@ def reset_database():
                             'Phone Number': token.phone_number,
                             'Customer Name': token.customer_name,
                             'Status': token.status,
-                            'Created At': token.created_at,
+                            'Created At': local_naive(token.created_at),
                             'Recall Count': token.recall_count
                         }
 
                         # Add service time data if available
                         if token.served_at:
-                            token_data['Served At'] = token.served_at
+                            token_data['Served At'] = local_naive(token.served_at)
                             token_data['Waiting Time (min)'] = token.waiting_time
 
                             if token.service_duration is not None:
@@ -1133,35 +1621,22 @@ def revert_token_status(token_id):
 
     # Store previous status for message
     previous_status = token.status
+    engine = get_queue_engine()
 
-    # Get the current token before making any changes
-    current_token = get_current_token()
-
-    # Check if this token was created before the current token,This helps determine if it should be the next to be served
-    is_earlier_token = current_token and token.id < current_token.id
+    with queue_transition():
+        # Served tokens are counted again when they are next served
+        if previous_status == 'SERVED':
+            remove_employee_service(token)
 
-    # Revert to PENDING
-    token.status = 'PENDING'
-
-    # If this was the current token, clear it and find the next token to serve
-    settings = get_settings()
-    if settings.current_token_id == token_id:
-        settings.current_token_id = 0  # Set to 0 instead of None for consistency
-        db.session.commit()
+        # Revert to PENDING
+        change_token_status(token, 'PENDING')
 
-        # Find the next token to serve
-        next_token = get_next_token()
-        if next_token:
-            settings.current_token_id = next_token.id
-            db.session.commit()
-    else:
-        # If this token came before the current token and is now pending,
-        # it should be the next token to be served
-        if is_earlier_token:
-
-            pass
-
-        db.session.commit()
+        # If this was the current token, move on to the next token to serve
+        settings = get_settings()
+        if settings.current_token_id == token_id:
+            # With no current token the lowest pending id is next
+            next_id = engine.next_id(current_id=0)
+            settings.current_token_id = min(next_id, token.id) if next_id else token.id
 
     # Broadcast token update to all connected clients
     broadcast_token_update()
@@ -1220,24 +1695,18 @@ def delete_token(token_id):
     # Get token number
     token_number = token.token_number
 
-    # Check if next token
-    next_token = get_next_token()
-    is_next_token = next_token and next_token.id == token.id
-
-    # Delete token
-    db.session.delete(token)
-    db.session.commit()
-
+    engine = get_queue_engine()
 
-    if is_next_token:
-        # Get new next token
-        new_next_token = get_next_token()
+    with queue_transition():
+        # Delete token
+        db.session.delete(token)
 
-        # Update current token
+        # If the deleted token was next and nothing is being served, serve the new next token
         settings = get_settings()
-        if settings.current_token_id == 0 and new_next_token:
-            settings.current_token_id = new_next_token.id
-            db.session.commit()
+        if engine.next_id() == token.id and settings.current_token_id == 0:
+            new_next_id = engine.next_id(exclude=(token.id,))
+            if new_next_id:
+                settings.current_token_id = new_next_id
 
     # Broadcast token update to all connected clients
     broadcast_token_update()
@@ -1347,130 +1816,35 @@ def enhanced_analytics():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    # Get tokens
-    all_tokens = Token.query.all()
-    served_tokens = [t for t in all_tokens if t.status == 'SERVED' and t.served_at is not None]
-    skipped_tokens = [t for t in all_tokens if t.status == 'SKIPPED' or t.skip_count > 0]
-    pending_tokens = [t for t in all_tokens if t.status == 'PENDING']
+    date_range = requested_date_range()
 
     # Get employees
     staff_members = Employee.query.all()
 
-    # Count tokens
-    total_tokens = len(all_tokens)
-    total_served = len(served_tokens)
-    total_skipped = len(skipped_tokens)
-    total_pending = len(pending_tokens)
-    # Get recovered tokens
-    skipped_then_served = []
-    for token in served_tokens:
-        if token.skip_count > 0:
-            skipped_then_served.append(token)
-    # Recovery metrics
-    total_recovered = len(skipped_then_served)
-    recovery_rate = (total_recovered / total_skipped * 100) if total_skipped > 0 else 0
-    # Avg recovery time
-    avg_recovery_time = sum(token.recovery_time or 0 for token in skipped_then_served) / total_recovered if total_recovered > 0 else 0
-
-    # Service metrics
-    if total_served > 0:
-        # Calculate averages
-        avg_waiting_time = sum(token.waiting_time or 0 for token in served_tokens) / total_served
-
-
-        avg_service_duration = sum(token.service_duration or 0 for token in served_tokens) / total_served / 60
-
-        total_recalls = sum(token.recall_count or 0 for token in all_tokens)
-        total_skips = sum(token.skip_count or 0 for token in all_tokens)
-    else:
-        avg_waiting_time = 0
-        avg_service_duration = 0
-        total_recalls = 0
-        total_skips = 0
-
-    # Time analytics
-    day_stats = {}
-    hour_stats = {}
-
-    for token in all_tokens:
-        # Day stats
-        day = token.day_of_week
-        if day not in day_stats:
-            day_stats[day] = {'count': 0, 'served': 0, 'skipped': 0}
-
-        day_stats[day]['count'] += 1
-        if token.status == 'SERVED':
-            day_stats[day]['served'] += 1
-        elif token.status == 'SKIPPED' or token.skip_count > 0:
-            day_stats[day]['skipped'] += 1
-
-        # Hour stats
-        hour = token.hour_of_day
-        if hour not in hour_stats:
-            hour_stats[hour] = {'count': 0, 'served': 0, 'skipped': 0}
-
-        hour_stats[hour]['count'] += 1
-        if token.status == 'SERVED':
-            hour_stats[hour]['served'] += 1
-        elif token.status == 'SKIPPED' or token.skip_count > 0:
-            hour_stats[hour]['skipped'] += 1
-
-    # Reason analytics
-    reason_stats = {}
-    for token in all_tokens:
-        reason = token.visit_reason
-        if reason not in reason_stats:
-            reason_stats[reason] = {
-                'count': 0,
-                'served': 0,
-                'skipped': 0,
-                'pending': 0,
-                'total_waiting_time': 0,
-                'total_service_duration': 0,
-                'total_recalls': 0,
-                'total_skips': 0
-            }
-
-        reason_stats[reason]['count'] += 1
-        reason_stats[reason]['total_recalls'] += token.recall_count or 0
-        reason_stats[reason]['total_skips'] += token.skip_count or 0
-
-        if token.status == 'SERVED':
-            reason_stats[reason]['served'] += 1
-            reason_stats[reason]['total_waiting_time'] += token.waiting_time or 0
-            reason_stats[reason]['total_service_duration'] += token.service_duration or 0 if token.service_duration else 0
-        elif token.status == 'SKIPPED' or token.skip_count > 0:
-            reason_stats[reason]['skipped'] += 1
-        elif token.status == 'PENDING':
-            reason_stats[reason]['pending'] += 1
-
-    # Reason averages
-    for reason, stats in reason_stats.items():
-        if stats['served'] > 0:
-            stats['avg_waiting_time'] = stats['total_waiting_time'] / stats['served']
-            stats['avg_service_duration'] = stats['total_service_duration'] / stats['served'] / 60
-        else:
-            stats['avg_waiting_time'] = 0
-            stats['avg_service_duration'] = 0
-
-    return render_template('enhanced_analytics.html',
-                          total_tokens=total_tokens,
-                          total_served=total_served,
-                          total_skipped=total_skipped,
-                          total_pending=total_pending,
-                          avg_waiting_time=avg_waiting_time,
-                          avg_service_duration=avg_service_duration,
-                          total_recalls=total_recalls,
-                          total_skips=total_skips,
-                          day_stats=day_stats,
-                          hour_stats=hour_stats,
-                          reason_stats=reason_stats,
-                          all_tokens=all_tokens,
+    # Analytics of the range, shared with the Excel export
+    entry = analytics_model(date_range, staff_members)
+
+    # Everything else the page shows; pages with flash messages are not cached
+    settings = get_settings()
+    variant = (
+        date_range, is_admin(), 'employee_id' in session, settings.use_thermal_printer if settings else None,
+        tuple((staff.id, staff.name, staff.role, staff.tokens_served, staff.avg_service_time,
+               staff.is_on_duty, staff.is_active, staff.last_login) for staff in staff_members)
+    )
+    cacheable = not session.get('_flashes')
+    if cacheable:
+        html = analytics_cache.get_page(entry, variant)
+        if html is not None:
+            return html
+
+    html = render_template('enhanced_analytics.html',
                           staff_members=staff_members,
-                          skipped_then_served=skipped_then_served,
-                        total_recovered=total_recovered,
-                        recovery_rate=recovery_rate,
-                        avg_recovery_time=avg_recovery_time)
+                          date_range=date_range,
+                          date_presets=DATE_PRESETS,
+                          **entry.context)
+    if cacheable:
+        analytics_cache.put_page(entry, variant, html)
+    return html
 
 # Employee routes
 @app.route('/manage-employees')
@@ -1688,107 +2062,12 @@ def end_duty():
 
 @app.route('/serve-token/<int:token_id>')
 def serve_token(token_id):
-    if not is_admin() and 'employee_id' not in session:
+    if not is_staff():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    token = Token.query.get_or_404(token_id)
-
-    # Check token status
-    if token.status != 'PENDING' and token.status != 'SKIPPED':
-        flash(f'Only pending or skipped tokens can be served. Token {token.token_number} is {token.status}', 'error')
-        if is_admin():
-            return redirect(url_for('admin'))
-        else:
-            return redirect(url_for('employee_dashboard'))
-
-    # Handle skipped tokens
-    recovery_time = None
-    if token.status == 'SKIPPED':
-        # Calculate recovery time
-        if token.last_skipped_at:
-            current_time = get_ist_time()
-
-            # Handle timezones
-            if token.last_skipped_at.tzinfo is None and current_time.tzinfo is not None:
-
-                current_time_naive = current_time.replace(tzinfo=None)
-                recovery_delta = current_time_naive - token.last_skipped_at
-            elif token.last_skipped_at.tzinfo is not None and current_time.tzinfo is None:
-
-                last_skipped_at_naive = token.last_skipped_at.replace(tzinfo=None)
-                recovery_delta = current_time - last_skipped_at_naive
-            else:
-
-                recovery_delta = current_time - token.last_skipped_at
-
-            recovery_time = int(recovery_delta.total_seconds())
-            token.recovery_time = recovery_time
-
-        status_change = TokenStatusChange(
-             token_id=token.id,
-             old_status='SKIPPED',
-             new_status='SERVED',
-             changed_by=session.get('employee_id')
-         )
-        db.session.add(status_change)
-
-        flash(f'Serving previously skipped token {token.token_number}. Token was skipped {token.skip_count} times.', 'info')
-
-    # Mark current token as served
-    settings = get_settings()
-    current_token = get_current_token()
-    if current_token:
-        current_token.status = 'SERVED'
-        current_token.served_at = get_ist_time()
-
-        # Record employee
-        if 'employee_id' in session:
-            employee_id = session['employee_id']
-            current_token.staff_id = str(employee_id)
-
-            # Update stats
-            employee = Employee.query.get(employee_id)
-            if employee:
-                employee.tokens_served += 1
-
-                # Update avg time
-                if current_token.service_duration:
-                    if employee.tokens_served == 1:
-                        employee.avg_service_time = current_token.service_duration / 60  # Convert to minutes
-                    else:
-                        # Weighted average
-                        employee.avg_service_time = (employee.avg_service_time * (employee.tokens_served - 1) +
-                                                 current_token.service_duration / 60) / employee.tokens_served
-
-        # Calculate duration
-        if current_token.created_at:
-
-            if current_token.created_at.tzinfo is None:
-                served_at_naive = current_token.served_at.replace(tzinfo=None)
-                delta = served_at_naive - current_token.created_at
-            else:
-                # Both have timezone info
-                delta = current_token.served_at - current_token.created_at
-
-            current_token.service_duration = int(delta.total_seconds())
-
-        db.session.commit()
-
-    # Set current token
-    settings.current_token_id = token.id
-    db.session.commit()
-
-    # Broadcast update
-    broadcast_token_update()
-
-    flash(f'Now serving token {token.token_number}', 'success')
-
-    # Redirect based on user type
-    if is_admin():
-        return redirect(url_for('admin'))
-    else:
-        return redirect(url_for('employee_dashboard'))
+    flash_messages(queue_serve_token(token_id))
+    return staff_redirect()
 
 # User guide
 @app.route('/user-guide')
@@ -1820,105 +2099,52 @@ def user_guide():
             return redirect(url_for('employee_dashboard'))
 @app.route('/skip-token')
 def skip_token():
-    if not is_admin() and 'employee_id' not in session:
+    if not is_staff():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    current_token = get_current_token()
-    if current_token:
-        # Mark as skipped
-        current_token.status = 'SKIPPED'
-
-        # Store previous status
-        current_token.previous_status = 'PENDING' if not current_token.previous_status else current_token.status
-
-        # Update skip info
-        current_token.skip_count += 1
-        current_token.last_skipped_at = get_ist_time()
-
-        # Record employee
-        if 'employee_id' in session:
-            employee_id = session['employee_id']
-
-            if not current_token.staff_id:
-                current_token.staff_id = str(employee_id)
-
-        # Find next token
-        next_token = get_next_token()
-
-        # Clear current token
-        settings = get_settings()
-        settings.current_token_id = 0
-        db.session.commit()
-
-        # Set next token
-        if next_token:
-            settings.current_token_id = next_token.id
-            db.session.commit()
-
-        # Broadcast update
-        broadcast_token_update()
-
-        flash(f'Token {current_token.token_number} has been skipped', 'warning')
-    else:
-        flash('No active token to skip', 'error')
-
-    # Redirect based on user type
-    if is_admin():
-        return redirect(url_for('admin'))
-    else:
-        return redirect(url_for('employee_dashboard'))
+    flash_messages(queue_skip_token())
+    return staff_redirect()
 
 @app.route('/recover-token/<int:token_id>')
 def recover_token(token_id):
-    if not is_admin() and 'employee_id' not in session:
+    if not is_staff():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
 
-    token = Token.query.get_or_404(token_id)
-
-    # Check token status
-    if token.status != 'SKIPPED':
-        flash(f'Only skipped tokens can be recovered. Token {token.token_number} is {token.status}', 'error')
-        if is_admin():
-            return redirect(url_for('admin'))
-        else:
-            return redirect(url_for('employee_dashboard'))
-
-    # Calculate recovery time
-    if token.last_skipped_at:
-        current_time = get_ist_time()
-
-        # Handle timezones
-        if token.last_skipped_at.tzinfo is None and current_time.tzinfo is not None:
-
-            current_time_naive = current_time.replace(tzinfo=None)
-            recovery_delta = current_time_naive - token.last_skipped_at
-        elif token.last_skipped_at.tzinfo is not None and current_time.tzinfo is None:
-
-            last_skipped_at_naive = token.last_skipped_at.replace(tzinfo=None)
-            recovery_delta = current_time - last_skipped_at_naive
-        else:
-
-            recovery_delta = current_time - token.last_skipped_at
-
-        recovery_time = int(recovery_delta.total_seconds())
-        token.recovery_time = recovery_time
-
-    # Reset status
-    token.status = 'PENDING'
-    db.session.commit()
-
-    # Broadcast token update to all connected clients
-    broadcast_token_update()
-
-    flash(f'Token {token.token_number} has been recovered and is now back in the pending queue', 'success')
-
-    # Redirect based on user type
-    if is_admin():
-        return redirect(url_for('admin'))
-    else:
-        return redirect(url_for('employee_dashboard'))
+    flash_messages(queue_recover_token(token_id))
+    return staff_redirect()
+
+# JSON queue actions for the dashboards
+@app.route('/api/queue/<action>', methods=['POST'])
+@app.route('/api/queue/<action>/<int:token_id>', methods=['POST'])
+def queue_action_api(action, token_id=None):
+    """
+    Run a staff action and return its messages with the new queue state,
+    so dashboards can update in place instead of reloading the page.
+    """
+    if not is_staff():
+        return jsonify({'success': False, 'messages': [{'category': 'error', 'message': 'Access denied'}]}), 403
+
+    if action not in QUEUE_ACTIONS:
+        return jsonify({'success': False, 'messages': [{'category': 'error', 'message': f'Unknown action {action}'}]}), 404
+
+    handler, takes_token = QUEUE_ACTIONS[action]
+    if takes_token != (token_id is not None):
+        return jsonify({'success': False, 'messages': [{'category': 'error', 'message': f'Invalid token for {action}'}]}), 400
+
+    # The handlers' get_or_404 would answer with an HTML page
+    if takes_token and db.session.get(Token, token_id) is None:
+        message = f'Token {token_id} not found'
+        return jsonify({'success': False, 'error': message, 'messages': [{'category': 'error', 'message': message}]}), 404
+
+    messages = handler(token_id) if takes_token else handler()
+
+    return jsonify({
+        'success': not any(category == 'error' for category, _ in messages),
+        'messages': [{'category': category, 'message': message} for category, message in messages],
+        'queue': get_queue_status('admin' if is_admin() else 'employee')
+    })
 
 @app.route('/api/print-token/<int:token_id>')
 def print_token_json(token_id):
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Token Duration Backfill Script for QMS
+
+Tokens store their waiting, recovery and total durations in seconds when
+they are served, recovered or completed. The application fills in tokens
+written before that on startup; this script does the same without
+starting the server, or recomputes every token, e.g. after editing
+timestamps with raw SQL.
+
+Usage:
+    python backfill_durations.py        # Fill in tokens without durations
+    python backfill_durations.py --all  # Recompute the durations of every token
+"""
+
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill the stored QMS token durations')
+    parser.add_argument('--all', action='store_true', help='Recompute every token, not only those without durations')
+    args = parser.parse_args()
+
+    from app import app, db, Token
+    from analytics import backfill_durations
+
+    with app.app_context():
+        # The commit rebuilds the analytics rollups from the new durations
+        rows = backfill_durations(db.session, Token, only_missing=not args.all)
+        db.session.commit()
+        print(f"Stored the durations of {rows} token(s).")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
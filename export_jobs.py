@@ -0,0 +1,157 @@
+# Exports run as background jobs, written to files under an exports directory
+
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from eventlet import GreenPool, patcher, tpool
+except ImportError:
+    patcher = None
+
+# Job ids are uuid4 hex strings, also used as file names
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def hub_is_patched():
+    """True when eventlet has monkey patched threading (the gunicorn eventlet worker)"""
+    return patcher is not None and patcher.is_monkey_patched('thread')
+
+
+class ExportJobs:
+    """
+    Background export jobs.
+
+    Each job writes its file to directory/<id>.<extension> and keeps its
+    state in directory/<id>.json, so any worker can report its progress and
+    serve the finished file. Jobs run in a pool of native threads: under
+    eventlet each job is handed to tpool, so a long export never blocks the
+    hub that serves the live displays.
+
+    Jobs older than max_age seconds are removed, then the oldest finished
+    ones until their files fit in max_bytes.
+    """
+
+    def __init__(self, directory, workers=2, max_age=24 * 3600, max_bytes=500 * 1024 * 1024):
+        self.directory = directory
+        self.workers = workers
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, run, extension, **details):
+        """
+        Queue run(path, progress) as a new job and return its state.
+        run writes the export to path and may call progress(done, total).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.cleanup()
+
+        job_id = uuid.uuid4().hex
+        job = dict(details, id=job_id, status='queued', filename=f'{job_id}.{extension}',
+                   done=0, total=None, created=time.time(), finished=None, error=None)
+        self.save(job)
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = GreenPool(self.workers) if hub_is_patched() else ThreadPoolExecutor(self.workers)
+        if hub_is_patched():
+            self.pool.spawn_n(tpool.execute, self.run_job, job, run)
+        else:
+            self.pool.submit(self.run_job, job, run)
+        return job
+
+    def run_job(self, job, run):
+        path = self.file_path(job)
+        job.update(status='running', started=time.time())
+        self.save(job)
+
+        def progress(done, total=None):
+            job['done'] = done
+            if total is not None:
+                job['total'] = total
+            self.save(job)
+
+        try:
+            run(path, progress)
+            job.update(status='finished', size=os.path.getsize(path))
+        except Exception as e:
+            print(f'Error running export job {job["id"]}: {str(e)}')
+            traceback.print_exc()
+            job.update(status='failed', error=str(e))
+            if os.path.exists(path):
+                os.remove(path)
+        job['finished'] = time.time()
+        self.save(job)
+        self.cleanup()
+
+    def get(self, job_id):
+        """State of a job, None for unknown (or removed) jobs"""
+        if not JOB_ID.match(job_id or ''):
+            return None
+        try:
+            with open(self.state_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def file_path(self, job):
+        return os.path.join(self.directory, job['filename'])
+
+    def state_path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def save(self, job):
+        # Write then rename, so readers never see a partial state file
+        path = self.state_path(job['id'])
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(f'{path}.tmp', path)
+
+    def jobs(self):
+        """States of all jobs, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        jobs = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                job = self.get(name[:-len('.json')])
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job['created'])
+
+    def remove(self, job):
+        for path in (self.file_path(job), self.state_path(job['id'])):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def cleanup(self, now=None):
+        """
+        Remove jobs past max_age, then the oldest finished ones until their
+        files fit in max_bytes. Returns the ids of the removed jobs.
+        """
+        now = time.time() if now is None else now
+        removed = []
+        kept = []
+        for job in self.jobs():
+            # Unfinished jobs this old belong to a worker that has gone away
+            if now - (job['finished'] or job['created']) > self.max_age:
+                self.remove(job)
+                removed.append(job['id'])
+            elif job['status'] == 'finished':
+                kept.append(job)
+
+        total = sum(job.get('size', 0) for job in kept)
+        for job in kept:
+            if total <= self.max_bytes:
+                break
+            self.remove(job)
+            removed.append(job['id'])
+            total -= job.get('size', 0)
+        return removed
@@ -0,0 +1,338 @@
+# Token exports streamed straight from the database
+
+import csv
+import io
+
+import xlsxwriter
+from sqlalchemy import select, tuple_
+
+from analytics import created_between
+from timestamps import epoch_ms, local_naive
+
+# Parquet and Arrow exports are optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Rows fetched per query; memory stays bounded by this, not the table
+EXPORT_BATCH_SIZE = 1000
+
+# Columns of the Tokens sheet
+TOKEN_EXPORT_HEADER = (
+    'Token Number', 'Visit Reason', 'Phone Number', 'Customer Name', 'Status', 'Created At',
+    'Recall Count', 'Skip Count', 'Was Skipped', 'Last Skipped At', 'Recovery Time (sec)',
+    'Recovery Time (min)', 'Served At', 'Waiting Time (min)', 'Service Duration (min)'
+)
+TOKEN_EXPORT_COLUMNS = (
+    'token_number', 'visit_reason', 'phone_number', 'customer_name', 'status', 'created_at',
+    'recall_count', 'skip_count', 'last_skipped_at', 'served_at', 'service_duration',
+    'waiting_seconds', 'recovery_seconds'
+)
+
+# Columns of the Recovery Analysis sheet
+RECOVERY_EXPORT_HEADER = (
+    'Token Number', 'Customer Name', 'Visit Reason', 'Created At', 'Times Skipped',
+    'Last Skipped At', 'Served At', 'Recovery Time (sec)', 'Recovery Time (min)',
+    'Total Wait Time (min)', 'Staff ID'
+)
+RECOVERY_EXPORT_COLUMNS = (
+    'token_number', 'customer_name', 'visit_reason', 'created_at', 'skip_count',
+    'last_skipped_at', 'served_at', 'recovery_seconds', 'waiting_seconds', 'staff_id'
+)
+
+# Typed columns of the Parquet and Arrow exports, in the token table's own
+# names and units (durations in seconds). Timestamps are the stored epoch
+# milliseconds, read back as IST.
+ARROW_TIMESTAMP = ('timestamp', 'ms', '+05:30')
+COLUMNAR_FIELDS = (
+    ('id', 'int64'),
+    ('token_number', 'string'),
+    ('visit_reason', 'string'),
+    ('phone_number', 'string'),
+    ('customer_name', 'string'),
+    ('status', 'string'),
+    ('created_at', ARROW_TIMESTAMP),
+    ('recall_count', 'int32'),
+    ('skip_count', 'int32'),
+    ('last_skipped_at', ARROW_TIMESTAMP),
+    ('served_at', ARROW_TIMESTAMP),
+    ('service_duration', 'int32'),
+    ('waiting_seconds', 'int32'),
+    ('recovery_seconds', 'int32'),
+    ('staff_id', 'string'),
+    ('change_version', 'int64'),
+)
+# Rows per Parquet row group / Arrow record batch
+COLUMNAR_BATCH_SIZE = 64 * 1024
+COLUMNAR_COMPRESSION = 'zstd'
+
+# Workbook header and cell formats, as pandas' ExcelWriter wrote them
+HEADER_FORMAT = {'bold': True, 'text_wrap': True, 'valign': 'top', 'fg_color': '#D7E4BC', 'border': 1}
+DATE_FORMAT = 'yyyy-mm-dd hh:mm:ss'
+COLUMN_WIDTH = 15
+
+
+def select_tokens(statement, Token, start=None, end=None, since=None):
+    """
+    Restrict a token select to the service dates from start to end and to
+    the tokens written by commits after the since watermark
+    (Token.change_version). Incremental selects are ordered by change
+    version, a range scan of its index.
+
+    There is no upper bound: tokens committed while an export is paging
+    are included, and sent again by the next export since the watermark
+    read before it started, which is harmless for rows keyed by id.
+    """
+    statement = statement.where(*created_between(Token.created_at, start, end))
+    if since is None:
+        return statement.order_by(Token.id)
+    return statement.where(Token.change_version > since).order_by(Token.change_version, Token.id)
+
+
+def token_order(Token, since=None):
+    """The ORDER BY columns of select_tokens, unique per token"""
+    if since is None:
+        return (Token.id,)
+    return (Token.change_version, Token.id)
+
+
+def paged_rows(session, statement, keys, page_size=EXPORT_BATCH_SIZE):
+    """
+    Lists of rows of an ordered select, page_size rows at a time, by keyset
+    pagination on keys (its ORDER BY columns, which the rows carry as extra
+    trailing columns).
+
+    Each page is read on its own connection and transaction, so nothing is
+    held between pages. A cursor left open for a whole download would keep
+    SQLite's read lock, and every queue write would fail until the client
+    had read the last row.
+    """
+    labels = [f'page_key_{index}' for index in range(len(keys))]
+    statement = statement.add_columns(*(key.label(label) for key, label in zip(keys, labels))).limit(page_size)
+    engine = session.get_bind()
+
+    last = None
+    while True:
+        page = statement
+        if last is not None:
+            page = page.where(tuple_(*keys) > tuple_(*last) if len(keys) > 1 else keys[0] > last[0])
+        with engine.connect() as connection:
+            rows = connection.execute(page).all()
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last = [getattr(rows[-1], label) for label in labels]
+
+
+def token_rows(session, Token, start=None, end=None, since=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Token export rows of the service dates from start to end, read in
+    pages of batch_size
+    """
+    statement = select_tokens(
+        select(*(getattr(Token, name) for name in TOKEN_EXPORT_COLUMNS)), Token, start, end, since
+    )
+    for rows in paged_rows(session, statement, token_order(Token, since), batch_size):
+        for token in rows:
+            yield token_row(token)
+
+
+def token_row(token):
+    """One Tokens sheet row; empty cells are None"""
+    skip_count = token.skip_count or 0
+    was_skipped = skip_count > 0
+
+    recovery_seconds = None
+    if was_skipped and token.status == 'SERVED' and token.served_at and token.last_skipped_at:
+        recovery_seconds = token.recovery_seconds
+
+    return (
+        token.token_number,
+        token.visit_reason,
+        token.phone_number,
+        token.customer_name,
+        token.status,
+        local_naive(token.created_at),
+        token.recall_count or 0,
+        skip_count,
+        was_skipped,
+        local_naive(token.last_skipped_at) if was_skipped else None,
+        recovery_seconds,
+        tenths_of_minutes(recovery_seconds),
+        local_naive(token.served_at),
+        token.waiting_seconds // 60 if token.waiting_seconds is not None else None,
+        tenths_of_minutes(token.service_duration) if token.served_at else None,
+    )
+
+
+def recovery_rows(session, Token, start=None, end=None, since=None, batch_size=EXPORT_BATCH_SIZE):
+    """Recovery Analysis rows: tokens served after being skipped, in pages"""
+    statement = select(*(getattr(Token, name) for name in RECOVERY_EXPORT_COLUMNS)).where(
+        Token.status == 'SERVED', Token.served_at.isnot(None), Token.skip_count > 0
+    )
+    statement = select_tokens(statement, Token, start, end, since)
+
+    for token in (token for rows in paged_rows(session, statement, token_order(Token, since), batch_size)
+                  for token in rows):
+        recovery_seconds = token.recovery_seconds
+        yield (
+            token.token_number,
+            token.customer_name,
+            token.visit_reason,
+            local_naive(token.created_at),
+            token.skip_count,
+            local_naive(token.last_skipped_at),
+            local_naive(token.served_at),
+            recovery_seconds,
+            tenths_of_minutes(recovery_seconds) if recovery_seconds else None,
+            token.waiting_seconds // 60 if token.waiting_seconds is not None else None,
+            token.staff_id,
+        )
+
+
+def columnar_supported():
+    """True when pyarrow is installed"""
+    return pa is not None
+
+
+def columnar_schema():
+    """The pyarrow schema of COLUMNAR_FIELDS"""
+    fields = []
+    for name, kind in COLUMNAR_FIELDS:
+        if isinstance(kind, tuple):
+            _, unit, timezone = kind
+            fields.append(pa.field(name, pa.timestamp(unit, tz=timezone)))
+        else:
+            fields.append(pa.field(name, getattr(pa, kind)()))
+    return pa.schema(fields)
+
+
+def columnar_batches(session, Token, start=None, end=None, since=None, batch_size=COLUMNAR_BATCH_SIZE):
+    """
+    pyarrow record batches of the tokens created on the service dates from
+    start to end, one per page of batch_size rows
+    """
+    schema = columnar_schema()
+    columns = []
+    for name, kind in COLUMNAR_FIELDS:
+        column = getattr(Token, name)
+        # Epoch milliseconds go into the timestamp columns as they are
+        columns.append(epoch_ms(column).label(name) if isinstance(kind, tuple) else column)
+
+    statement = select_tokens(select(*columns), Token, start, end, since)
+
+    for rows in paged_rows(session, statement, token_order(Token, since), batch_size):
+        # Leave out the trailing page keys
+        values = list(zip(*rows))[:len(COLUMNAR_FIELDS)]
+        yield pa.record_batch([list(column) for column in values], schema=schema)
+
+
+def write_columnar(output, batches, export_format='parquet'):
+    """
+    Write record batches as a Parquet file (one row group per batch) or an
+    Arrow IPC file to output, a path or a binary file
+    """
+    if pa is None:
+        raise RuntimeError(f'{export_format.title()} export needs pyarrow (pip install pyarrow)')
+
+    schema = columnar_schema()
+    if export_format == 'parquet':
+        writer = pq.ParquetWriter(output, schema, compression=COLUMNAR_COMPRESSION)
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=COLUMNAR_COMPRESSION)
+        writer = pa.ipc.new_file(output, schema, options=options)
+
+    with writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+def frame_rows(frame):
+    """(header, rows) of a small DataFrame sheet, with missing values as None"""
+    values = frame.astype(object).where(frame.notna(), None)
+    return tuple(frame.columns), values.itertuples(index=False, name=None)
+
+
+def report_progress(items, progress, total, every=EXPORT_BATCH_SIZE, size=None):
+    """
+    Pass items through, calling progress(done, total) about every so many
+    rows and at the end. size(item) is the number of rows in an item, one
+    by default.
+    """
+    done = reported = 0
+    progress(done, total)
+    for item in items:
+        yield item
+        done += size(item) if size else 1
+        if done - reported >= every:
+            progress(done, total)
+            reported = done
+    progress(done, total)
+
+
+def tenths_of_minutes(seconds):
+    """Seconds as minutes to one decimal, rounded the way pandas' round(1) does"""
+    if seconds is None:
+        return None
+    return round(seconds / 60 * 10) / 10
+
+
+def csv_chunks(rows, header=TOKEN_EXPORT_HEADER, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Encoded CSV text of the rows, one chunk per batch_size rows. The header
+    is its own first chunk, so the response starts before the first query.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def flush():
+        chunk = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    writer.writerow(header)
+    yield flush()
+
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending == batch_size:
+            yield flush()
+            pending = 0
+    if pending:
+        yield flush()
+
+
+def write_workbook(output, sheets):
+    """
+    Write sheets, a dict of sheet name to (header, rows), as an xlsx
+    workbook to output (a path or a seekable binary file).
+
+    constant_memory mode flushes each row to disk once the next one is
+    started, so only one row per sheet is held at a time. Database rows
+    should come from paged_rows (token_rows, recovery_rows): writing the
+    cells takes far longer than reading them, and no lock may be held
+    meanwhile.
+    """
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'default_date_format': DATE_FORMAT,
+    })
+    header_format = workbook.add_format(HEADER_FORMAT)
+
+    for sheet_name, (header, rows) in sheets.items():
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.set_column(0, len(header), COLUMN_WIDTH)
+        worksheet.write_row(0, 0, header, header_format)
+        for row_number, row in enumerate(rows, start=1):
+            for col_num, value in enumerate(row):
+                # Missing values are left blank
+                if value is not None:
+                    worksheet.write(row_number, col_num, value)
+
+    workbook.close()
@@ -0,0 +1,103 @@
+# The summary sheets of the Excel export, built with pandas
+
+import pandas as pd
+
+from timestamps import local_naive
+
+
+def summary_sheets(model, staff_members):
+    """
+    The Summary, Day, Hour, Reason and Staff Performance sheets, built from
+    the analytics model the analytics page shows
+    """
+    # Summary Statistics
+    summary_data = {
+        'Metric': [
+            'Total Tokens', 'Tokens Served', 'Tokens Skipped', 'Tokens Pending',
+            'Average Waiting Time (min)', 'Average Service Duration (min)',
+            'Total Recalls', 'Total Skips', 'Skipped Tokens Recovered', 'Recovery Rate (%)'
+        ],
+        'Value': [
+            model['total_tokens'], model['total_served'], model['total_skipped'], model['total_pending'],
+            round(model['avg_waiting_time'], 1), round(model['avg_service_duration'], 1),
+            model['total_recalls'], model['total_skips'], model['total_recovered'], round(model['recovery_rate'], 1)
+        ]
+    }
+    summary_df = pd.DataFrame(summary_data)
+
+    # Day of Week Analysis
+    day_data = []
+    for day, stats in model['day_stats'].items():
+        efficiency = round((stats['served'] / stats['count'] * 100), 1) if stats['count'] > 0 else 0
+        recovery_rate = round((stats['recovered'] / stats['skipped'] * 100), 1) if stats['skipped'] > 0 else 0
+        day_data.append({
+            'Day': day,
+            'Total': stats['count'],
+            'Served': stats['served'],
+            'Skipped': stats['skipped'],
+            'Recovered': stats['recovered'],
+            'Efficiency (%)': efficiency,
+            'Recovery Rate (%)': recovery_rate
+        })
+    day_df = pd.DataFrame(day_data)
+
+    # Hour of Day Analysis
+    hour_data = []
+    for hour, stats in model['hour_stats'].items():
+        efficiency = round((stats['served'] / stats['count'] * 100), 1) if stats['count'] > 0 else 0
+        recovery_rate = round((stats['recovered'] / stats['skipped'] * 100), 1) if stats['skipped'] > 0 else 0
+        hour_data.append({
+            'Hour': f"{hour}:00",
+            'Total': stats['count'],
+            'Served': stats['served'],
+            'Skipped': stats['skipped'],
+            'Recovered': stats['recovered'],
+            'Efficiency (%)': efficiency,
+            'Recovery Rate (%)': recovery_rate
+        })
+    hour_df = pd.DataFrame(hour_data)
+
+    # Visit Reason Analysis
+    reason_data = []
+    for reason, stats in model['reason_stats'].items():
+        recovery_rate = round((stats['recovered'] / stats['skipped'] * 100), 1) if stats['skipped'] > 0 else 0
+        reason_data.append({
+            'Visit Reason': reason,
+            'Total': stats['count'],
+            'Served': stats['served'],
+            'Skipped': stats['skipped'],
+            'Recovered': stats['recovered'],
+            'Pending': stats['pending'],
+            'Recalls': stats['total_recalls'],
+            'Skips': stats['total_skips'],
+            'Avg. Wait (min)': round(stats['avg_waiting_time'], 1),
+            'Avg. Service (min)': round(stats['avg_service_duration'], 1),
+            'Recovery Rate (%)': recovery_rate
+        })
+    reason_df = pd.DataFrame(reason_data)
+
+    # Staff Performance
+    staff_data = []
+    performance = model['staff_performance']
+    for staff in staff_members:
+        service = performance.get(staff.id, {})
+        staff_data.append({
+            'Staff ID': staff.employee_id,
+            'Name': staff.name,
+            'Role': staff.role,
+            'Tokens Served': service.get('served', 0),
+            'Avg. Service Time (min)': round(service.get('avg_service_time', 0), 1),
+            'Service Time Std. Dev. (min)': round(service.get('stdev_service_time', 0), 1),
+            'Avg. Wait (min)': round(model['staff_stats'].get(str(staff.id), {}).get('avg_waiting_time', 0), 1),
+            'Status': 'On Duty' if staff.is_on_duty else 'Off Duty',
+            'Last Login': local_naive(staff.last_login)
+        })
+    staff_df = pd.DataFrame(staff_data)
+
+    return {
+        'Summary': summary_df,
+        'Day Analysis': day_df,
+        'Hour Analysis': hour_df,
+        'Reason Analysis': reason_df,
+        'Staff Performance': staff_df,
+    }
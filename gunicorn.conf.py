@@ -1,18 +1,22 @@
 # Gunicorn config
+import os
+
+# Port (one instance per port when scaling out, see qms@.service)
+port = os.environ.get('QMS_PORT', '5000')
 
 # Socket
-bind = "0.0.0.0:5000"
+bind = f"0.0.0.0:{port}"
 backlog = 2048
 
 # Workers
 worker_class = "eventlet"  # For SocketIO
-workers = 1  # Single worker for SocketIO
+workers = 1  # Single worker per instance for SocketIO; run more instances to scale
 threads = 4
 timeout = 120
 
 # Server
 daemon = False
-pidfile = "/var/run/gunicorn/qms.pid"
+pidfile = "/var/run/gunicorn/qms.pid" if port == '5000' else f"/var/run/gunicorn/qms-{port}.pid"
 umask = 0
 user = "www-data"
 group = "www-data"
@@ -23,7 +27,7 @@ accesslog = "/var/log/gunicorn/qms-access.log"
 loglevel = "info"
 
 # Process
-proc_name = "qms"
+proc_name = "qms" if port == '5000' else f"qms-{port}"
 
 # Hooks
 def on_starting(server):
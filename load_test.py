@@ -0,0 +1,160 @@
+"""
+Load test for the QMS application.
+
+Runs concurrent clients against one or more QMS instances and reports
+throughput. Each client sticks to one instance, like nginx ip_hash.
+
+Examples:
+    # Against running instances
+    python load_test.py --url http://127.0.0.1:5000 --url http://127.0.0.1:5001
+
+    # Start 1, 2 and 4 local instances in turn and compare throughput
+    SOCKETIO_MESSAGE_QUEUE=redis://127.0.0.1:6379/0 python load_test.py --compare 1,2,4
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_client(base_url, deadline, write_ratio, results, lock):
+    """Request the display page, generating a token every so often"""
+    latencies = []
+    errors = 0
+    count = 0
+    writes_due = 0.0
+
+    while time.time() < deadline:
+        writes_due += write_ratio
+        start = time.time()
+        try:
+            if writes_due >= 1:
+                writes_due -= 1
+                data = urllib.parse.urlencode({
+                    'visit_reason': 'reason1',
+                    'customer_name': 'Load Test',
+                    'phone_number': '0000000000'
+                }).encode()
+                urllib.request.urlopen(base_url + '/generate-token', data=data, timeout=30).read()
+            else:
+                urllib.request.urlopen(base_url + '/', timeout=30).read()
+            latencies.append(time.time() - start)
+        except (urllib.error.URLError, OSError):
+            errors += 1
+        count += 1
+
+    with lock:
+        results['requests'] += count
+        results['errors'] += errors
+        results['latencies'].extend(latencies)
+
+
+def run_load(urls, clients, duration, write_ratio):
+    """Run the clients for duration seconds and return the summary"""
+    results = {'requests': 0, 'errors': 0, 'latencies': []}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    threads = [
+        threading.Thread(target=run_client, args=(urls[i % len(urls)], deadline, write_ratio, results, lock))
+        for i in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = sorted(results['latencies'])
+    return {
+        'requests': results['requests'],
+        'errors': results['errors'],
+        'throughput': len(latencies) / duration,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+    }
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/', timeout=2).read()
+            return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    return False
+
+
+def spawn_instances(count, base_port):
+    """Start count single-worker gunicorn instances on consecutive ports"""
+    if count > 1 and not os.environ.get('SOCKETIO_MESSAGE_QUEUE'):
+        print('Warning: SOCKETIO_MESSAGE_QUEUE is not set, broadcasts will not reach other instances')
+
+    processes = []
+    urls = []
+    for port in range(base_port, base_port + count):
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--worker-class', 'eventlet', '-w', '1',
+             '--bind', f'127.0.0.1:{port}', 'wsgi:application'],
+            cwd=APP_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        ))
+        urls.append(f'http://127.0.0.1:{port}')
+
+    for url in urls:
+        if not wait_until_ready(url):
+            stop_instances(processes)
+            raise RuntimeError(f'Instance at {url} did not start')
+    return processes, urls
+
+
+def stop_instances(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def print_summary(label, summary):
+    print(f"{label:>10}  {summary['throughput']:8.1f} req/s  "
+          f"p50 {summary['p50_ms']:6.1f} ms  p95 {summary['p95_ms']:6.1f} ms  "
+          f"errors {summary['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='QMS load test')
+    parser.add_argument('--url', action='append', help='Instance base URL (repeat for several)')
+    parser.add_argument('--compare', help='Comma separated instance counts to start and compare, e.g. 1,2,4')
+    parser.add_argument('--base-port', type=int, default=5100, help='First port for started instances')
+    parser.add_argument('--clients', type=int, default=32, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per run')
+    parser.add_argument('--write-ratio', type=float, default=0.05, help='Fraction of requests that generate a token')
+    args = parser.parse_args()
+
+    if args.compare:
+        for count in [int(value) for value in args.compare.split(',')]:
+            processes, urls = spawn_instances(count, args.base_port)
+            try:
+                summary = run_load(urls, args.clients, args.duration, args.write_ratio)
+            finally:
+                stop_instances(processes)
+            print_summary(f'{count} worker' + ('s' if count > 1 else ''), summary)
+        return 0
+
+    urls = [url.rstrip('/') for url in (args.url or ['http://127.0.0.1:5000'])]
+    summary = run_load(urls, args.clients, args.duration, args.write_ratio)
+    print_summary(f'{len(urls)} url' + ('s' if len(urls) > 1 else ''), summary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Database Migration Script for QMS
+
+This script brings an existing tokens.db up to date with the models:
+it adds declared columns and indexes that are missing from existing tables,
+and converts timestamps stored as IST date/time text to UTC epoch
+milliseconds.
+Every step is idempotent. The application applies the same steps when it
+starts, so running this script is only needed to migrate a database
+without starting the server.
+"""
+
+import os
+import sys
+from sqlalchemy import DateTime, inspect
+
+from timestamps import IST_OFFSET_MS, EpochDateTime
+
+
+def column_default_sql(column):
+    """Render a scalar Python-side column default as a SQL literal"""
+    if column.default is None or not column.default.is_scalar:
+        return None
+
+    value = column.default.arg
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return None
+
+
+def add_missing_columns(db):
+    """Add declared columns that do not exist yet"""
+    inspector = inspect(db.engine)
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+            default = column_default_sql(column)
+            if default is not None:
+                ddl += f' DEFAULT {default}'
+
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(ddl)
+            added.append(f'{table.name}.{column.name}')
+
+    return added
+
+
+def create_missing_indexes(db):
+    """Create declared indexes that do not exist yet"""
+    inspector = inspect(db.engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+    return created
+
+
+def convert_epoch_columns(db):
+    """
+    Convert timestamps stored the old way, as naive IST date/times, to UTC
+    epoch milliseconds (SQLite and PostgreSQL)
+    """
+    dialect = db.engine.dialect.name
+    inspector = inspect(db.engine)
+    converted = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        stored_types = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if not isinstance(column.type, EpochDateTime) or column.name not in stored_types:
+                continue
+
+            stored_type = stored_types[column.name]
+            if dialect == 'sqlite':
+                # Columns keep their declared type, only text values are old
+                ddl = (f"UPDATE {table.name} SET {column.name} = "
+                       f"CAST(round((julianday({column.name}) - 2440587.5) * 86400000) AS INTEGER) - {IST_OFFSET_MS} "
+                       f"WHERE typeof({column.name}) = 'text'")
+            elif dialect == 'postgresql' and isinstance(stored_type, DateTime):
+                offset = 0 if stored_type.timezone else IST_OFFSET_MS
+                ddl = (f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT "
+                       f"USING CAST(round(EXTRACT(EPOCH FROM {column.name}) * 1000) AS BIGINT) - {offset}")
+            else:
+                continue
+
+            with db.engine.begin() as connection:
+                result = connection.exec_driver_sql(ddl)
+            if dialect != 'sqlite' or result.rowcount:
+                converted.append(f'{table.name}.{column.name}')
+
+    return converted
+
+
+def upgrade_database(db):
+    """Run every migration step, returning a list of what changed"""
+    changes = []
+
+    for name in add_missing_columns(db):
+        changes.append(f"Added column {name}")
+
+    for name in create_missing_indexes(db):
+        changes.append(f"Created index {name}")
+
+    for name in convert_epoch_columns(db):
+        changes.append(f"Converted timestamps of {name} to epoch milliseconds")
+
+    return changes
+
+
+if __name__ == "__main__":
+    # Check production mode
+    if os.environ.get('PRODUCTION', 'False').lower() == 'true':
+        confirm = input("You are running this script in PRODUCTION mode. Are you sure you want to continue? (y/n): ")
+        if confirm.lower() != 'y':
+            print("Migration cancelled.")
+            sys.exit(0)
+
+    print("Starting database migration...")
+
+    # Importing the app applies pending migrations
+    from app import app, db
+
+    # Verify
+    with app.app_context():
+        remaining = upgrade_database(db)
+        for change in remaining:
+            print(change)
+        print("Migration complete. Database schema is up to date.")
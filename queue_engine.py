@@ -0,0 +1,266 @@
+# Queue state engine
+
+import bisect
+import threading
+
+from timestamps import to_epoch_ms
+
+# Statuses kept in the live queue
+QUEUE_STATUSES = ('PENDING', 'SKIPPED')
+
+
+class QueueEntry:
+    """Lightweight copy of the token fields the live queue needs"""
+    __slots__ = ('id', 'token_number', 'customer_name', 'visit_reason',
+                 'recall_count', 'status', 'last_skipped_at')
+
+    def __init__(self, id, token_number, customer_name=None, visit_reason=None,
+                 recall_count=0, status='PENDING', last_skipped_at=None):
+        self.id = id
+        self.token_number = token_number
+        self.customer_name = customer_name
+        self.visit_reason = visit_reason
+        self.recall_count = recall_count or 0
+        self.status = status
+        self.last_skipped_at = last_skipped_at
+
+    @property
+    def skip_key(self):
+        """Sort key for the skipped list (epoch milliseconds, id)"""
+        skipped_at = to_epoch_ms(self.last_skipped_at)
+        return (0 if skipped_at is None else skipped_at, self.id)
+
+
+class QueueEngine:
+    """
+    Process-resident view of the live queue.
+
+    Holds the pending ids in id order, the skipped tokens ordered by
+    last_skipped_at and the current token pointer, so current/next/skipped
+    lookups never scan the tokens table. The engine is loaded once from the
+    database and then fed every committed change through apply().
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.version = 0
+        self.queue_active = True
+        self._current_id = 0
+        self._missing_id = 0
+        self._entries = {}
+        self._pending = []
+        self._skipped = []
+
+    # Loading
+    def invalidate(self):
+        """Drop all state so the next read reloads from the database"""
+        with self._lock:
+            version = self.version
+            self._reset()
+            self.version = version
+
+    def load(self, entries, current_id, queue_active, version=0):
+        with self._lock:
+            self._reset()
+            self._current_id = current_id or 0
+            self.queue_active = bool(queue_active)
+            for entry in entries:
+                self._add(entry)
+            self.loaded = True
+            self.version = version
+
+    # Reads
+    @property
+    def current_id(self):
+        return self._current_id
+
+    def current_entry(self):
+        with self._lock:
+            return self._entries.get(self._current_id)
+
+    def needs_current(self):
+        """True when the current token is set but not tracked yet"""
+        with self._lock:
+            current_id = self._current_id
+            return bool(current_id) and current_id not in self._entries and current_id != self._missing_id
+
+    def get(self, token_id):
+        with self._lock:
+            return self._entries.get(token_id)
+
+    def next_id(self, current_id=None, exclude=()):
+        """
+        Id of the next pending token after the current one (wraps around).
+
+        current_id and exclude let callers ask what the next token will be
+        once a pending change is committed.
+        """
+        with self._lock:
+            pending = self._pending
+            if exclude:
+                pending = [token_id for token_id in pending if token_id not in exclude]
+            if not pending:
+                return None
+            if current_id is None:
+                current_id = self._current_id
+            if not current_id:
+                return pending[0]
+
+            # First pending token with a higher id
+            index = bisect.bisect_right(pending, current_id)
+            if index < len(pending):
+                return pending[index]
+
+            # Otherwise the first pending token with a lower id
+            if pending[0] < current_id:
+                return pending[0]
+            return None
+
+    def next_entry(self):
+        with self._lock:
+            next_id = self.next_id()
+            return self._entries.get(next_id) if next_id else None
+
+    def pending_ids(self):
+        with self._lock:
+            return list(self._pending)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def pending(self):
+        """Pending entries in queue order"""
+        with self._lock:
+            return [self._entries[token_id] for token_id in self._pending]
+
+    def skipped(self, limit=10):
+        """Skipped entries, most recently skipped first"""
+        with self._lock:
+            keys = self._skipped[::-1]
+            if limit is not None:
+                keys = keys[:limit]
+            return [self._entries[token_id] for _, token_id in keys]
+
+    # Updates
+    def apply(self, changes, version=None):
+        """
+        Apply a batch of committed changes and record the queue version
+        they were committed under.
+
+        Each change is one of:
+            ('settings', current_token_id, queue_active)
+            ('token', QueueEntry)
+            ('delete', token_id)
+        Settings changes are applied first so token entries see the final
+        current pointer. A version that does not directly follow the
+        engine's means changes were committed elsewhere (another worker),
+        so the engine drops its state and reloads instead.
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            if version is not None and version != self.version + 1:
+                self.invalidate()
+                return
+
+            previous_current = self._current_id
+            for change in changes:
+                if change[0] == 'settings':
+                    self._current_id = change[1] or 0
+                    self.queue_active = bool(change[2])
+
+            for change in changes:
+                if change[0] == 'token':
+                    self._remove(change[1].id)
+                    self._add(change[1])
+                elif change[0] == 'delete':
+                    self._remove(change[1])
+
+            # Forget the old current token once it leaves the queue
+            if previous_current != self._current_id:
+                entry = self._entries.get(previous_current)
+                if entry and entry.status not in QUEUE_STATUSES:
+                    self._remove(previous_current)
+
+            if version is not None:
+                self.version = version
+
+    def track(self, entry):
+        """Track a token outside the queue statuses (e.g. the current one)"""
+        with self._lock:
+            if not self.loaded:
+                return
+            self._remove(entry.id)
+            self._add(entry, force=True)
+
+    def track_missing(self, token_id):
+        """Remember that the current token no longer exists"""
+        with self._lock:
+            self._missing_id = token_id
+
+    def _add(self, entry, force=False):
+        if entry.status == 'PENDING':
+            bisect.insort(self._pending, entry.id)
+        elif entry.status == 'SKIPPED':
+            bisect.insort(self._skipped, entry.skip_key)
+        elif not force and entry.id != self._current_id:
+            return
+        self._entries[entry.id] = entry
+
+    def _remove(self, token_id):
+        entry = self._entries.pop(token_id, None)
+        if entry is None:
+            return
+        if entry.status == 'PENDING':
+            index = bisect.bisect_left(self._pending, token_id)
+            if index < len(self._pending) and self._pending[index] == token_id:
+                del self._pending[index]
+        elif entry.status == 'SKIPPED':
+            key = entry.skip_key
+            index = bisect.bisect_left(self._skipped, key)
+            if index < len(self._skipped) and self._skipped[index] == key:
+                del self._skipped[index]
+
+
+def list_item_key(item):
+    return tuple(sorted(item.items()))
+
+
+def list_delta(old_items, new_items):
+    """
+    Entries that left a list and entries that joined it with their final
+    positions, so clients can patch the list in place.
+    """
+    old_keys = {list_item_key(item) for item in old_items}
+    new_keys = {list_item_key(item) for item in new_items}
+    return {
+        'removed': [item for item in old_items if list_item_key(item) not in new_keys],
+        'added': [
+            {'index': index, 'token': item}
+            for index, item in enumerate(new_items)
+            if list_item_key(item) not in old_keys
+        ]
+    }
+
+
+def queue_status_delta(old, new):
+    """
+    Fields of a queue_status payload that changed between two snapshots.
+
+    Scalar fields are sent whole and list fields (skipped_tokens,
+    pending_tokens) as a list delta.
+    """
+    changes = {}
+    for field, value in new.items():
+        if field == 'version' or old.get(field) == value:
+            continue
+        if isinstance(value, list):
+            changes[field] = list_delta(old.get(field) or [], value)
+        else:
+            changes[field] = value
+
+    return changes
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Analytics Rollup Rebuild Script for QMS
+
+The analytics page and the Excel export read pre-aggregated rollup tables
+that every token change keeps up to date. This script recomputes them from
+the tokens table, e.g. after editing tokens with raw SQL. A rebuild also
+recomputes the staff statistics from the served tokens.
+
+Usage:
+    python rebuild_rollups.py          # Recompute and replace the rollups
+    python rebuild_rollups.py --check  # Only report rows that differ
+"""
+
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the QMS analytics rollups')
+    parser.add_argument('--check', action='store_true', help='Compare with the tokens table without writing')
+    args = parser.parse_args()
+
+    from app import app, db, Token, Settings, Employee, StaffDailyStats, increment_settings, rollup_models
+    from rollups import check_rollups, rebuild_rollups
+    from staff_stats import rebuild_staff_stats
+
+    with app.app_context():
+        differences = check_rollups(db.session, Token, rollup_models)
+        for difference in differences:
+            print(difference)
+
+        if args.check:
+            print(f"{len(differences)} difference(s) found.")
+            return 1 if differences else 0
+
+        rows = rebuild_rollups(db.session, Token, rollup_models)
+        staff_rows = rebuild_staff_stats(db.session, Token, Employee, StaffDailyStats)
+        # Running workers drop their cached analytics on the new data version
+        increment_settings(Settings.queue_version)
+        db.session.commit()
+        print(f"Rebuilt {rows} rollup rows ({len(differences)} difference(s) corrected) "
+              f"and {staff_rows} staff statistics rows.")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
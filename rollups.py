@@ -0,0 +1,412 @@
+# Analytics rollups: token counts and totals pre-aggregated per service day
+
+from collections import Counter
+
+from sqlalchemy import delete, func, insert, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from analytics import recovered_tokens
+from sketches import QuantileSketch, sketch_bucket
+from timestamps import local_time
+
+# Token columns the rollups are computed from
+ROLLUP_FIELDS = (
+    'created_at', 'status', 'served_at', 'service_duration', 'skip_count',
+    'recall_count', 'waiting_seconds', 'visit_reason', 'staff_id'
+)
+
+# Summed in every rollup row
+ROLLUP_METRICS = (
+    'token_count', 'served_count', 'completed_count', 'skipped_count',
+    'skipped_only_count', 'pending_count', 'pending_only_count', 'recovered_count',
+    'waiting_minutes', 'service_seconds', 'completed_service_seconds',
+    'recall_count', 'skip_count'
+)
+
+# Percentile sketches: groups they are kept for, and the percentiles shown
+SKETCH_DIMENSIONS = ('reason', 'hour', 'staff')
+PERCENTILES = (50, 90, 99)
+
+
+def rollup_keys(values):
+    """The row of each rollup table a token is counted in"""
+    created_at = local_time(values['created_at'])
+    service_date = created_at.date()
+    return {
+        'daily': (service_date,),
+        'hourly': (service_date, created_at.hour),
+        'reason': (service_date, values['visit_reason']),
+        'staff': (service_date, values['staff_id'] or ''),
+    }
+
+
+def rollup_metrics(values):
+    """
+    What one token adds to the rows it is counted in, using the same
+    status buckets as the analytics page and the export.
+    """
+    status = values['status']
+    skip_count = values['skip_count'] or 0
+    served = status == 'SERVED'
+    completed = served and values['served_at'] is not None
+    skipped = status == 'SKIPPED' or skip_count > 0
+    service_duration = values['service_duration'] or 0
+
+    waiting = None
+    if served and values['waiting_seconds'] is not None:
+        waiting = values['waiting_seconds'] // 60
+
+    return {
+        'token_count': 1,
+        'served_count': int(served),
+        'completed_count': int(completed),
+        'skipped_count': int(skipped),
+        'skipped_only_count': int(skipped and not served),
+        'pending_count': int(status == 'PENDING'),
+        'pending_only_count': int(status == 'PENDING' and skip_count == 0),
+        'recovered_count': int(served and skip_count > 0),
+        'waiting_minutes': waiting or 0,
+        'service_seconds': service_duration if served else 0,
+        'completed_service_seconds': service_duration if completed else 0,
+        'recall_count': values['recall_count'] or 0,
+        'skip_count': skip_count,
+    }
+
+
+def sketch_samples(values):
+    """The waiting and service seconds a served token adds to the sketches"""
+    if values['status'] != 'SERVED' or values['served_at'] is None or values['waiting_seconds'] is None:
+        return {}
+
+    samples = {'waiting': values['waiting_seconds']}
+    if values['service_duration'] is not None:
+        samples['service'] = values['service_duration']
+    return samples
+
+
+def sketch_groups(values):
+    groups = {
+        'reason': values['visit_reason'],
+        'hour': str(local_time(values['created_at']).hour),
+    }
+    if values['staff_id']:
+        groups['staff'] = values['staff_id']
+    return groups
+
+
+def add_token(deltas, values, sign=1):
+    """Add a token to the pending deltas, or remove it with sign=-1"""
+    if values['created_at'] is None:
+        return
+
+    metrics = rollup_metrics(values)
+    for dimension, key in rollup_keys(values).items():
+        row = deltas.setdefault((dimension, key), dict.fromkeys(ROLLUP_METRICS, 0))
+        for name, value in metrics.items():
+            row[name] += sign * value
+
+    # Sketch deltas are bucket counts
+    service_date = local_time(values['created_at']).date()
+    for metric, value in sketch_samples(values).items():
+        bucket = sketch_bucket(value)
+        for dimension, group in sketch_groups(values).items():
+            counts = deltas.setdefault(('sketch', (service_date, dimension, group, metric)), Counter())
+            counts[bucket] += sign
+
+
+def rollup_values(token, previous=False):
+    """A token's rollup inputs, or with previous=True the ones last flushed"""
+    state = inspect(token)
+    values = {}
+    for name in ROLLUP_FIELDS:
+        history = state.attrs[name].history
+        if previous and history.deleted:
+            values[name] = history.deleted[0]
+        else:
+            values[name] = getattr(token, name)
+    return values
+
+
+def rollup_inputs_changed(token):
+    state = inspect(token)
+    return any(state.attrs[name].history.has_changes() for name in ROLLUP_FIELDS)
+
+
+def apply_rollup_deltas(session, models, deltas):
+    """Add the pending deltas to the rollup rows, creating missing rows"""
+    dialect = session.get_bind().dialect.name
+
+    for (dimension, key), metrics in deltas.items():
+        changes = {name: value for name, value in metrics.items() if value}
+        if not changes:
+            continue
+
+        model = models[dimension]
+        table = model.__table__
+        key_values = dict(zip(model.key_columns, key))
+
+        if dimension == 'sketch':
+            apply_sketch_delta(session, table, key_values, changes, dialect)
+            continue
+
+        if dialect in ('sqlite', 'postgresql'):
+            dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            statement = dialect_insert(table).values(**key_values, **changes)
+            statement = statement.on_conflict_do_update(
+                index_elements=list(model.key_columns),
+                set_={name: table.c[name] + statement.excluded[name] for name in changes}
+            )
+            session.execute(statement)
+            continue
+
+        # Other databases: update the row, insert it if it is new
+        result = session.execute(
+            update(table)
+            .where(*[table.c[column] == value for column, value in key_values.items()])
+            .values({name: table.c[name] + value for name, value in changes.items()})
+        )
+        if result.rowcount == 0:
+            session.execute(insert(table).values(**key_values, **changes))
+
+
+def apply_sketch_delta(session, table, key_values, buckets, dialect):
+    """Add bucket counts to a stored sketch, read and written under a row lock"""
+    where = [table.c[column] == value for column, value in key_values.items()]
+    locked = select(table.c.buckets).where(*where).with_for_update()
+
+    row = session.execute(locked).first()
+    if row is None and dialect in ('sqlite', 'postgresql'):
+        # Create the row first, so concurrent transactions lock the same one
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        session.execute(dialect_insert(table).values(**key_values, buckets='{}').on_conflict_do_nothing())
+        row = session.execute(locked).first()
+
+    sketch = QuantileSketch.from_json(row.buckets if row else None)
+    sketch.update(buckets)
+    values = {'buckets': sketch.to_json(), 'value_count': sketch.count}
+
+    if row is None:
+        session.execute(insert(table).values(**key_values, **values))
+    else:
+        session.execute(update(table).where(*where).values(values))
+
+
+def compute_rollups(session, Token):
+    """Rollup rows recomputed from the tokens table"""
+    rows = {}
+    columns = [getattr(Token, name) for name in ROLLUP_FIELDS]
+    for row in session.execute(select(*columns).execution_options(yield_per=1000)):
+        add_token(rows, row._asdict())
+    return rows
+
+
+def rebuild_rollups(session, Token, models):
+    """Replace the stored rollups with ones recomputed from the tokens"""
+    rows = compute_rollups(session, Token)
+
+    for dimension, model in models.items():
+        table = model.__table__
+        session.execute(delete(table))
+        if dimension == 'sketch':
+            values = [
+                dict(zip(model.key_columns, key), buckets=sketch.to_json(), value_count=sketch.count)
+                for (row_dimension, key), counts in rows.items()
+                if row_dimension == dimension
+                for sketch in [QuantileSketch(counts)] if sketch.count
+            ]
+        else:
+            values = [
+                dict(zip(model.key_columns, key), **metrics)
+                for (row_dimension, key), metrics in rows.items()
+                if row_dimension == dimension
+            ]
+        if values:
+            session.execute(insert(table), values)
+
+    return len(rows)
+
+
+def stored_rollups(session, models):
+    rows = {}
+    for dimension, model in models.items():
+        names = ('buckets',) if dimension == 'sketch' else ROLLUP_METRICS
+        columns = [getattr(model, name) for name in model.key_columns + names]
+        for row in session.execute(select(*columns)):
+            key = tuple(row[:len(model.key_columns)])
+            if dimension == 'sketch':
+                rows[(dimension, key)] = QuantileSketch.from_json(row.buckets).buckets
+            else:
+                rows[(dimension, key)] = dict(zip(ROLLUP_METRICS, row[len(model.key_columns):]))
+    return rows
+
+
+def check_rollups(session, Token, models):
+    """
+    Compare the stored rollups with ones recomputed from the tokens and
+    return the differences. Rows left at zero by deleted tokens count as
+    missing.
+    """
+    expected = compute_rollups(session, Token)
+    stored = stored_rollups(session, models)
+    empty = dict.fromkeys(ROLLUP_METRICS, 0)
+
+    differences = []
+    for dimension, key in sorted(set(expected) | set(stored), key=repr):
+        if dimension == 'sketch':
+            want = QuantileSketch(expected.get((dimension, key))).buckets
+            have = stored.get((dimension, key), {})
+            if want != have:
+                differences.append(f'sketch {key}: buckets differ')
+            continue
+
+        want = expected.get((dimension, key), empty)
+        have = stored.get((dimension, key), empty)
+        for name in ROLLUP_METRICS:
+            if want[name] != have[name]:
+                differences.append(f'{dimension} {key}: {name} is {have[name]}, expected {want[name]}')
+    return differences
+
+
+def rollup_analytics(session, Token, models, start=None, end=None):
+    """
+    Template context for the analytics page, read from the rollups of the
+    service dates from start to end (inclusive, None for open ends). Holds
+    the same values as aggregating the tokens table, with recovered counts
+    per group and a staff breakdown added.
+    """
+    Daily, Hourly, Reason, Staff = models['daily'], models['hourly'], models['reason'], models['staff']
+
+    def sums(model):
+        return [func.coalesce(func.sum(getattr(model, name)), 0) for name in ROLLUP_METRICS]
+
+    def in_range(model):
+        conditions = []
+        if start:
+            conditions.append(model.service_date >= start)
+        if end:
+            conditions.append(model.service_date <= end)
+        return conditions
+
+    totals = dict(zip(ROLLUP_METRICS, session.query(*sums(Daily)).filter(*in_range(Daily)).one()))
+    total_served = totals['completed_count']
+
+    if total_served > 0:
+        avg_waiting_time = totals['waiting_minutes'] / total_served
+        avg_service_duration = totals['completed_service_seconds'] / total_served / 60
+        total_recalls = totals['recall_count']
+        total_skips = totals['skip_count']
+    else:
+        avg_waiting_time = 0
+        avg_service_duration = 0
+        total_recalls = 0
+        total_skips = 0
+
+    def group_stats(metrics):
+        return {
+            'count': metrics['token_count'],
+            'served': metrics['served_count'],
+            'skipped': metrics['skipped_only_count'],
+            'recovered': metrics['recovered_count'],
+        }
+
+    # Day of week, in order of first appearance
+    day_stats = {}
+    for row in session.query(Daily).filter(Daily.token_count > 0, *in_range(Daily)).order_by(Daily.service_date):
+        stats = day_stats.setdefault(row.service_date.strftime('%A'), dict.fromkeys(ROLLUP_METRICS, 0))
+        for name in ROLLUP_METRICS:
+            stats[name] += getattr(row, name)
+    day_stats = {day: group_stats(metrics) for day, metrics in day_stats.items()}
+
+    def grouped(model, key):
+        rows = session.query(key, *sums(model)).filter(
+            model.token_count > 0, *in_range(model)
+        ).group_by(key).order_by(func.min(model.service_date), key).all()
+        return [(row[0], dict(zip(ROLLUP_METRICS, row[1:]))) for row in rows]
+
+    hour_stats = {hour: group_stats(metrics) for hour, metrics in grouped(Hourly, Hourly.hour)}
+
+    reason_stats = {}
+    for reason, metrics in grouped(Reason, Reason.visit_reason):
+        served = metrics['served_count']
+        reason_stats[reason] = dict(
+            group_stats(metrics),
+            pending=metrics['pending_only_count'],
+            total_waiting_time=metrics['waiting_minutes'],
+            total_service_duration=metrics['service_seconds'],
+            total_recalls=metrics['recall_count'],
+            total_skips=metrics['skip_count'],
+            avg_waiting_time=metrics['waiting_minutes'] / served if served > 0 else 0,
+            avg_service_duration=metrics['service_seconds'] / served / 60 if served > 0 else 0,
+        )
+
+    staff_stats = {}
+    for staff_id, metrics in grouped(Staff, Staff.staff_id):
+        served = metrics['served_count']
+        if staff_id and served > 0:
+            staff_stats[staff_id] = {
+                'served': served,
+                'avg_waiting_time': metrics['waiting_minutes'] / served,
+                'avg_service_duration': metrics['service_seconds'] / served / 60,
+            }
+
+    skipped_then_served = recovered_tokens(session, Token, start, end)
+    total_recovered = len(skipped_then_served)
+    total_skipped = totals['skipped_count']
+    percentiles = sketch_percentiles(session, models['sketch'], in_range(models['sketch']))
+
+    return {
+        'total_tokens': totals['token_count'],
+        'total_served': total_served,
+        'total_skipped': total_skipped,
+        'total_pending': totals['pending_count'],
+        'avg_waiting_time': avg_waiting_time,
+        'avg_service_duration': avg_service_duration,
+        'total_recalls': total_recalls,
+        'total_skips': total_skips,
+        'day_stats': day_stats,
+        'hour_stats': hour_stats,
+        'reason_stats': reason_stats,
+        'staff_stats': staff_stats,
+        'percentiles': percentiles,
+        'skipped_then_served': skipped_then_served,
+        'total_recovered': total_recovered,
+        'recovery_rate': (total_recovered / total_skipped * 100) if total_skipped > 0 else 0,
+        'avg_recovery_time': sum(token['recovery_time'] or 0 for token in skipped_then_served) / total_recovered if total_recovered > 0 else 0,
+    }
+
+
+def sketch_percentiles(session, Sketch, conditions=()):
+    """
+    Waiting and service time percentiles in minutes, overall and per
+    reason, hour and staff member, merged from the daily sketches:
+    {'overall': {'waiting': {50: ..., 90: ..., 99: ...}, 'service': ...},
+     'reason': {reason: {'count': ..., 'waiting': ..., 'service': ...}}, ...}
+    """
+    merged = {}
+    for row in session.query(Sketch.dimension, Sketch.group_key, Sketch.metric, Sketch.buckets).filter(
+        Sketch.value_count > 0, *conditions
+    ):
+        sketch = QuantileSketch.from_json(row.buckets)
+        merged.setdefault((row.dimension, row.group_key, row.metric), QuantileSketch()).merge(sketch)
+        # Every served token is in exactly one hour
+        if row.dimension == 'hour':
+            merged.setdefault(('overall', None, row.metric), QuantileSketch()).merge(sketch)
+
+    def minutes(sketch):
+        return {p: sketch.quantile(p / 100) / 60 for p in PERCENTILES}
+
+    result = {'overall': {}}
+    result.update({dimension: {} for dimension in SKETCH_DIMENSIONS})
+    for (dimension, group, metric), sketch in sorted(merged.items(), key=lambda item: repr(item[0])):
+        if dimension == 'overall':
+            result['overall'][metric] = minutes(sketch)
+            continue
+        if dimension == 'hour':
+            group = int(group)
+        stats = result[dimension].setdefault(group, {'count': 0})
+        stats[metric] = minutes(sketch)
+        if metric == 'waiting':
+            stats['count'] = sketch.count
+
+    result['hour'] = dict(sorted(result['hour'].items()))
+    return result
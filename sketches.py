@@ -0,0 +1,86 @@
+# Mergeable quantile sketch for waiting and service time percentiles
+
+import json
+import math
+
+# Quantiles are within this fraction of the true value
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+# Bucket for values under one (second), reported as zero
+ZERO_BUCKET = -1
+
+
+def sketch_bucket(value):
+    """The bucket a value is counted in"""
+    if value < 1:
+        return ZERO_BUCKET
+    return math.ceil(math.log(value) / LOG_GAMMA)
+
+
+def bucket_value(bucket):
+    """The value a bucket stands for, within the relative accuracy of all its values"""
+    if bucket == ZERO_BUCKET:
+        return 0.0
+    return 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+class QuantileSketch:
+    """
+    Log-bucketed quantile sketch (DDSketch style).
+
+    Values are counted in buckets whose bounds grow by a fixed ratio, so
+    any quantile is within RELATIVE_ACCURACY of the exact one. Sketches
+    merge by adding bucket counts, and a value can be removed exactly,
+    which lets the rollups take back a token whose status is reverted.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = {}
+        if buckets:
+            self.update(buckets)
+
+    @classmethod
+    def from_json(cls, data):
+        if not data:
+            return cls()
+        return cls({int(bucket): count for bucket, count in json.loads(data).items()})
+
+    def to_json(self):
+        return json.dumps({str(bucket): count for bucket, count in sorted(self.buckets.items())},
+                          separators=(',', ':'))
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def add(self, value, count=1):
+        self.update({sketch_bucket(value): count})
+
+    def update(self, buckets):
+        """Add bucket counts (negative to remove values)"""
+        for bucket, count in buckets.items():
+            total = self.buckets.get(bucket, 0) + count
+            if total:
+                self.buckets[bucket] = total
+            else:
+                self.buckets.pop(bucket, None)
+
+    def merge(self, other):
+        self.update(other.buckets)
+        return self
+
+    def quantile(self, q):
+        """The value at quantile q (0 to 1), None for an empty sketch"""
+        count = self.count
+        if count <= 0:
+            return None
+
+        rank = q * (count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return bucket_value(bucket)
+        return bucket_value(max(self.buckets))
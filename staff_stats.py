@@ -0,0 +1,220 @@
+# Staff service time statistics, kept with atomic SQL updates
+
+import math
+from collections import defaultdict
+
+from sqlalchemy import case, delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from timestamps import local_time
+
+# (count, mean, m2) of no values
+EMPTY_STATE = (0, 0.0, 0.0)
+
+
+def welford_step(count, mean, m2, value):
+    """
+    Column values that add one value to a running (count, mean, m2) state
+    with Welford's algorithm. Every expression reads the old row, so
+    concurrent updates of one row are applied one after the other by the
+    database instead of overwriting each other.
+    """
+    count, mean, m2 = (func.coalesce(column, 0) for column in (count, mean, m2))
+    delta = value - mean
+    return count + 1, mean + delta / (count + 1.0), m2 + delta * delta * count / (count + 1.0)
+
+
+def welford_removal(count, mean, m2, value):
+    """
+    Column values that take one value added by welford_step back out of a
+    running (count, mean, m2) state. Removing the last value leaves the
+    empty state.
+    """
+    count, mean, m2 = (func.coalesce(column, 0) for column in (count, mean, m2))
+    delta = value - mean
+    mean_after = mean - delta / (count - 1.0)
+    remaining = count > 1
+    return (
+        case((remaining, count - 1), else_=0),
+        case((remaining, mean_after), else_=0.0),
+        case((remaining, m2 - delta * (value - mean_after)), else_=0.0),
+    )
+
+
+def add_value(state, value):
+    """welford_step on a (count, mean, m2) tuple"""
+    count, mean, m2 = state
+    delta = value - mean
+    return count + 1, mean + delta / (count + 1), m2 + delta * delta * count / (count + 1)
+
+
+def remove_value(state, value):
+    """welford_removal on a (count, mean, m2) tuple"""
+    count, mean, m2 = state
+    if count <= 1:
+        return EMPTY_STATE
+    delta = value - mean
+    mean_after = mean - delta / (count - 1)
+    return count - 1, mean_after, m2 - delta * (value - mean_after)
+
+
+def merge_states(states):
+    """Combine (count, mean, m2) states, e.g. of several days (Chan et al.)"""
+    count, mean, m2 = 0, 0.0, 0.0
+    for other_count, other_mean, other_m2 in states:
+        if not other_count:
+            continue
+        total = count + other_count
+        delta = other_mean - mean
+        mean += delta * other_count / total
+        m2 += other_m2 + delta * delta * count * other_count / total
+        count = total
+    return count, mean, m2
+
+
+def standard_deviation(count, m2):
+    """Sample standard deviation of a (count, m2) state"""
+    if count < 2:
+        return 0.0
+    return math.sqrt(max(m2, 0.0) / (count - 1))
+
+
+def record_service(session, Employee, StaffDailyStats, employee_id, token):
+    """
+    Credit a served token to an employee: the overall counters on the
+    employee (service time in minutes) and the row of the token's service
+    date (in seconds).
+    """
+    seconds = token.service_duration
+
+    values = {Employee.tokens_served: func.coalesce(Employee.tokens_served, 0) + 1}
+    if seconds is not None:
+        columns = (Employee.service_count, Employee.avg_service_time, Employee.service_m2)
+        values.update(zip(columns, welford_step(*columns, seconds / 60)))
+    session.execute(update(Employee).where(Employee.id == employee_id).values(values))
+
+    table = StaffDailyStats.__table__
+    key = {'employee_id': employee_id, 'service_date': local_time(token.created_at).date()}
+    columns = (table.c.service_count, table.c.service_mean, table.c.service_m2)
+    changes = {table.c.served_count: table.c.served_count + 1}
+    if seconds is not None:
+        changes.update(zip(columns, welford_step(*columns, seconds)))
+
+    first = add_value(EMPTY_STATE, seconds) if seconds is not None else EMPTY_STATE
+    new_row = dict(key, served_count=1, service_count=first[0], service_mean=first[1], service_m2=first[2])
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = dialect_insert(table).values(**new_row)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(key),
+            set_={column.name: value for column, value in changes.items()}
+        )
+        session.execute(statement)
+        return
+
+    # Other databases: update the row, insert it if it is new
+    where = [table.c[name] == value for name, value in key.items()]
+    if session.execute(update(table).where(*where).values(changes)).rowcount == 0:
+        session.execute(insert(table).values(**new_row))
+
+
+def remove_service(session, Employee, StaffDailyStats, employee_id, token):
+    """
+    Take back the record_service credit of a token, e.g. when a served
+    token is reverted, so serving it again does not count it twice
+    """
+    seconds = token.service_duration
+
+    served = func.coalesce(Employee.tokens_served, 0)
+    values = {Employee.tokens_served: case((served > 0, served - 1), else_=0)}
+    if seconds is not None:
+        columns = (Employee.service_count, Employee.avg_service_time, Employee.service_m2)
+        values.update(zip(columns, welford_removal(*columns, seconds / 60)))
+    session.execute(update(Employee).where(Employee.id == employee_id).values(values))
+
+    table = StaffDailyStats.__table__
+    changes = {table.c.served_count: case((table.c.served_count > 0, table.c.served_count - 1), else_=0)}
+    if seconds is not None:
+        columns = (table.c.service_count, table.c.service_mean, table.c.service_m2)
+        changes.update(zip(columns, welford_removal(*columns, seconds)))
+    session.execute(update(table).where(
+        table.c.employee_id == employee_id,
+        table.c.service_date == local_time(token.created_at).date()
+    ).values(changes))
+
+
+def rebuild_staff_stats(session, Token, Employee, StaffDailyStats):
+    """
+    Recompute the staff statistics from the served tokens, crediting each
+    to its staff_id. Returns the number of daily rows.
+    """
+    daily = defaultdict(lambda: [0, EMPTY_STATE])
+    statement = select(Token.staff_id, Token.created_at, Token.service_duration).where(
+        Token.status == 'SERVED', Token.staff_id.isnot(None)
+    ).order_by(Token.id).execution_options(yield_per=1000)
+    for staff_id, created_at, seconds in session.execute(statement):
+        if not str(staff_id).isdigit() or created_at is None:
+            continue
+        row = daily[(int(staff_id), local_time(created_at).date())]
+        row[0] += 1
+        if seconds is not None:
+            row[1] = add_value(row[1], seconds)
+
+    session.execute(delete(StaffDailyStats))
+    rows = [
+        dict(employee_id=employee_id, service_date=service_date, served_count=served,
+             service_count=state[0], service_mean=state[1], service_m2=state[2])
+        for (employee_id, service_date), (served, state) in daily.items()
+    ]
+    if rows:
+        session.execute(insert(StaffDailyStats), rows)
+
+    days = defaultdict(list)
+    for (employee_id, _), row in daily.items():
+        days[employee_id].append(row)
+
+    for employee in session.query(Employee):
+        count, mean, m2 = merge_states(state for _, state in days[employee.id])
+        employee.tokens_served = sum(served for served, _ in days[employee.id])
+        employee.service_count = count
+        # Employee stats are in minutes
+        employee.avg_service_time = mean / 60
+        employee.service_m2 = m2 / 3600
+    return len(rows)
+
+
+def staff_service_stats(session, StaffDailyStats, start=None, end=None):
+    """
+    Served count and service time mean and standard deviation (minutes)
+    per employee id over the service dates from start to end
+    """
+    conditions = []
+    if start:
+        conditions.append(StaffDailyStats.service_date >= start)
+    if end:
+        conditions.append(StaffDailyStats.service_date <= end)
+
+    days = defaultdict(list)
+    for row in session.query(StaffDailyStats).filter(*conditions):
+        days[row.employee_id].append(row)
+
+    stats = {}
+    for employee_id, rows in days.items():
+        count, mean, m2 = merge_states((row.service_count, row.service_mean, row.service_m2) for row in rows)
+        stats[employee_id] = {
+            'served': sum(row.served_count for row in rows),
+            'avg_service_time': mean / 60,
+            'stdev_service_time': standard_deviation(count, m2) / 60,
+        }
+    return stats
+
+
+def employee_service_stats(employee):
+    """The staff_service_stats entry of an employee's overall counters"""
+    return {
+        'served': employee.tokens_served or 0,
+        'avg_service_time': employee.avg_service_time or 0.0,
+        'stdev_service_time': standard_deviation(employee.service_count or 0, employee.service_m2 or 0.0),
+    }
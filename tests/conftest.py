@@ -22,6 +22,12 @@ class TestConfig:
     ADMIN_PASSWORD = 'test_admin_password'
     TIMEZONE = timezone(timedelta(hours=5, minutes=30))  # IST
 
+@pytest.fixture(autouse=True, scope='session')
+def export_directory(tmp_path_factory):
+    """Write export job files to a temporary directory, not the repository."""
+    from app import export_jobs
+    export_jobs.directory = str(tmp_path_factory.mktemp('exports'))
+
 @pytest.fixture
 def app():
     """Create and configure a Flask app for testing."""
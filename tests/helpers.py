@@ -0,0 +1,119 @@
+"""
+Helpers shared by the test modules: queue and token fixtures and the
+per-row analytics reference.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+
+
+def reset_queue(app, db, Token, Settings, TokenStatusChange, count=3):
+    """Start from an empty queue with a few pending tokens"""
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        TokenStatusChange.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        tokens = [Token(token_number=f'T{i:03d}', visit_reason='reason1', customer_name=f'C{i}') for i in range(1, count + 1)]
+        db.session.add_all(tokens)
+        db.session.commit()
+        return [token.id for token in tokens]
+
+def add_random_tokens(db, Token, count, seed=7):
+    rng = random.Random(seed)
+    start = datetime(2024, 3, 1, 8, 0, 0)
+    for i in range(count):
+        created_at = start + timedelta(days=rng.randint(0, 20), minutes=rng.randint(0, 600), seconds=rng.randint(0, 59))
+        status = rng.choice(['PENDING', 'SERVED', 'SERVED', 'SKIPPED'])
+        skip_count = rng.choice([0, 0, 1, 2])
+        token = Token(
+            token_number=f'A{i:04d}',
+            visit_reason=rng.choice(['reason1', 'reason2', 'Other: walk in']),
+            customer_name=f'C{i}',
+            created_at=created_at,
+            status=status,
+            skip_count=skip_count,
+            recall_count=rng.randint(0, 3),
+        )
+        if status == 'SERVED':
+            token.served_at = created_at + timedelta(seconds=rng.randint(0, 5400))
+            token.service_duration = int((token.served_at - created_at).total_seconds())
+            if skip_count:
+                token.recovery_time = rng.choice([None, 0, rng.randint(0, 3000)])
+            if rng.random() < 0.05:
+                # Rows served before served_at was recorded
+                token.served_at = None
+        db.session.add(token)
+    db.session.commit()
+
+def python_analytics(all_tokens):
+    """The per-row loops enhanced_analytics used before, as the reference"""
+    served_tokens = [t for t in all_tokens if t.status == 'SERVED' and t.served_at is not None]
+    skipped_tokens = [t for t in all_tokens if t.status == 'SKIPPED' or t.skip_count > 0]
+    total_served = len(served_tokens)
+    skipped_then_served = [t for t in served_tokens if t.skip_count > 0]
+
+    result = {
+        'total_tokens': len(all_tokens),
+        'total_served': total_served,
+        'total_skipped': len(skipped_tokens),
+        'total_pending': len([t for t in all_tokens if t.status == 'PENDING']),
+        'avg_waiting_time': sum(t.waiting_time or 0 for t in served_tokens) / total_served if total_served else 0,
+        'avg_service_duration': sum(t.service_duration or 0 for t in served_tokens) / total_served / 60 if total_served else 0,
+        'total_recalls': sum(t.recall_count or 0 for t in all_tokens) if total_served else 0,
+        'total_skips': sum(t.skip_count or 0 for t in all_tokens) if total_served else 0,
+        'total_recovered': len(skipped_then_served),
+        'skipped_then_served': [t.id for t in skipped_then_served],
+    }
+
+    day_stats, hour_stats, reason_stats = {}, {}, {}
+    for token in all_tokens:
+        for stats, key in ((day_stats, token.day_of_week), (hour_stats, token.hour_of_day)):
+            entry = stats.setdefault(key, {'count': 0, 'served': 0, 'skipped': 0})
+            entry['count'] += 1
+            if token.status == 'SERVED':
+                entry['served'] += 1
+            elif token.status == 'SKIPPED' or token.skip_count > 0:
+                entry['skipped'] += 1
+
+        entry = reason_stats.setdefault(token.visit_reason, {
+            'count': 0, 'served': 0, 'skipped': 0, 'pending': 0, 'total_waiting_time': 0,
+            'total_service_duration': 0, 'total_recalls': 0, 'total_skips': 0
+        })
+        entry['count'] += 1
+        entry['total_recalls'] += token.recall_count or 0
+        entry['total_skips'] += token.skip_count or 0
+        if token.status == 'SERVED':
+            entry['served'] += 1
+            entry['total_waiting_time'] += token.waiting_time or 0
+            entry['total_service_duration'] += token.service_duration or 0
+        elif token.status == 'SKIPPED' or token.skip_count > 0:
+            entry['skipped'] += 1
+        elif token.status == 'PENDING':
+            entry['pending'] += 1
+
+    for entry in reason_stats.values():
+        entry['avg_waiting_time'] = entry['total_waiting_time'] / entry['served'] if entry['served'] else 0
+        entry['avg_service_duration'] = entry['total_service_duration'] / entry['served'] / 60 if entry['served'] else 0
+
+    result.update(day_stats=day_stats, hour_stats=hour_stats, reason_stats=reason_stats)
+    return result
+
+def wait_for_job(client, status_url):
+    """Poll a job's status until it stops running"""
+    for _ in range(200):
+        job = client.get(status_url).get_json()['job']
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('Export job did not finish')
+
+def download_export(client, url):
+    """Run an /export-data export, which is written by a background job, and download the file"""
+    response = client.get(url, headers={'Accept': 'application/json'})
+    assert response.status_code == 202
+    job = wait_for_job(client, response.get_json()['status_url'])
+    assert job['status'] == 'finished', job['error']
+    return client.get(job['download_url'])
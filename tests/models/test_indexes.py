@@ -0,0 +1,99 @@
+"""
+Query-plan checks for the hot Token queries.
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+
+def query_plan(db, query):
+    """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=db.engine.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall()
+    return [row[-1] for row in rows]
+
+def assert_no_table_scan(db, query):
+    plan = query_plan(db, query)
+    for detail in plan:
+        if detail.startswith('SCAN tokens'):
+            assert 'INDEX' in detail, f'Full table scan: {plan}'
+    return plan
+
+def test_hot_queries_use_indexes():
+    """Every hot-path Token query is answered from an index."""
+    from app import app, db, Token
+    from migrate_database import upgrade_database
+
+    with app.app_context():
+        db.create_all()
+        upgrade_database(db)
+
+        day_start = datetime(2024, 1, 1)
+        hot_queries = [
+            # Pending queue / next token
+            Token.query.filter_by(status='PENDING').order_by(Token.id),
+            Token.query.filter(Token.id > 5, Token.status == 'PENDING').order_by(Token.id),
+            Token.query.filter(Token.id < 5, Token.status == 'PENDING').order_by(Token.id),
+            # Skipped list
+            Token.query.filter_by(status='SKIPPED').order_by(Token.last_skipped_at.desc()).limit(10),
+            # Employee served history
+            Token.query.filter_by(staff_id='1', status='SERVED').order_by(Token.served_at.desc()).limit(10),
+            # Analytics by creation time
+            Token.query.filter(Token.created_at >= day_start, Token.created_at < day_start + timedelta(days=1)),
+            db.session.query(db.func.date(Token.created_at), db.func.count(Token.id)).group_by(db.func.date(Token.created_at)),
+        ]
+
+        for query in hot_queries:
+            assert_no_table_scan(db, query)
+
+def test_date_range_queries_use_indexes():
+    """Analytics and export for a date range read only that range."""
+    from datetime import date
+    from app import app, db, Token, DailyRollup
+    from analytics import created_between
+    from exports import TOKEN_EXPORT_COLUMNS
+
+    with app.app_context():
+        db.create_all()
+
+        today = date(2024, 1, 1)
+        export_query = db.select(*[getattr(Token, name) for name in TOKEN_EXPORT_COLUMNS]).where(
+            *created_between(Token.created_at, today, today)
+        ).order_by(Token.id)
+        plan = assert_no_table_scan(db, export_query)
+        assert any('ix_tokens_created_at' in detail for detail in plan), plan
+
+        rollup_query = DailyRollup.query.filter(DailyRollup.service_date >= today, DailyRollup.service_date <= today)
+        assert any('SEARCH' in detail for detail in query_plan(db, rollup_query))
+
+        # Incremental export page: a range of the change version index, already in order
+        from exports import select_tokens
+        since_query = select_tokens(db.select(Token.id, Token.token_number), Token, since=10).where(
+            db.tuple_(Token.change_version, Token.id) > db.tuple_(12, 40)
+        ).limit(100)
+        plan = assert_no_table_scan(db, since_query)
+        assert any('ix_tokens_change_version_id' in detail for detail in plan), plan
+        assert not any('TEMP B-TREE' in detail for detail in plan), plan
+
+def test_migration_adds_missing_indexes():
+    """The migration recreates indexes missing from an existing database."""
+    from app import app, db
+    from migrate_database import upgrade_database
+
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS ix_tokens_status_id')
+
+        changes = upgrade_database(db)
+        assert 'Created index ix_tokens_status_id' in changes
+
+        # Running it again is a no-op
+        assert upgrade_database(db) == []
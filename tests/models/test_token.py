@@ -3,7 +3,7 @@ Tests for the Token model.
 """
 
 import pytest
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 def test_token_creation(app, db):
     """Test creating a new token."""
@@ -139,3 +139,84 @@ def test_token_skip(app, db):
         assert skipped_token.skip_count == 1
         assert skipped_token.last_skipped_at is not None
         assert skipped_token.previous_status == 'SERVING'
+
+def test_token_timestamps_stored_as_utc_epoch(app, db):
+    """Timestamps are stored as UTC epoch milliseconds and read back as IST."""
+    from app import Token, IST
+
+    with app.app_context():
+        # Naive datetimes are IST wall-clock times
+        token = Token(token_number='T005', visit_reason='reason1', created_at=datetime(2024, 3, 5, 10, 0, 0, 250000))
+        db.session.add(token)
+        db.session.commit()
+
+        with db.engine.connect() as connection:
+            stored = connection.exec_driver_sql("SELECT created_at FROM tokens WHERE token_number = 'T005'").scalar()
+        assert stored == int(datetime(2024, 3, 5, 4, 30, 0, 250000, tzinfo=timezone.utc).timestamp() * 1000)
+
+        db.session.expire_all()
+        saved_token = Token.query.filter_by(token_number='T005').first()
+        assert saved_token.created_at == datetime(2024, 3, 5, 10, 0, 0, 250000, tzinfo=IST)
+        assert saved_token.created_at.utcoffset() == timedelta(hours=5, minutes=30)
+        assert Token.query.filter(Token.created_at >= datetime(2024, 3, 5, 10, 0)).count() == 1
+
+def test_text_timestamps_migrated_to_epoch(app, db):
+    """Timestamps stored as IST text by older versions are converted in place."""
+    from app import Token, IST
+    from migrate_database import upgrade_database
+
+    with app.app_context():
+        db.session.add(Token(token_number='T006', visit_reason='reason1'))
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(
+                "UPDATE tokens SET created_at = '2024-03-05 10:00:00.250000', served_at = '2024-03-05 10:12:30.000000' "
+                "WHERE token_number = 'T006'"
+            )
+
+        assert 'Converted timestamps of tokens.created_at to epoch milliseconds' in upgrade_database(db)
+        assert upgrade_database(db) == []
+
+        # As on startup, the durations of the migrated rows are filled in
+        from analytics import backfill_durations
+        assert backfill_durations(db.session, Token) == 1
+        db.session.commit()
+
+        db.session.expire_all()
+        token = Token.query.filter_by(token_number='T006').first()
+        assert token.created_at == datetime(2024, 3, 5, 10, 0, 0, 250000, tzinfo=IST)
+        assert token.served_at == datetime(2024, 3, 5, 10, 12, 30, tzinfo=IST)
+        assert token.waiting_time == 12
+
+def test_commits_stamp_change_version(app, db):
+    """Each commit stamps the tokens it wrote with its queue version."""
+    from app import Token, Settings, stored_queue_version
+
+    with app.app_context():
+        if not Settings.query.first():
+            db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0))
+            db.session.commit()
+
+        first = Token(token_number='T007', visit_reason='reason1')
+        second = Token(token_number='T008', visit_reason='reason1')
+        db.session.add_all([first, second])
+        db.session.commit()
+        version = stored_queue_version()
+        assert first.change_version == second.change_version == version
+
+        # Settings-only commits leave the tokens alone
+        Settings.query.first().queue_active = False
+        db.session.commit()
+        assert stored_queue_version() > version
+        assert first.change_version == version
+
+        second.status = 'SERVED'
+        db.session.commit()
+        assert second.change_version == stored_queue_version()
+        assert first.change_version == version
+
+        # Bulk updates are stamped as well
+        Token.query.filter_by(id=first.id).update({'recall_count': 1}, synchronize_session=False)
+        db.session.commit()
+        assert first.change_version == stored_queue_version() > second.change_version
@@ -107,3 +107,49 @@ def test_generate_token_submission():
             assert token.visit_reason == 'test_reason'
             assert token.phone_number == '1234567890'
             assert token.status == 'PENDING'
+
+def test_concurrent_token_numbers_are_unique():
+    """Parallel kiosks never receive the same token number."""
+    import threading
+    from app import app, db, Token, Settings, queue_engine, get_queue_engine
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        db.session.commit()
+        get_queue_engine()
+
+    kiosks = 6
+    per_kiosk = 10
+    errors = []
+
+    def kiosk():
+        with app.test_client() as client:
+            for _ in range(per_kiosk):
+                response = client.post('/generate-token', data={
+                    'visit_reason': 'reason1',
+                    'customer_name': 'Rush Customer',
+                    'phone_number': '1234567890'
+                })
+                if response.status_code != 302:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=kiosk) for _ in range(kiosks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+
+    with app.app_context():
+        numbers = [token.token_number for token in Token.query.all()]
+        assert len(numbers) == kiosks * per_kiosk
+        assert len(set(numbers)) == len(numbers)
+        assert Settings.query.first().last_token_number == kiosks * per_kiosk
+
+        # Allocation does not force the queue engine to reload
+        assert queue_engine.loaded
+        assert queue_engine.pending_count() == kiosks * per_kiosk
@@ -0,0 +1,80 @@
+"""
+Tests for the JSON queue action API.
+"""
+
+import os
+import sys
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import reset_queue
+
+
+def test_queue_api_requires_staff():
+    """Anonymous clients cannot run queue actions."""
+    from app import app
+
+    with app.test_client() as client:
+        response = client.post('/api/queue/next')
+        assert response.status_code == 403
+        assert response.get_json()['success'] is False
+
+def test_queue_api_returns_new_state():
+    """Each action returns its messages and the updated queue state."""
+    from app import app, db, Token, Settings, TokenStatusChange
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['employee_id'] = 1
+            sess['employee_role'] = 'employee'
+
+        result = client.post('/api/queue/next').get_json()
+        assert result['success'] is True
+        assert result['queue']['current_token']['token_number'] == 'T001'
+        assert result['queue']['next_token'] == {'token_number': 'T002', 'id': ids[1]}
+
+        result = client.post('/api/queue/skip').get_json()
+        assert result['messages'] == [{'category': 'warning', 'message': 'Token T001 has been skipped'}]
+        assert result['queue']['current_token']['token_number'] == 'T002'
+        assert [token['id'] for token in result['queue']['skipped_tokens']] == [ids[0]]
+
+        result = client.post(f'/api/queue/recover/{ids[0]}').get_json()
+        assert result['success'] is True
+        assert result['queue']['skipped_tokens'] == []
+        assert [token['id'] for token in result['queue']['pending_tokens']] == ids
+
+        result = client.post('/api/queue/mark-served').get_json()
+        assert result['queue']['current_token'] is None
+
+        # A refused action reports an error and leaves the state alone
+        result = client.post('/api/queue/recall').get_json()
+        assert result['success'] is False
+        assert result['messages'][0]['category'] == 'error'
+
+        result = client.post(f'/api/queue/serve/{ids[2]}').get_json()
+        assert result['queue']['current_token']['token_number'] == 'T003'
+
+    with app.app_context():
+        assert db.session.get(Token, ids[1]).status == 'SERVED'
+        assert db.session.get(Token, ids[1]).staff_id == '1'
+
+def test_queue_api_rejects_bad_requests():
+    """Unknown actions and missing token ids are rejected."""
+    from app import app
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        assert client.post('/api/queue/unknown').status_code == 404
+        assert client.post('/api/queue/serve').status_code == 400
+        assert client.post('/api/queue/next/5').status_code == 400
+        assert client.get('/api/queue/next').status_code == 405
+
+        # Unknown tokens get a JSON error, not an HTML 404 page
+        response = client.post('/api/queue/serve/999999')
+        assert response.status_code == 404
+        assert response.get_json()['success'] is False
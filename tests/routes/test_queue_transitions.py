@@ -0,0 +1,105 @@
+"""
+Tests for single-transaction queue actions.
+"""
+
+import os
+import sys
+from sqlalchemy import event
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import reset_queue
+
+
+def count_commits(db, client, url, method='get', **kwargs):
+    """Run a request and return how many commits it made"""
+    commits = []
+
+    def on_commit(session):
+        commits.append(session)
+
+    event.listen(db.session, 'after_commit', on_commit)
+    try:
+        response = getattr(client, method)(url, **kwargs)
+    finally:
+        event.remove(db.session, 'after_commit', on_commit)
+    assert response.status_code == 302
+    return len(commits)
+
+def test_staff_actions_commit_once():
+    """next/skip/serve/recover/revert/served each run as one transaction."""
+    from app import app, db, Token, Settings, TokenStatusChange
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        assert count_commits(db, client, '/next-token') == 1
+        assert count_commits(db, client, '/next-token') == 1
+        assert count_commits(db, client, '/skip-token') == 1
+        assert count_commits(db, client, f'/recover-token/{ids[1]}') == 1
+        assert count_commits(db, client, f'/serve-token/{ids[1]}') == 1
+        assert count_commits(db, client, f'/revert-token-status/{ids[0]}') == 1
+        assert count_commits(db, client, '/mark-as-served') == 1
+        assert count_commits(db, client, '/generate-token', method='post', data={
+            'visit_reason': 'reason1',
+            'customer_name': 'Walk In',
+            'phone_number': '1234567890'
+        }) == 1
+
+    with app.app_context():
+        # Every status change left an audit row
+        changes = [(c.token_id, c.old_status, c.new_status) for c in TokenStatusChange.query.order_by(TokenStatusChange.id)]
+        assert (ids[0], 'PENDING', 'SERVED') in changes
+        assert (ids[1], 'PENDING', 'SKIPPED') in changes
+        assert (ids[1], 'SKIPPED', 'PENDING') in changes
+        assert (ids[0], 'SERVED', 'PENDING') in changes
+        assert all(c.changed_by == 'admin' for c in TokenStatusChange.query.all())
+
+        # The kiosk token number was allocated in the same transaction
+        assert Settings.query.first().last_token_number == 1
+        assert Token.query.filter_by(customer_name='Walk In').first().token_number == 'T001'
+
+def test_serving_skipped_token_logs_one_change():
+    """A skipped token served from the skipped list gets one SKIPPED -> SERVED audit row."""
+    from app import app, db, Token, Settings, TokenStatusChange
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        client.get('/next-token')
+        client.get('/skip-token')
+        client.get(f'/serve-token/{ids[0]}')
+        client.get('/mark-as-served')
+
+    with app.app_context():
+        assert db.session.get(Token, ids[0]).status == 'SERVED'
+        changes = [(c.old_status, c.new_status) for c in TokenStatusChange.query.filter_by(token_id=ids[0])]
+        assert changes == [('PENDING', 'SKIPPED'), ('SKIPPED', 'SERVED')]
+
+def test_failed_transition_rolls_back():
+    """A failure inside a transition leaves no partial state behind."""
+    from app import app, db, Token, Settings, TokenStatusChange, queue_transition, change_token_status, get_current_token
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+
+    with app.test_request_context():
+        try:
+            with queue_transition():
+                token = db.session.get(Token, ids[0])
+                change_token_status(token, 'SERVED')
+                Settings.query.first().current_token_id = ids[0]
+                db.session.flush()
+                raise RuntimeError('boom')
+        except RuntimeError:
+            pass
+
+        assert db.session.get(Token, ids[0]).status == 'PENDING'
+        assert TokenStatusChange.query.count() == 0
+        assert get_current_token() is None
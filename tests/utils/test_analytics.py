@@ -0,0 +1,160 @@
+"""
+Tests for the analytics page numbers and durations.
+"""
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import add_random_tokens, python_analytics
+
+
+def test_rollup_analytics_match_python_loops():
+    """The analytics page numbers from the rollups are those of the old per-row loops."""
+    from app import app, db, Token, rollup_models
+    from rollups import rollup_analytics
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 400)
+
+        expected = python_analytics(Token.query.order_by(Token.id).all())
+        actual = rollup_analytics(db.session, Token, rollup_models)
+
+        for key in ('total_tokens', 'total_served', 'total_skipped', 'total_pending',
+                    'total_recalls', 'total_skips', 'total_recovered'):
+            assert actual[key] == expected[key], key
+        assert actual['avg_waiting_time'] == pytest.approx(expected['avg_waiting_time'])
+        assert actual['avg_service_duration'] == pytest.approx(expected['avg_service_duration'])
+        assert [t['id'] for t in actual['skipped_then_served']] == expected['skipped_then_served']
+
+        # Same groups, with the rollups' recovered counts on top
+        for name in ('day_stats', 'hour_stats', 'reason_stats'):
+            assert set(actual[name]) == set(expected[name]), name
+            for group, stats in expected[name].items():
+                assert {key: actual[name][group][key] for key in stats} == pytest.approx(stats), (name, group)
+
+        Token.query.delete()
+        db.session.commit()
+
+def test_analytics_page_renders_from_aggregates():
+    """The analytics page works on an empty and a populated table."""
+    from app import app, db, Token
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        with app.app_context():
+            db.create_all()
+            Token.query.delete()
+            db.session.commit()
+        assert client.get('/enhanced-analytics').status_code == 200
+
+        with app.app_context():
+            add_random_tokens(db, Token, 50)
+        response = client.get('/enhanced-analytics')
+        assert response.status_code == 200
+        assert b'Recovered Tokens Detail' in response.data
+
+        with app.app_context():
+            Token.query.delete()
+            db.session.commit()
+
+def test_resolve_date_range():
+    """Presets and from/to dates resolve to inclusive service dates."""
+    from datetime import date
+    from analytics import resolve_date_range
+
+    today = date(2024, 3, 14)
+    assert resolve_date_range({}, today) == (None, None, 'all')
+    assert resolve_date_range({'preset': 'today'}, today) == (today, today, 'today')
+    assert resolve_date_range({'preset': 'last7'}, today)[:2] == (date(2024, 3, 8), today)
+    assert resolve_date_range({'preset': 'this_month'}, today)[:2] == (date(2024, 3, 1), today)
+
+    custom = resolve_date_range({'from': '2024-03-10', 'to': '2024-03-02'}, today)
+    assert custom == (date(2024, 3, 2), date(2024, 3, 10), 'custom')
+    assert custom.query_args() == {'from': '2024-03-02', 'to': '2024-03-10'}
+    assert resolve_date_range({'from': '2024-03-10'}, today)[:2] == (date(2024, 3, 10), None)
+
+    for args in ({'preset': 'decade'}, {'from': '14/03/2024'}):
+        with pytest.raises(ValueError):
+            resolve_date_range(args, today)
+
+def test_date_range_filters_page_and_export():
+    """The analytics page and the export only cover the selected dates."""
+    from app import app, db, Token
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        with app.app_context():
+            db.create_all()
+            Token.query.delete()
+            db.session.commit()
+            add_random_tokens(db, Token, 200)
+            day = datetime(2024, 3, 5)
+            expected = Token.query.filter(Token.created_at >= day, Token.created_at < day + timedelta(days=1)).count()
+            assert 0 < expected < 200
+
+        response = client.get('/enhanced-analytics?from=2024-03-05&to=2024-03-05')
+        assert response.status_code == 200
+        assert f'<h2 class="display-4">{expected}</h2>'.encode() in response.data
+        assert b'export-data?format=csv&amp;from=2024-03-05&amp;to=2024-03-05' in response.data
+
+        response = client.get('/export-data?from=2024-03-05&to=2024-03-05')
+        assert response.data.decode().count('\n') == expected + 1
+        assert 'tokens_export_2024-03-05_2024-03-05.csv' in response.headers['Content-Disposition']
+
+        # Bad dates fall back to everything
+        response = client.get('/enhanced-analytics?from=yesterday')
+        assert b'<h2 class="display-4">200</h2>' in response.data
+        assert b'Invalid date range' in response.data
+
+        with app.app_context():
+            Token.query.delete()
+            db.session.commit()
+
+def test_backfill_matches_stored_durations():
+    """The backfill UPDATE stores the same durations as a token transition."""
+    from app import app, db, Token, rollup_models
+    from analytics import backfill_durations
+    from rollups import check_rollups
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 120)
+
+        rng = random.Random(11)
+        for token in Token.query.filter(Token.skip_count > 0).all():
+            token.last_skipped_at = token.created_at + timedelta(seconds=rng.randint(0, 1200))
+        for token in Token.query.filter(Token.served_at.isnot(None)).limit(20).all():
+            token.completed_at = token.served_at + timedelta(seconds=rng.randint(0, 900), milliseconds=rng.randint(0, 999))
+        db.session.commit()
+
+        columns = (Token.id, Token.waiting_seconds, Token.recovery_seconds, Token.total_seconds)
+        stored = db.session.query(*columns).order_by(Token.id).all()
+        assert any(row.recovery_seconds for row in stored) and any(row.total_seconds for row in stored)
+
+        # Rows from before the durations were stored
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('UPDATE tokens SET waiting_seconds = NULL, recovery_seconds = NULL, total_seconds = NULL')
+        assert backfill_durations(db.session, Token) > 0
+        db.session.commit()
+
+        assert db.session.query(*columns).order_by(Token.id).all() == stored
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+        Token.query.delete()
+        db.session.commit()
@@ -0,0 +1,148 @@
+"""
+Tests for the analytics page cache.
+"""
+
+import os
+import sys
+from datetime import date, datetime
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import download_export
+
+
+def test_cache_eviction_and_range_invalidation():
+    """Entries are evicted least recently used first and dropped per date."""
+    from analytics_cache import AnalyticsCache
+
+    cache = AnalyticsCache(max_entries=2)
+    march = (date(2024, 3, 1), date(2024, 3, 31))
+    april = (date(2024, 4, 1), date(2024, 4, 30))
+    everything = (None, None)
+
+    cache.put(march, 1, {'total_tokens': 3})
+    cache.put(april, 1, {'total_tokens': 4})
+    assert cache.get(march, 1).context == {'total_tokens': 3}
+    assert cache.get(march, 2) is None
+
+    # April was used least recently
+    cache.put(everything, 1, {'total_tokens': 7})
+    assert cache.get(april, 1) is None
+    assert len(cache) == 2
+
+    # A change on 5 March drops the ranges covering it, the rest move on to version 2
+    cache.put(april, 1, {'total_tokens': 4})
+    cache.invalidate({date(2024, 3, 5)}, 2)
+    assert cache.get(march, 1) is None
+    assert cache.get(everything, 1) is None
+    assert cache.get(april, 2).context == {'total_tokens': 4}
+
+    # Entries that missed a version are not carried forward
+    cache.invalidate(set(), 4)
+    assert cache.get(april, 4) is None
+
+def test_analytics_page_served_from_cache(monkeypatch):
+    """Repeated views reuse the cached page until a token in the range changes."""
+    import app as app_module
+    from app import app, db, Token, Settings, analytics_cache
+
+    calls = []
+    rollup_analytics = app_module.rollup_analytics
+
+    def counting_rollup_analytics(*args):
+        calls.append(args[3:])
+        return rollup_analytics(*args)
+
+    monkeypatch.setattr(app_module, 'rollup_analytics', counting_rollup_analytics)
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        if not Settings.query.first():
+            db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0))
+        db.session.add(Token(token_number='M001', visit_reason='reason1', created_at=datetime(2024, 3, 5, 10, 0)))
+        db.session.add(Token(token_number='A001', visit_reason='reason1', created_at=datetime(2024, 4, 2, 10, 0)))
+        db.session.add(Token(token_number='M002', visit_reason='reason1', status='SERVED', skip_count=1,
+                             created_at=datetime(2024, 3, 6, 10, 0), last_skipped_at=datetime(2024, 3, 6, 10, 5),
+                             served_at=datetime(2024, 3, 6, 10, 20), recovery_time=300))
+        db.session.commit()
+    analytics_cache.clear()
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        march = '/enhanced-analytics?from=2024-03-01&to=2024-03-31'
+        april = '/enhanced-analytics?from=2024-04-01&to=2024-04-30'
+        first = client.get(march).data
+        assert client.get(march).data == first
+        assert b'<td>M002</td>' in first
+
+        # The cached model holds plain values, not Token objects bound to a finished session
+        recovered = next(iter(analytics_cache.entries.values())).context['skipped_then_served']
+        assert [(token['token_number'], token['skip_count'], token['recovery_time']) for token in recovered] == [('M002', 1, 300)]
+        client.get(april)
+        client.get(april)
+        assert len(calls) == 2
+
+        # A token created in April only invalidates April
+        with app.app_context():
+            db.session.add(Token(token_number='A002', visit_reason='reason2', created_at=datetime(2024, 4, 3, 9, 0)))
+            db.session.commit()
+
+        assert client.get(march).data == first
+        assert b'<h2 class="display-4">2</h2>' in client.get(april).data
+        assert len(calls) == 3
+
+        # A change made elsewhere (another worker) shows up as a new data version
+        with app.app_context():
+            settings = Settings.query.first()
+            settings.queue_version = (settings.queue_version or 0) + 10
+            db.session.commit()
+        client.get(march)
+        assert len(calls) == 4
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
+
+def test_export_reuses_page_model(monkeypatch):
+    """An Excel export right after a page view reuses the page's analytics model."""
+    import app as app_module
+    from app import app, db, Token, analytics_cache
+
+    calls = []
+    rollup_analytics = app_module.rollup_analytics
+
+    def counting_rollup_analytics(*args):
+        calls.append(args[3:])
+        return rollup_analytics(*args)
+
+    monkeypatch.setattr(app_module, 'rollup_analytics', counting_rollup_analytics)
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.add(Token(token_number='M001', visit_reason='reason1', created_at=datetime(2024, 3, 5, 10, 0)))
+        db.session.commit()
+    analytics_cache.clear()
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        assert client.get('/enhanced-analytics?preset=all').status_code == 200
+        response = download_export(client, '/export-data?format=excel')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        assert len(calls) == 1
+
+        # Another range is computed once, by whichever comes first
+        download_export(client, '/export-data?format=excel&from=2024-03-01&to=2024-03-31')
+        client.get('/enhanced-analytics?from=2024-03-01&to=2024-03-31')
+        assert len(calls) == 2
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
@@ -0,0 +1,521 @@
+"""
+Tests for the streamed token exports.
+"""
+
+import os
+import sys
+import io
+import itertools
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import add_random_tokens, download_export, wait_for_job
+
+
+def row_recovery_time(token):
+    """Recovery seconds as the export computed them per row"""
+    if token.recovery_time:
+        return token.recovery_time
+    if token.last_skipped_at and token.served_at:
+        return int((token.served_at - token.last_skipped_at).total_seconds())
+    return None
+
+def expected_tokens_sheet(tokens):
+    """The Tokens sheet computed from the Token objects"""
+    from timestamps import local_naive
+
+    rows = []
+    for token in tokens:
+        skipped = (token.skip_count or 0) > 0
+        recovery = None
+        if skipped and token.status == 'SERVED' and token.served_at and token.last_skipped_at:
+            recovery = row_recovery_time(token)
+        served = token.served_at is not None and token.service_duration is not None
+        rows.append({
+            'Token Number': token.token_number,
+            'Visit Reason': token.visit_reason,
+            'Phone Number': token.phone_number,
+            'Customer Name': token.customer_name,
+            'Status': token.status,
+            'Created At': local_naive(token.created_at),
+            'Recall Count': token.recall_count or 0,
+            'Skip Count': token.skip_count or 0,
+            'Was Skipped': skipped,
+            'Last Skipped At': local_naive(token.last_skipped_at) if skipped else None,
+            'Recovery Time (sec)': recovery,
+            'Recovery Time (min)': recovery / 60 if recovery is not None else None,
+            'Served At': local_naive(token.served_at),
+            'Waiting Time (min)': token.waiting_time,
+            'Service Duration (min)': token.service_duration / 60 if served else None,
+        })
+    sheet = pd.DataFrame(rows)
+    for column in ('Recovery Time (min)', 'Service Duration (min)'):
+        sheet[column] = sheet[column].astype(float).round(1)
+    return sheet
+
+def test_streamed_csv_matches_tokens():
+    """The streamed CSV has a Tokens sheet row per token, sent in batches."""
+    from app import app, db, Token
+    from exports import TOKEN_EXPORT_HEADER, csv_chunks, token_rows
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 250)
+
+        rng = random.Random(11)
+        for token in Token.query.filter(Token.skip_count > 0):
+            if rng.random() < 0.7:
+                token.last_skipped_at = token.created_at + timedelta(seconds=rng.randint(0, 600))
+        db.session.commit()
+
+        sheet = expected_tokens_sheet(Token.query.order_by(Token.id).all())
+        assert tuple(sheet.columns) == TOKEN_EXPORT_HEADER
+
+        chunks = list(csv_chunks(token_rows(db.session, Token), batch_size=100))
+        # Header, then 100 + 100 + 50 rows
+        assert [chunk.decode().count('\n') for chunk in chunks] == [1, 100, 100, 50]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+        response = client.get('/export-data?format=csv')
+        assert response.is_streamed
+        assert response.mimetype == 'text/csv'
+        assert 'tokens_export.csv' in response.headers['Content-Disposition']
+
+    timestamps = ['Created At', 'Last Skipped At', 'Served At']
+    streamed = pd.read_csv(io.BytesIO(response.data), parse_dates=timestamps)
+    expected = pd.read_csv(io.StringIO(sheet.to_csv(index=False)), parse_dates=timestamps)
+    pd.testing.assert_frame_equal(streamed, expected)
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
+
+def test_export_formats():
+    """Both export formats work on an empty and a filled token table."""
+    from app import app, db, Token
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        with app.app_context():
+            db.create_all()
+            Token.query.delete()
+            db.session.commit()
+        assert download_export(client, '/export-data?format=excel').status_code == 200
+
+        with app.app_context():
+            add_random_tokens(db, Token, 40)
+        response = download_export(client, '/export-data?format=excel')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+        # Browsers get a page that follows the background job
+        response = client.get('/export-data?format=excel')
+        assert response.status_code == 202
+        assert response.headers['Location'] in response.data.decode()
+        assert 'data-export-status' in response.data.decode()
+        assert 'X-Export-Watermark' in response.headers
+        wait_for_job(client, response.headers['Location'])
+
+        response = client.get('/export-data')
+        assert response.mimetype == 'text/csv'
+        assert response.data.decode().count('\n') == 41
+
+        with app.app_context():
+            Token.query.delete()
+            db.session.commit()
+
+def test_writes_commit_during_export():
+    """A half-read export holds no database lock, so queue writes go through."""
+    from app import app, db, Token
+    from exports import token_rows
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 250)
+
+        rows = token_rows(db.session, Token, batch_size=100)
+        first = list(itertools.islice(rows, 150))
+
+        # Another connection writes without waiting for the export
+        connection = sqlite3.connect(db.engine.url.database, timeout=0.2)
+        with connection:
+            connection.execute("INSERT INTO tokens (token_number, visit_reason, status) VALUES ('L001', 'Deposit', 'PENDING')")
+        connection.close()
+
+        # Later pages see the new token
+        rest = list(rows)
+        assert len(first) + len(rest) == 251
+        assert rest[-1][0] == 'L001'
+
+        # Incremental exports page through the change version index
+        incremental = list(token_rows(db.session, Token, since=-1, batch_size=7))
+        # (the raw insert above has no change version yet)
+        ordered = Token.query.filter(Token.change_version.isnot(None)).order_by(Token.change_version, Token.id).all()
+        assert [row[0] for row in incremental] == [token.token_number for token in ordered]
+
+        Token.query.delete()
+        db.session.commit()
+
+def test_full_export_includes_tokens_changed_midway(monkeypatch):
+    """A token committed while a full export is paging is still exported."""
+    import app as app_module
+    import exports
+    from app import app, db, Token
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 30)
+
+    def change_last_token():
+        with app.app_context():
+            token = Token.query.filter_by(token_number='A0025').one()
+            token.recall_count = (token.recall_count or 0) + 1
+            db.session.commit()
+
+    def rows_changed_midway(*args, **kwargs):
+        for index, row in enumerate(exports.token_rows(*args, batch_size=10, **kwargs)):
+            if index == 10:
+                # Another worker commits after the first page was read
+                writer = threading.Thread(target=change_last_token)
+                writer.start()
+                writer.join()
+            yield row
+    monkeypatch.setattr(app_module, 'token_rows', rows_changed_midway)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+        response = client.get('/export-data?format=csv')
+
+    rows = pd.read_csv(io.BytesIO(response.data), dtype=str)
+    assert list(rows['Token Number']) == [f'A{index:04d}' for index in range(30)]
+
+    with app.app_context():
+        # With its committed change
+        recall_count = Token.query.filter_by(token_number='A0025').one().recall_count
+        assert rows.set_index('Token Number').loc['A0025', 'Recall Count'] == str(recall_count)
+        Token.query.delete()
+        db.session.commit()
+
+def test_writes_commit_during_workbook_export():
+    """Queue writes go through while the workbook's token sheets are being written."""
+    from app import app, db, Token
+    from exports import RECOVERY_EXPORT_HEADER, TOKEN_EXPORT_HEADER, recovery_rows, token_rows, write_workbook
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 200)
+        recalls = db.session.query(db.func.sum(Token.recall_count)).scalar()
+        recovered = Token.query.filter(Token.status == 'SERVED', Token.served_at.isnot(None),
+                                       Token.skip_count > 0).count()
+        db.session.commit()
+
+        def write_midway(rows, at):
+            for index, row in enumerate(rows):
+                if index == at:
+                    connection = sqlite3.connect(db.engine.url.database, timeout=0.2)
+                    with connection:
+                        connection.execute('UPDATE tokens SET recall_count = recall_count + 1')
+                    connection.close()
+                yield row
+
+        with tempfile.TemporaryFile() as output:
+            write_workbook(output, {
+                'Tokens': (TOKEN_EXPORT_HEADER, write_midway(token_rows(db.session, Token, batch_size=50), 75)),
+                'Recovery Analysis': (RECOVERY_EXPORT_HEADER,
+                                      write_midway(recovery_rows(db.session, Token, batch_size=2), 3)),
+            })
+            output.seek(0)
+            with zipfile.ZipFile(output) as workbook:
+                # Header plus one row per token
+                rows = [workbook.read(f'xl/worksheets/sheet{index}.xml').decode().count('<row ') for index in (1, 2)]
+        assert rows == [200 + 1, recovered + 1]
+
+        # Both updates were committed, once per token each
+        assert db.session.query(db.func.sum(Token.recall_count)).scalar() == recalls + 2 * 200
+
+        Token.query.delete()
+        db.session.commit()
+
+def synthetic_rows(count):
+    """Tokens sheet rows without a database"""
+    start = datetime(2024, 3, 1, 9, 0)
+    for index in range(count):
+        created_at = start + timedelta(seconds=37 * index)
+        skipped = index % 3 > 0
+        yield (f'A{index % 1000:03d}', 'Account Opening', '9876543210', f'Customer {index}', 'SERVED',
+               created_at, 0, index % 3, skipped, created_at if skipped else None, 120, 2.0,
+               created_at + timedelta(minutes=5), 5, 3.5)
+
+def peak_memory(count):
+    """Peak traced memory of writing a Tokens sheet of count rows"""
+    from exports import TOKEN_EXPORT_HEADER, write_workbook
+
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryFile() as output:
+            write_workbook(output, {'Tokens': (TOKEN_EXPORT_HEADER, synthetic_rows(count))})
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def test_workbook_memory_does_not_grow_with_rows():
+    """Writing eight times the rows stays within the same memory budget."""
+    small, large = peak_memory(1000), peak_memory(8000)
+    assert large < 2 * 1024 * 1024
+    assert large < small * 1.5
+
+def test_excel_export_sheets():
+    """The Excel export has every sheet, the token sheets streamed from the database."""
+    from app import app, db, Token
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 120)
+        tokens = Token.query.all()
+        recovered = [t for t in tokens if t.status == 'SERVED' and t.served_at and t.skip_count > 0]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+        response = download_export(client, '/export-data?format=excel')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as workbook:
+        names = re.findall(r'<sheet name="([^"]+)"', workbook.read('xl/workbook.xml').decode())
+        assert names == ['Tokens', 'Summary', 'Day Analysis', 'Hour Analysis', 'Reason Analysis',
+                         'Staff Performance', 'Recovery Analysis']
+
+        def row_count(index):
+            return workbook.read(f'xl/worksheets/sheet{index}.xml').decode().count('<row ')
+        # Header plus one row per token
+        assert row_count(1) == len(tokens) + 1
+        assert row_count(2) == 11
+        assert row_count(7) == len(recovered) + 1
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
+
+def test_export_since_watermark():
+    """An export since a watermark has only the tokens created or changed after it."""
+    from app import app, db, Token
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 50)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        response = client.get('/export-data?format=csv')
+        assert response.data.decode().count('\n') == 51
+        watermark = int(response.headers['X-Export-Watermark'])
+
+        with app.app_context():
+            changed = Token.query.order_by(Token.id).limit(3).all()
+            for token in changed:
+                token.recall_count = (token.recall_count or 0) + 1
+            db.session.add(Token(token_number='W001', visit_reason='Deposit', status='PENDING'))
+            db.session.commit()
+            expected = [token.token_number for token in changed] + ['W001']
+
+        response = client.get(f'/export-data?format=csv&since={watermark}')
+        rows = pd.read_csv(io.BytesIO(response.data), dtype=str)
+        assert list(rows['Token Number']) == expected
+        next_watermark = int(response.headers['X-Export-Watermark'])
+        assert next_watermark > watermark
+
+        # Nothing changed since
+        response = client.get(f'/export-data?format=csv&since={next_watermark}')
+        assert response.data.decode().count('\n') == 1
+        assert int(response.headers['X-Export-Watermark']) == next_watermark
+
+        assert client.get('/export-data?format=csv&since=yesterday').status_code == 302
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
+
+def test_background_export_job(tmp_path):
+    """A background CSV export reports progress and downloads the same file."""
+    from app import app, db, Token, export_jobs
+
+    export_jobs.directory = str(tmp_path)
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 60)
+
+    with app.test_client() as client:
+        assert client.post('/api/export-jobs?format=csv').status_code == 403
+
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+        assert client.post('/api/export-jobs?format=pdf').status_code == 400
+
+        response = client.post('/api/export-jobs?format=csv&from=2024-03-01')
+        assert response.status_code == 202
+        job = wait_for_job(client, response.get_json()['status_url'])
+        assert job['status'] == 'finished'
+        assert job['done'] == job['total'] == 60
+
+        download = client.get(job['download_url'])
+        assert download.status_code == 200
+        assert 'tokens_export_2024-03-01_latest.csv' in download.headers['Content-Disposition']
+        assert download.data == client.get('/export-data?format=csv&from=2024-03-01').data
+        download.close()
+
+        response = client.post('/api/export-jobs?format=excel')
+        job = wait_for_job(client, response.get_json()['status_url'])
+        assert job['status'] == 'finished'
+        assert client.get(job['download_url']).mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+        assert client.get('/api/export-jobs/unknown').status_code == 404
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
+
+def test_queue_action_during_export_job(tmp_path, monkeypatch):
+    """Staff queue actions commit while an export job is partway through the tokens."""
+    import app as app_module
+    import exports
+    from app import app, db, Token, Settings, TokenStatusChange, export_jobs
+    from tests.helpers import reset_queue
+
+    export_jobs.directory = str(tmp_path)
+    reset_queue(app, db, Token, Settings, TokenStatusChange)
+    with app.app_context():
+        add_random_tokens(db, Token, 200)
+
+    # Pause the job between two pages of tokens
+    reached, release = threading.Event(), threading.Event()
+
+    def paused_rows(*args, **kwargs):
+        for index, row in enumerate(exports.token_rows(*args, batch_size=50, **kwargs)):
+            if index == 75:
+                reached.set()
+                release.wait(10)
+            yield row
+    monkeypatch.setattr(app_module, 'token_rows', paused_rows)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        status_url = client.post('/api/export-jobs?format=csv').get_json()['status_url']
+        assert reached.wait(10)
+        try:
+            assert client.get(status_url).get_json()['job']['status'] == 'running'
+            response = client.post('/api/queue/next')
+            assert response.status_code == 200
+            assert response.get_json()['success']
+        finally:
+            release.set()
+        assert wait_for_job(client, status_url)['status'] == 'finished'
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
+
+def test_export_job_cleanup(tmp_path):
+    """Old jobs go first by age, then the oldest finished files over the quota."""
+    from export_jobs import ExportJobs
+
+    jobs = ExportJobs(str(tmp_path), max_age=3600, max_bytes=250)
+    now = time.time()
+
+    def job(status, age, size=0):
+        job_id = uuid.uuid4().hex
+        state = dict(id=job_id, status=status, filename=f'{job_id}.csv', created=now - age,
+                     finished=None if status == 'running' else now - age, size=size)
+        with open(jobs.file_path(state), 'wb') as f:
+            f.write(b'x' * size)
+        jobs.save(state)
+        return job_id
+
+    expired = job('failed', 7200)
+    oldest = job('finished', 600, 100)
+    newer = job('finished', 300, 100)
+    newest = job('finished', 60, 100)
+    running = job('running', 30)
+
+    assert jobs.cleanup(now) == [expired, oldest]
+    assert [state['id'] for state in jobs.jobs()] == [newer, newest, running]
+    assert sorted(os.listdir(tmp_path)) == sorted(f'{job_id}.{ext}' for job_id in (newer, newest, running)
+                                                  for ext in ('csv', 'json'))
+    assert jobs.cleanup(now + 3400) == [newer]
+
+def test_columnar_exports():
+    """Parquet and Arrow exports have typed columns matching the tokens."""
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    from app import app, db, Token
+    from exports import columnar_batches, write_columnar
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 150)
+        tokens = Token.query.order_by(Token.id).all()
+
+        # One row group per cursor batch
+        output = io.BytesIO()
+        write_columnar(output, columnar_batches(db.session, Token, batch_size=40))
+        assert pq.ParquetFile(io.BytesIO(output.getvalue())).num_row_groups == 4
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+        parquet = download_export(client, '/export-data?format=parquet')
+        assert parquet.mimetype == 'application/vnd.apache.parquet'
+        assert 'tokens_export.parquet' in parquet.headers['Content-Disposition']
+        arrow = download_export(client, '/export-data?format=arrow')
+
+    for table in (pq.read_table(io.BytesIO(parquet.data)), pa.ipc.open_file(arrow.data).read_all()):
+        assert table.schema.field('created_at').type == pa.timestamp('ms', tz='+05:30')
+        assert table.schema.field('waiting_seconds').type == pa.int32()
+        assert table.column('id').to_pylist() == [t.id for t in tokens]
+        assert table.column('created_at').to_pylist() == [t.created_at for t in tokens]
+        assert table.column('served_at').to_pylist() == [t.served_at for t in tokens]
+        assert table.column('waiting_seconds').to_pylist() == [t.waiting_seconds for t in tokens]
+        assert table.column('visit_reason').to_pylist() == [t.visit_reason for t in tokens]
+
+    with app.app_context():
+        Token.query.delete()
+        db.session.commit()
@@ -0,0 +1,463 @@
+"""
+Tests for the in-memory queue engine.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from queue_engine import QueueEngine, QueueEntry
+
+
+def make_engine(entries, current_id=0):
+    engine = QueueEngine()
+    engine.load(entries, current_id, True)
+    return engine
+
+def test_next_id_without_current():
+    """The first pending token is next when nothing is being served."""
+    engine = make_engine([QueueEntry(3, 'T003'), QueueEntry(1, 'T001'), QueueEntry(2, 'T002')])
+    assert engine.next_id() == 1
+    assert engine.pending_ids() == [1, 2, 3]
+
+def test_next_id_wraps_around():
+    """Next prefers a higher id, then falls back to the lowest pending id."""
+    engine = make_engine([QueueEntry(2, 'T002'), QueueEntry(5, 'T005'), QueueEntry(9, 'T009')], current_id=5)
+    assert engine.next_id() == 9
+
+    engine.apply([('token', QueueEntry(9, 'T009', status='SERVED'))])
+    assert engine.next_id() == 2
+
+    engine.apply([('token', QueueEntry(2, 'T002', status='SERVED'))])
+    assert engine.next_id() is None
+
+def test_skipped_order_and_limit():
+    """Skipped tokens are returned most recently skipped first."""
+    now = datetime(2024, 1, 1, 10, 0, 0)
+    engine = make_engine([
+        QueueEntry(1, 'T001', status='SKIPPED', last_skipped_at=now),
+        QueueEntry(2, 'T002', status='SKIPPED', last_skipped_at=now + timedelta(minutes=5)),
+        QueueEntry(3, 'T003', status='SKIPPED', last_skipped_at=now + timedelta(minutes=1)),
+    ])
+    assert [e.token_number for e in engine.skipped()] == ['T002', 'T003', 'T001']
+    assert [e.token_number for e in engine.skipped(1)] == ['T002']
+
+    # Recovering a token moves it back to pending
+    engine.apply([('token', QueueEntry(2, 'T002', status='PENDING', last_skipped_at=now))])
+    assert [e.token_number for e in engine.skipped()] == ['T003', 'T001']
+    assert engine.pending_ids() == [2]
+
+def test_current_pointer_changes():
+    """Settings changes move the current pointer and drop served tokens."""
+    engine = make_engine([QueueEntry(1, 'T001'), QueueEntry(2, 'T002')], current_id=1)
+    assert engine.current_entry().token_number == 'T001'
+
+    engine.apply([
+        ('settings', 2, True),
+        ('token', QueueEntry(1, 'T001', status='SERVED')),
+    ])
+    assert engine.current_id == 2
+    assert engine.get(1) is None
+    assert engine.next_id() is None
+
+def test_apply_ignored_until_loaded():
+    """Changes before the first load are dropped; the load is authoritative."""
+    engine = QueueEngine()
+    engine.apply([('token', QueueEntry(1, 'T001'))])
+    assert not engine.loaded
+    assert engine.next_id() is None
+
+def test_version_gap_reloads():
+    """A change committed under an unexpected version drops the engine state."""
+    engine = QueueEngine()
+    engine.load([QueueEntry(1, 'T001')], 0, True, version=4)
+
+    engine.apply([('token', QueueEntry(2, 'T002'))], version=5)
+    assert engine.pending_ids() == [1, 2]
+
+    # Version 6 was committed by another worker
+    engine.apply([('token', QueueEntry(3, 'T003'))], version=7)
+    assert not engine.loaded
+    assert engine.version == 5
+
+def test_workers_share_queue_state():
+    """Changes committed by another worker are picked up before the next read."""
+    from app import app, db, Token, Settings, get_next_token
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        tokens = [Token(token_number=f'W{i:03d}', visit_reason='reason1', customer_name=f'C{i}') for i in range(1, 4)]
+        db.session.add_all(tokens)
+        db.session.commit()
+        ids = [token.id for token in tokens]
+        assert get_next_token().id == ids[0]
+
+    def commit_elsewhere(token_id):
+        # Another worker's commit never reaches this process's session events
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("UPDATE tokens SET status = 'SERVED' WHERE id = ?", (token_id,))
+            connection.exec_driver_sql('UPDATE settings SET queue_version = queue_version + 1')
+
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = 'redis://127.0.0.1:6379/0'
+    try:
+        with app.app_context():
+            commit_elsewhere(ids[0])
+        with app.test_request_context():
+            assert get_next_token().id == ids[1]
+    finally:
+        app.config['SOCKETIO_MESSAGE_QUEUE'] = message_queue
+
+    # Single worker: the version gap on the next local commit forces a reload
+    with app.app_context():
+        commit_elsewhere(ids[1])
+        db.session.add(Token(token_number='W004', visit_reason='reason1', customer_name='C4'))
+        db.session.commit()
+        assert get_next_token().id == ids[2]
+
+def test_engine_follows_database():
+    """get_next_token and the skipped list track committed changes."""
+    from app import app, db, Token, Settings, get_next_token, get_current_token, get_skipped_tokens, queue_engine
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        tokens = [Token(token_number=f'Q{i:03d}', visit_reason='reason1', customer_name=f'C{i}') for i in range(1, 5)]
+        db.session.add_all(tokens)
+        db.session.commit()
+
+        assert get_current_token() is None
+        assert get_next_token().id == tokens[0].id
+
+        # Serve the first token
+        Settings.query.first().current_token_id = tokens[0].id
+        db.session.commit()
+        assert get_current_token().id == tokens[0].id
+        assert get_next_token().id == tokens[1].id
+
+        # Skip the second token
+        tokens[1].status = 'SKIPPED'
+        tokens[1].last_skipped_at = datetime.now()
+        db.session.commit()
+        assert get_next_token().id == tokens[2].id
+        assert [t.token_number for t in get_skipped_tokens()] == ['Q002']
+
+        # A fresh load agrees with the incrementally maintained state
+        expected = (queue_engine.current_id, queue_engine.next_id(), queue_engine.pending_ids())
+        queue_engine.invalidate()
+        assert get_next_token().id == tokens[2].id
+        assert (queue_engine.current_id, queue_engine.next_id(), queue_engine.pending_ids()) == expected
+
+        # Rolled back changes never reach the engine
+        tokens[2].status = 'SERVED'
+        db.session.flush()
+        db.session.rollback()
+        assert get_next_token().id == tokens[2].id
+
+        Token.query.delete()
+        db.session.commit()
+        assert get_next_token() is None
+
+def queue_item_key(item):
+    return item.get('id', item['token_number'])
+
+def apply_delta(state, changes):
+    """Python mirror of applyQueueDelta in base.html"""
+    patched = dict(state)
+    for field, value in changes.items():
+        if isinstance(state.get(field), list):
+            removed = [queue_item_key(item) for item in value['removed']]
+            items = [item for item in state[field] if queue_item_key(item) not in removed]
+            for entry in value['added']:
+                items.insert(entry['index'], entry['token'])
+            patched[field] = items
+        else:
+            patched[field] = value
+    return patched
+
+def set_broadcast_windows(app, staff, display):
+    """Set both coalescing windows and return the previous values"""
+    previous = (app.config['BROADCAST_COALESCE_MS'], app.config['DISPLAY_BROADCAST_COALESCE_MS'])
+    app.config['BROADCAST_COALESCE_MS'] = staff
+    app.config['DISPLAY_BROADCAST_COALESCE_MS'] = display
+    return previous
+
+def follow_broadcasts(socket_client, state):
+    """Apply received snapshots and deltas to state like the browser does"""
+    for message in socket_client.get_received():
+        payload = message['args'][0]
+        if message['name'] == 'queue_status':
+            state = payload
+        elif payload['base_version'] == state['version']:
+            state = apply_delta(state, payload['changes'])
+            state['version'] = payload['version']
+        elif payload['version'] > state['version']:
+            # Version gap: fetch a snapshot
+            socket_client.emit('request_queue_status')
+            snapshots = [m for m in socket_client.get_received() if m['name'] == 'queue_status']
+            state = snapshots[-1]['args'][0]
+    return state
+
+def test_queue_status_delta_round_trip():
+    """Applying a delta to the old snapshot reproduces the new one."""
+    from queue_engine import queue_status_delta
+
+    def skipped(*numbers):
+        return [{'token_number': n, 'skipped_at': f'10:0{i}:00'} for i, n in enumerate(numbers)]
+
+    old = {'current_token': {'token_number': 'T001'}, 'next_token': {'token_number': 'T002'},
+           'queue_active': True, 'skipped_tokens': skipped('T005', 'T004', 'T003')}
+    new = {'current_token': {'token_number': 'T002'}, 'next_token': None,
+           'queue_active': True, 'skipped_tokens': [{'token_number': 'T001', 'skipped_at': '10:09:00'}] + skipped('T005', 'T003')[:1] + [{'token_number': 'T003', 'skipped_at': '10:01:00'}]}
+
+    changes = queue_status_delta(old, new)
+    assert 'queue_active' not in changes
+    assert changes['next_token'] is None
+    assert apply_delta(old, changes) == new
+    assert queue_status_delta(new, new) == {}
+
+def test_broadcasts_are_versioned_deltas():
+    """Staff actions emit deltas that chain from the previous version."""
+    from app import app, db, socketio, Token, Settings
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        db.session.add_all([Token(token_number=f'V{i:03d}', visit_reason='reason1', customer_name=f'C{i}') for i in range(1, 4)])
+        db.session.commit()
+
+    # Emit inline so every action produces its own delta
+    windows = set_broadcast_windows(app, 0, 0)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        display = socketio.test_client(app)
+        admin = socketio.test_client(app, flask_test_client=client, auth={'room': 'admin'})
+        display_state = display.get_received()[-1]['args'][0]
+        admin_state = admin.get_received()[-1]['args'][0]
+
+        for url in ['/next-token', '/skip-token', '/next-token', '/mark-as-served']:
+            version = display_state['version']
+            client.get(url)
+            display_state = follow_broadcasts(display, display_state)
+            admin_state = follow_broadcasts(admin, admin_state)
+            assert display_state['version'] > version
+
+    with app.test_request_context():
+        from app import get_queue_status
+        assert display_state == get_queue_status('display')
+        assert admin_state == get_queue_status('admin')
+        assert display_state['current_token'] is None
+        assert [item['token_number'] for item in display_state['skipped_tokens']] == ['V001']
+        assert [item['token_number'] for item in admin_state['pending_tokens']] == []
+
+    display.disconnect()
+    admin.disconnect()
+    set_broadcast_windows(app, *windows)
+
+def browser_apply_delta(state_json, changes_json):
+    """Run applyQueueDelta from base.html under node on payloads as sent over the wire"""
+    with open(os.path.join(os.path.dirname(__file__), '../../templates/base.html')) as f:
+        source = re.search(r'function queueItemKey.*?\n        }\n\n        function applyQueueDelta.*?\n        }\n', f.read(), re.S).group(0)
+    script = source + 'process.stdout.write(JSON.stringify(applyQueueDelta(%s, %s)));' % (state_json, changes_json)
+    return json.loads(subprocess.run(['node', '-e', script], capture_output=True, text=True, check=True).stdout)
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node')
+def test_socket_delta_applies_to_api_snapshot():
+    """A socket delta patches the queue returned by the JSON API, whatever the key order."""
+    from app import app, db, socketio, Token, Settings, TokenStatusChange
+    from tests.helpers import reset_queue
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+    windows = set_broadcast_windows(app, 0, 0)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        admin = socketio.test_client(app, flask_test_client=client, auth={'room': 'admin'})
+        client.post('/api/queue/next')
+        # jsonify sorts the keys of the snapshot the page keeps after an action
+        response = client.post('/api/queue/skip')
+        snapshot_json = json.dumps(response.get_json()['queue'], sort_keys=True)
+        assert response.get_json()['queue']['skipped_tokens'][0]['id'] == ids[0]
+        admin.get_received()
+
+        client.post(f'/api/queue/recover/{ids[0]}')
+        delta = [m['args'][0] for m in admin.get_received() if m['name'] == 'queue_delta'][-1]
+        assert delta['base_version'] == response.get_json()['queue']['version']
+        # Socket.IO keeps the keys in insertion order
+        state = browser_apply_delta(snapshot_json, json.dumps(delta['changes']))
+        state['version'] = delta['version']
+
+    with app.test_request_context():
+        from app import get_queue_status
+        assert state == get_queue_status('admin')
+        assert state['skipped_tokens'] == []
+        assert [item['id'] for item in state['pending_tokens']] == ids
+
+    admin.disconnect()
+    set_broadcast_windows(app, *windows)
+
+def test_rooms_get_their_own_payloads():
+    """Displays get token numbers only; staff rooms also get details and the pending list."""
+    from app import app, db, socketio, Token, Settings
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=2, use_thermal_printer=True))
+        db.session.add_all([Token(token_number=f'T{i:03d}', visit_reason='reason1', customer_name=f'C{i}') for i in range(1, 3)])
+        db.session.commit()
+
+    windows = set_broadcast_windows(app, 0, 0)
+
+    with app.test_client() as client:
+        # A public client asking for a staff room is kept on the display room
+        display = socketio.test_client(app, auth={'room': 'admin'})
+
+        with client.session_transaction() as sess:
+            sess['employee_id'] = 1
+            sess['employee_role'] = 'employee'
+        employee = socketio.test_client(app, flask_test_client=client, auth={'room': 'employee'})
+
+        display_state = display.get_received()[-1]['args'][0]
+        employee_state = employee.get_received()[-1]['args'][0]
+        assert 'pending_tokens' not in display_state
+        assert [item['token_number'] for item in employee_state['pending_tokens']] == ['T001', 'T002']
+
+        client.get('/next-token')
+        display_state = follow_broadcasts(display, display_state)
+        employee_state = follow_broadcasts(employee, employee_state)
+        assert display_state['current_token'] == {'token_number': 'T001'}
+        assert employee_state['current_token']['customer_name'] == 'C1'
+
+        # A token at the back of the queue only changes the staff view
+        client.post('/generate-token', data={'visit_reason': 'reason1', 'customer_name': 'C3', 'phone_number': '1234567890'})
+        assert display.get_received() == []
+        employee_state = follow_broadcasts(employee, employee_state)
+        assert [item['token_number'] for item in employee_state['pending_tokens']] == ['T001', 'T002', 'T003']
+
+        display.disconnect()
+        employee.disconnect()
+
+    set_broadcast_windows(app, *windows)
+
+def test_reconnect_storm_uses_cached_snapshot():
+    """Many clients connecting at once cost no queries once the snapshot is cached."""
+    import threading
+    from sqlalchemy import event
+    from app import app, db, socketio, Token, Settings
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        db.session.add(Token(token_number='R001', visit_reason='reason1', customer_name='C1'))
+        db.session.commit()
+        engine = db.engine
+
+    # The first connection loads the engine and builds the snapshot
+    first = socketio.test_client(app)
+    snapshot = first.get_received()[0]['args'][0]
+
+    statements = []
+    thread_id = threading.get_ident()
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        # Broadcasts scheduled by earlier tests run in their own threads
+        if threading.get_ident() == thread_id:
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        clients = [socketio.test_client(app) for _ in range(20)]
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    for client in clients:
+        assert client.get_received()[0]['args'][0] == snapshot
+        client.disconnect()
+    first.disconnect()
+
+    assert statements == []
+
+    # A token joining the back of the queue leaves the display snapshot as it was
+    with app.app_context():
+        db.session.add(Token(token_number='R002', visit_reason='reason1', customer_name='C2'))
+        db.session.commit()
+
+    client = socketio.test_client(app)
+    assert client.get_received()[0]['args'][0] == snapshot
+    client.disconnect()
+
+    # A change the display shows invalidates it
+    with app.app_context():
+        Token.query.filter_by(token_number='R001').first().status = 'SERVED'
+        db.session.commit()
+
+    client = socketio.test_client(app)
+    status = client.get_received()[0]['args'][0]
+    assert status['version'] > snapshot['version']
+    assert status['next_token'] == {'token_number': 'R002'}
+    client.disconnect()
+
+def test_bursty_actions_share_one_broadcast():
+    """Rapid staff actions inside the coalescing window produce one emit."""
+    import time
+    from app import app, db, socketio, Token, Settings
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        Settings.query.delete()
+        db.session.add(Settings(queue_active=True, current_token_id=0, last_token_number=0, use_thermal_printer=True))
+        db.session.add_all([Token(token_number=f'B{i:03d}', visit_reason='reason1', customer_name=f'C{i}') for i in range(1, 6)])
+        db.session.commit()
+
+    windows = set_broadcast_windows(app, 200, 200)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        socket_client = socketio.test_client(app, flask_test_client=client, auth={'room': 'admin'})
+        socket_client.get_received()
+
+        for url in ['/next-token', '/next-token', '/skip-token', '/recall-token']:
+            client.get(url)
+
+        # Nothing has been emitted while the window is open
+        assert socket_client.get_received() == []
+        time.sleep(0.5)
+
+        received = socket_client.get_received()
+        socket_client.disconnect()
+
+    set_broadcast_windows(app, *windows)
+
+    assert len(received) == 1
+    payload = received[0]['args'][0]
+    current = payload['changes']['current_token'] if received[0]['name'] == 'queue_delta' else payload['current_token']
+    assert current['token_number'] == 'B003'
+    assert current['recall_count'] == 1
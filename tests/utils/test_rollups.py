@@ -0,0 +1,116 @@
+"""
+Tests for the incrementally maintained analytics rollups.
+"""
+
+import os
+import sys
+import random
+from datetime import timedelta
+
+import pytest
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import add_random_tokens, python_analytics, reset_queue
+
+
+def clear_tokens(db, Token):
+    Token.query.delete()
+    db.session.commit()
+
+def test_rollups_follow_token_changes():
+    """Inserts, edits and deletes keep the rollups equal to a rebuild."""
+    from app import app, db, Token, rollup_models
+    from rollups import check_rollups, rollup_analytics
+
+    with app.app_context():
+        db.create_all()
+        clear_tokens(db, Token)
+        add_random_tokens(db, Token, 200)
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+        rng = random.Random(3)
+        tokens = Token.query.order_by(Token.id).all()
+        for token in rng.sample(tokens, 60):
+            token.status = rng.choice(['PENDING', 'SERVED', 'SKIPPED'])
+            token.skip_count += rng.choice([0, 1])
+            token.visit_reason = rng.choice(['reason1', 'reason3'])
+            token.staff_id = rng.choice([None, '1', '2'])
+            token.created_at = token.created_at + timedelta(hours=rng.choice([0, 5, 30]))
+            if rng.random() < 0.3:
+                # Several flushes in one transaction
+                db.session.flush()
+                token.recall_count += 1
+        for token in rng.sample(tokens, 20):
+            db.session.delete(token)
+        db.session.commit()
+
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+        # Same numbers as going through the tokens one by one
+        expected = python_analytics(Token.query.order_by(Token.id).all())
+        actual = rollup_analytics(db.session, Token, rollup_models)
+        for key in ('total_tokens', 'total_served', 'total_skipped', 'total_pending',
+                    'total_recalls', 'total_skips', 'total_recovered'):
+            assert actual[key] == expected[key], key
+        assert actual['avg_waiting_time'] == pytest.approx(expected['avg_waiting_time'])
+        assert actual['avg_service_duration'] == pytest.approx(expected['avg_service_duration'])
+        for name in ('day_stats', 'hour_stats', 'reason_stats'):
+            assert set(actual[name]) == set(expected[name])
+            for group, stats in expected[name].items():
+                assert {key: actual[name][group][key] for key in stats} == pytest.approx(stats), (name, group)
+
+        # A rolled back change leaves the rollups alone
+        tokens[0].status = 'SERVED' if tokens[0].status != 'SERVED' else 'PENDING'
+        db.session.flush()
+        db.session.rollback()
+        db.session.add(Token(token_number='X1', visit_reason='reason1'))
+        db.session.commit()
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+        clear_tokens(db, Token)
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+def test_queue_transitions_update_rollups():
+    """Generate, serve, skip, recover and revert update the rollups."""
+    from app import app, db, Token, Settings, TokenStatusChange, DailyRollup, rollup_models
+    from rollups import check_rollups
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['employee_id'] = 1
+            sess['employee_role'] = 'employee'
+
+        client.post('/generate-token', data={'visit_reason': 'reason2', 'customer_name': 'Walk In'})
+        for url in ('/api/queue/next', '/api/queue/skip', f'/api/queue/recover/{ids[0]}',
+                    f'/api/queue/serve/{ids[0]}', '/api/queue/mark-served'):
+            assert client.post(url).get_json()['success'] is True, url
+        client.get(f'/revert-token-status/{ids[1]}')
+
+    with app.app_context():
+        assert check_rollups(db.session, Token, rollup_models) == []
+        totals = db.session.query(db.func.sum(DailyRollup.token_count), db.func.sum(DailyRollup.served_count)).one()
+        assert totals == (4, Token.query.filter_by(status='SERVED').count())
+
+def test_rebuild_repairs_rollups():
+    """Changes made behind the ORM's back are found and fixed by a rebuild."""
+    from app import app, db, Token, rollup_models
+    from rollups import check_rollups, rebuild_rollups
+
+    with app.app_context():
+        db.create_all()
+        clear_tokens(db, Token)
+        add_random_tokens(db, Token, 30)
+
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("UPDATE tokens SET status = 'PENDING'")
+        assert check_rollups(db.session, Token, rollup_models) != []
+
+        rebuild_rollups(db.session, Token, rollup_models)
+        db.session.commit()
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+        clear_tokens(db, Token)
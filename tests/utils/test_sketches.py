@@ -0,0 +1,86 @@
+"""
+Tests for the waiting and service time quantile sketches.
+"""
+
+import os
+import sys
+import random
+
+import pytest
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from tests.helpers import add_random_tokens
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+def test_sketch_accuracy_merge_and_remove():
+    """Quantiles stay within the relative accuracy; merges and removals are exact."""
+    from sketches import QuantileSketch, RELATIVE_ACCURACY
+
+    rng = random.Random(5)
+    values = [rng.lognormvariate(6, 1) for _ in range(5000)]
+
+    whole = QuantileSketch()
+    first, second = QuantileSketch(), QuantileSketch()
+    for index, value in enumerate(values):
+        whole.add(value)
+        (first if index % 2 else second).add(value)
+
+    for q in (0.5, 0.9, 0.99):
+        assert whole.quantile(q) == pytest.approx(exact_quantile(values, q), rel=RELATIVE_ACCURACY)
+
+    merged = QuantileSketch.from_json(first.to_json()).merge(second)
+    assert merged.buckets == whole.buckets
+
+    # Removing the second half leaves the first
+    for value in values[::2]:
+        merged.add(value, -1)
+    assert merged.buckets == first.buckets
+
+    assert QuantileSketch().quantile(0.5) is None
+    assert QuantileSketch.from_json(QuantileSketch().to_json()).count == 0
+
+def test_rollup_percentiles_match_tokens():
+    """Percentiles read from the rollups match the served tokens' own."""
+    from app import app, db, Token, rollup_models
+    from analytics import waited_seconds
+    from rollups import check_rollups, sketch_percentiles
+    from sketches import RELATIVE_ACCURACY
+
+    with app.app_context():
+        db.create_all()
+        Token.query.delete()
+        db.session.commit()
+        add_random_tokens(db, Token, 300)
+
+        # Serving and reverting tokens adds and removes their samples
+        tokens = Token.query.order_by(Token.id).all()
+        for token in tokens[:40]:
+            token.status = 'PENDING' if token.status == 'SERVED' else token.status
+        db.session.commit()
+        assert check_rollups(db.session, Token, rollup_models) == []
+
+        served = Token.query.filter(Token.status == 'SERVED', Token.served_at.isnot(None)).all()
+        waits = [waited_seconds(t.created_at, t.served_at, t.skip_count or 0, t.recovery_time) for t in served]
+        percentiles = sketch_percentiles(db.session, rollup_models['sketch'])
+
+        for p in (50, 90, 99):
+            expected = exact_quantile(waits, p / 100) / 60
+            assert percentiles['overall']['waiting'][p] == pytest.approx(expected, rel=RELATIVE_ACCURACY, abs=1 / 60)
+
+        by_reason = {}
+        for token, wait in zip(served, waits):
+            by_reason.setdefault(token.visit_reason, []).append(wait)
+        assert set(percentiles['reason']) == set(by_reason)
+        for reason, reason_waits in by_reason.items():
+            assert percentiles['reason'][reason]['count'] == len(reason_waits)
+            expected = exact_quantile(reason_waits, 0.9) / 60
+            assert percentiles['reason'][reason]['waiting'][90] == pytest.approx(expected, rel=RELATIVE_ACCURACY, abs=1 / 60)
+
+        Token.query.delete()
+        db.session.commit()
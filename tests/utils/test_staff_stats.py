@@ -0,0 +1,195 @@
+"""
+Tests for the incrementally maintained staff statistics.
+"""
+
+import os
+import sys
+import random
+import statistics
+import threading
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+# Add the parent directory to the path so we can import the app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+
+def test_welford_states_are_stable_and_merge():
+    """Running and merged states match the exact mean and deviation."""
+    from staff_stats import EMPTY_STATE, add_value, merge_states, remove_value, standard_deviation
+
+    rng = random.Random(4)
+    # A large offset breaks the naive sum-of-squares formula
+    values = [1e9 + rng.uniform(0, 600) for _ in range(2000)]
+
+    state = EMPTY_STATE
+    days = [EMPTY_STATE] * 5
+    for index, value in enumerate(values):
+        state = add_value(state, value)
+        days[index % 5] = add_value(days[index % 5], value)
+
+    for count, mean, m2 in (state, merge_states(days)):
+        assert count == len(values)
+        assert mean == pytest.approx(statistics.mean(values), rel=1e-12)
+        assert standard_deviation(count, m2) == pytest.approx(statistics.stdev(values), rel=1e-6)
+
+    # Taking values back out returns the earlier states
+    for value in reversed(values[100:]):
+        state = remove_value(state, value)
+    count, mean, m2 = state
+    assert count == 100
+    assert mean == pytest.approx(statistics.mean(values[:100]), rel=1e-12)
+    assert standard_deviation(count, m2) == pytest.approx(statistics.stdev(values[:100]), rel=1e-6)
+    assert remove_value(add_value(EMPTY_STATE, 5.0), 5.0) == EMPTY_STATE
+
+def test_parallel_serves_keep_every_update():
+    """Concurrent serves by one employee are all counted, overall and per day."""
+    from app import app, db, Employee, StaffDailyStats
+    from staff_stats import record_service, staff_service_stats
+
+    with app.app_context():
+        db.create_all()
+        Employee.query.filter_by(employee_id='stats01').delete()
+        employee = Employee(employee_id='stats01', name='Stats Tester', role='employee', is_active=True)
+        employee.set_password('password123')
+        db.session.add(employee)
+        db.session.commit()
+        employee_id = employee.id
+        StaffDailyStats.query.filter_by(employee_id=employee_id).delete()
+        db.session.commit()
+
+    rng = random.Random(9)
+    serves = [[(datetime(2024, 3, 5 + rng.randint(0, 1), 10, 0), rng.randint(60, 1800)) for _ in range(10)]
+              for _ in range(6)]
+
+    def serve(batch):
+        with app.app_context():
+            for created_at, seconds in batch:
+                token = SimpleNamespace(created_at=created_at, service_duration=seconds)
+                record_service(db.session, Employee, StaffDailyStats, employee_id, token)
+                db.session.commit()
+
+    threads = [threading.Thread(target=serve, args=(batch,)) for batch in serves]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    minutes = [seconds / 60 for batch in serves for _, seconds in batch]
+    with app.app_context():
+        employee = db.session.get(Employee, employee_id)
+        assert employee.tokens_served == len(minutes)
+        assert employee.service_count == len(minutes)
+        assert employee.avg_service_time == pytest.approx(statistics.mean(minutes))
+
+        stats = staff_service_stats(db.session, StaffDailyStats)[employee_id]
+        assert stats['served'] == len(minutes)
+        assert stats['avg_service_time'] == pytest.approx(statistics.mean(minutes))
+        assert stats['stdev_service_time'] == pytest.approx(statistics.stdev(minutes))
+
+        # One day on its own
+        first_day = [seconds / 60 for batch in serves for created_at, seconds in batch if created_at.day == 5]
+        stats = staff_service_stats(db.session, StaffDailyStats, date(2024, 3, 5), date(2024, 3, 5))[employee_id]
+        assert stats['served'] == len(first_day)
+        assert stats['avg_service_time'] == pytest.approx(statistics.mean(first_day))
+
+        StaffDailyStats.query.filter_by(employee_id=employee_id).delete()
+        db.session.delete(employee)
+        db.session.commit()
+
+def test_serving_updates_staff_stats():
+    """Serving through the queue credits the employee once per token."""
+    from app import app, db, Token, Settings, TokenStatusChange, Employee, StaffDailyStats
+    from staff_stats import employee_service_stats, rebuild_staff_stats
+    from tests.helpers import reset_queue
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+    with app.app_context():
+        Employee.query.filter_by(employee_id='stats02').delete()
+        employee = Employee(employee_id='stats02', name='Queue Tester', role='employee', is_active=True)
+        employee.set_password('password123')
+        db.session.add(employee)
+        db.session.commit()
+        employee_id = employee.id
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['employee_id'] = employee_id
+            sess['employee_role'] = 'employee'
+
+        client.post('/api/queue/next')
+        client.post('/api/queue/mark-served')
+        client.post(f'/api/queue/serve/{ids[1]}')
+        client.post('/api/queue/mark-served')
+
+    with app.app_context():
+        served = Token.query.filter_by(staff_id=str(employee_id), status='SERVED').all()
+        assert len(served) == 2
+        stats = employee_service_stats(db.session.get(Employee, employee_id))
+        assert stats['served'] == 2
+        assert stats['avg_service_time'] == pytest.approx(statistics.mean(t.service_duration / 60 for t in served))
+
+        # A rebuild from the tokens gives the same numbers
+        rebuild_staff_stats(db.session, Token, Employee, StaffDailyStats)
+        db.session.commit()
+        assert employee_service_stats(db.session.get(Employee, employee_id)) == pytest.approx(stats)
+
+        StaffDailyStats.query.delete()
+        Employee.query.filter_by(employee_id='stats02').delete()
+        db.session.commit()
+
+def test_reverted_tokens_are_not_counted_twice():
+    """Reverting a served token takes back its credit, so serving it again counts it once."""
+    from app import app, db, get_ist_time, Token, Settings, TokenStatusChange, Employee, StaffDailyStats
+    from staff_stats import employee_service_stats, rebuild_staff_stats, staff_service_stats
+    from tests.helpers import reset_queue
+
+    ids = reset_queue(app, db, Token, Settings, TokenStatusChange)
+    with app.app_context():
+        # Spread the service times
+        for minutes, token_id in zip((20, 12, 5), ids):
+            db.session.get(Token, token_id).created_at = get_ist_time() - timedelta(minutes=minutes)
+        Employee.query.filter_by(employee_id='stats03').delete()
+        StaffDailyStats.query.delete()
+        employee = Employee(employee_id='stats03', name='Revert Tester', role='employee', is_active=True)
+        employee.set_password('password123')
+        db.session.add(employee)
+        db.session.commit()
+        employee_id = employee.id
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['employee_id'] = employee_id
+            sess['employee_role'] = 'employee'
+
+        # next serves the current token too
+        client.get('/next-token')
+        client.get('/next-token')
+        client.get('/mark-as-served')
+        client.get(f'/revert-token-status/{ids[1]}')
+        client.get('/next-token')
+        client.get('/mark-as-served')
+
+    with app.app_context():
+        served = Token.query.filter_by(staff_id=str(employee_id), status='SERVED').all()
+        assert sorted(token.id for token in served) == ids[:2]
+        minutes = [token.service_duration / 60 for token in served]
+
+        stats = employee_service_stats(db.session.get(Employee, employee_id))
+        daily = staff_service_stats(db.session, StaffDailyStats)[employee_id]
+        assert stats['served'] == daily['served'] == 2
+        assert stats['avg_service_time'] == pytest.approx(statistics.mean(minutes))
+        assert stats['stdev_service_time'] == pytest.approx(statistics.stdev(minutes))
+        assert daily == pytest.approx(stats)
+
+        # The live numbers are the ones a rebuild from the tokens gives
+        rebuild_staff_stats(db.session, Token, Employee, StaffDailyStats)
+        db.session.commit()
+        assert employee_service_stats(db.session.get(Employee, employee_id)) == pytest.approx(stats)
+        assert staff_service_stats(db.session, StaffDailyStats)[employee_id] == pytest.approx(daily)
+
+        StaffDailyStats.query.delete()
+        Employee.query.filter_by(employee_id='stats03').delete()
+        db.session.commit()
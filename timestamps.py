@@ -0,0 +1,76 @@
+# Timestamps stored as integer UTC epoch milliseconds
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import BigInteger, type_coerce
+from sqlalchemy.types import TypeDecorator
+
+# Local (display and service date) timezone
+IST = timezone(timedelta(hours=5, minutes=30))
+IST_OFFSET_MS = int(IST.utcoffset(None) / timedelta(milliseconds=1))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MS_PER_DAY = 86400000
+MS_PER_HOUR = 3600000
+
+
+def to_epoch_ms(value):
+    """Milliseconds since the epoch; naive datetimes are local (IST) times"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=IST)
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+
+def seconds_between(start, end):
+    """Seconds from start to end, as a float"""
+    return (to_epoch_ms(end) - to_epoch_ms(start)) / 1000
+
+
+def local_time(value):
+    """A datetime as an aware IST time; naive datetimes already are local"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=IST)
+    return value.astimezone(IST)
+
+
+def local_naive(value):
+    """Local wall-clock time without tzinfo, for Excel and CSV cells"""
+    if value is None:
+        return None
+    return local_time(value).replace(tzinfo=None)
+
+
+class EpochDateTime(TypeDecorator):
+    """
+    DateTime column stored as integer UTC epoch milliseconds.
+
+    Reads return aware datetimes in IST, so they display as local time and
+    compare with get_ist_time() without any naive/aware handling. In SQL,
+    durations are plain integer subtraction (see epoch_ms).
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, int):
+            return value
+        return to_epoch_ms(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return (EPOCH + timedelta(milliseconds=int(value))).astimezone(IST)
+
+
+def epoch_ms(column):
+    """An EpochDateTime column as plain milliseconds, for SQL arithmetic"""
+    return type_coerce(column, BigInteger)
+
+
+def local_ms(column):
+    """Milliseconds since the epoch in IST wall-clock time, for day and hour buckets"""
+    return epoch_ms(column) + IST_OFFSET_MS